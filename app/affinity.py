@@ -0,0 +1,158 @@
+"""
+对话回退记忆模块
+记住每段对话上一轮由哪个上游提供响应，多轮对话中曾经回退过的对话直接使用备用上游
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from app.codec import dumps
+from app.config import AFFINITY_ENABLED, AFFINITY_MAX_ENTRIES, AFFINITY_TTL
+
+logger = logging.getLogger(__name__)
+
+
+def conversation_keys(model: str, messages: list) -> Tuple[Optional[bytes], Optional[bytes]]:
+    """
+    计算对话的查询键和记录键
+
+    记录键是本轮完整 messages 的哈希；下一轮请求去掉最后一条用户消息及其前面的
+    assistant 回复后，剩余的前缀与本轮完整 messages 相同，因此其查询键等于本轮的记录键。
+    两个键在同一次序列化过程中得到
+
+    Args:
+        model: 模型名称
+        messages: 请求中的 messages 列表
+
+    Returns:
+        (查询键, 记录键)，无法计算时对应位置为 None
+    """
+    if not isinstance(messages, list) or not messages:
+        return None, None
+
+    # 查询前缀：去掉最后一条用户消息，以及紧挨着它的上一轮 assistant 回复
+    cut = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        message = messages[index]
+        if isinstance(message, dict) and message.get("role") == "user":
+            cut = index
+            break
+    if cut > 0 and isinstance(messages[cut - 1], dict) and messages[cut - 1].get("role") == "assistant":
+        cut -= 1
+
+    hasher = hashlib.blake2b(model.encode("utf-8"), digest_size=16)
+    lookup_key = None
+    for index, message in enumerate(messages):
+        if index == cut:
+            lookup_key = hasher.copy().digest()
+        hasher.update(b"\x1e")
+        hasher.update(dumps(message, sort_keys=True))
+
+    if cut == 0:
+        # 第一轮对话没有可查询的前缀
+        lookup_key = None
+    return lookup_key, hasher.digest()
+
+
+class ConversationMemory:
+    """
+    对话回退记忆
+
+    以 LRU + TTL 方式保存 对话哈希 -> 上游 的映射，条目数受 max_entries 限制，
+    每个条目只占用一个定长哈希和少量元数据
+    """
+
+    def __init__(
+        self,
+        enabled: bool = AFFINITY_ENABLED,
+        max_entries: int = AFFINITY_MAX_ENTRIES,
+        ttl: float = AFFINITY_TTL
+    ):
+        """
+        初始化对话记忆
+
+        Args:
+            enabled: 是否启用
+            max_entries: 最大条目数
+            ttl: 条目有效期（秒）
+        """
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[bytes, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key: Optional[bytes]) -> Optional[str]:
+        """
+        查询对话上一轮使用的上游
+
+        Args:
+            key: conversation_keys 返回的查询键
+
+        Returns:
+            上游类型，未命中时返回 None
+        """
+        if key is None:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def remember(self, key: Optional[bytes], upstream: str) -> None:
+        """
+        记录本轮对话使用的上游
+
+        Args:
+            key: conversation_keys 返回的记录键
+            upstream: 提供响应的上游类型
+        """
+        if key is None:
+            return
+
+        with self._lock:
+            self._entries[key] = (upstream, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def snapshot(self) -> dict:
+        """获取记忆的命中统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups * 100, 2) if lookups > 0 else 0,
+                "evictions": self.evictions
+            }
+
+
+# 全局对话记忆实例
+_affinity_instance: Optional[ConversationMemory] = None
+
+
+def get_affinity() -> ConversationMemory:
+    """获取对话记忆单例实例"""
+    global _affinity_instance
+    if _affinity_instance is None:
+        _affinity_instance = ConversationMemory()
+    return _affinity_instance
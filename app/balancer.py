@@ -0,0 +1,208 @@
+"""
+负载均衡模块
+每一级上游（正常 / 备用）由多个端点组成，按进行中请求数或延迟 EWMA 选择端点，
+连续失败的端点会被暂时摘除
+"""
+import logging
+import random
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import httpx
+
+from app.config import BALANCE_STRATEGY, EJECT_CONSECUTIVE_ERRORS, EJECT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 负载均衡策略
+STRATEGY_LEAST_OUTSTANDING = "least_outstanding"
+STRATEGY_EWMA = "ewma"
+
+# 延迟 EWMA 的平滑系数
+EWMA_ALPHA = 0.3
+
+
+def is_endpoint_error(status_code: int) -> bool:
+    """上游状态码是否表示端点本身出错（服务端错误或限流）"""
+    return status_code >= 500 or status_code == 429
+
+
+class Endpoint:
+    """单个上游端点及其统计"""
+
+    def __init__(self, url: str, key: str = "", weight: float = 1.0):
+        self.url = url.rstrip("/")
+        self.key = key
+        self.weight = weight if weight > 0 else 1.0
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        # 响应头到达耗时的指数移动平均（秒），没有样本时为 None
+        self.ewma: Optional[float] = None
+        self.latency_total = 0.0
+        self.latency_samples = 0
+
+    def is_ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    def score(self, strategy: str) -> float:
+        """选择得分，越小越优先"""
+        load = (self.outstanding + 1) / self.weight
+        if strategy == STRATEGY_EWMA:
+            # 没有样本的端点优先，尽快获得延迟数据
+            return (self.ewma or 0.0) * load
+        return load
+
+
+class EndpointCall:
+    """
+    一次端点调用的跟踪器
+
+    在 with 块中使用：收到响应头时调用 connected() 记录延迟和状态码；
+    退出时释放端点，传输层异常视为端点失败，任务取消等其他情况不计入失败
+    """
+
+    def __init__(self, pool: 'EndpointPool', endpoint: Endpoint):
+        self.pool = pool
+        self.endpoint = endpoint
+        self.started_at = time.monotonic()
+        self.latency: Optional[float] = None
+        self.error = False
+
+    def connected(self, status_code: int) -> None:
+        """记录响应头到达"""
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started_at
+        self.error = is_endpoint_error(status_code)
+
+    def __enter__(self) -> 'EndpointCall':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None and issubclass(exc_type, httpx.TransportError):
+            self.error = True
+        self.pool.release(self.endpoint, self.latency, self.error)
+
+
+class EndpointPool:
+    """
+    一级上游的端点池
+
+    选择时跳过被摘除的端点；全部端点都被摘除时选择最早恢复的端点，避免整级不可用。
+    统计数据会被 WebUI 线程读取，因此用锁保护
+    """
+
+    def __init__(
+        self,
+        tier: str,
+        endpoints: List[dict],
+        strategy: str = BALANCE_STRATEGY,
+        eject_errors: int = EJECT_CONSECUTIVE_ERRORS,
+        eject_seconds: float = EJECT_SECONDS
+    ):
+        """
+        初始化端点池
+
+        Args:
+            tier: 上游级别（normal / fallback）
+            endpoints: 端点配置列表（url, key, weight）
+            strategy: 负载均衡策略
+            eject_errors: 连续失败多少次后摘除端点
+            eject_seconds: 摘除时长（秒）
+        """
+        self.tier = tier
+        self.strategy = strategy
+        self.eject_errors = eject_errors
+        self.eject_seconds = eject_seconds
+        self.endpoints = [
+            Endpoint(item["url"], item.get("key", ""), item.get("weight", 1.0))
+            for item in endpoints
+        ]
+        self._lock = threading.Lock()
+
+    def pick(self) -> Endpoint:
+        """选择一个端点并增加其进行中请求数"""
+        now = time.time()
+        with self._lock:
+            candidates = [e for e in self.endpoints if not e.is_ejected(now)]
+            if not candidates:
+                candidates = [min(self.endpoints, key=lambda e: e.ejected_until)]
+
+            if len(candidates) == 1:
+                endpoint = candidates[0]
+            else:
+                scores = [e.score(self.strategy) for e in candidates]
+                best = min(scores)
+                tied = [e for e, s in zip(candidates, scores) if s == best]
+                # 得分相同时按权重随机选择
+                endpoint = random.choices(tied, weights=[e.weight for e in tied])[0]
+
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def call(self, endpoint: Endpoint) -> EndpointCall:
+        """创建端点调用跟踪器"""
+        return EndpointCall(self, endpoint)
+
+    def release(self, endpoint: Endpoint, latency: Optional[float], error: bool) -> None:
+        """
+        释放端点并记录本次结果
+
+        Args:
+            endpoint: pick() 返回的端点
+            latency: 响应头到达耗时（秒），未收到响应时为 None
+            error: 是否为端点失败
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if latency is not None:
+                endpoint.latency_total += latency
+                endpoint.latency_samples += 1
+                if endpoint.ewma is None:
+                    endpoint.ewma = latency
+                else:
+                    endpoint.ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * endpoint.ewma
+
+            if not error:
+                endpoint.consecutive_errors = 0
+                return
+
+            endpoint.errors += 1
+            endpoint.consecutive_errors += 1
+            if self.eject_errors > 0 and endpoint.consecutive_errors >= self.eject_errors:
+                endpoint.ejected_until = time.time() + self.eject_seconds
+                endpoint.ejections += 1
+                # 恢复后再失败一次即重新摘除
+                endpoint.consecutive_errors = self.eject_errors - 1
+                logger.warning(
+                    f"{self.tier} 上游端点 {endpoint.url} 连续失败，摘除 {self.eject_seconds:.0f} 秒"
+                )
+
+    def in_flight(self) -> List[Tuple[str, int]]:
+        """各端点进行中的请求数（不加锁读取，供 /metrics 使用）"""
+        return [(e.url, e.outstanding) for e in self.endpoints]
+
+    def snapshot(self) -> list:
+        """获取各端点的统计"""
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "url": e.url,
+                    "weight": e.weight,
+                    "outstanding": e.outstanding,
+                    "requests": e.requests,
+                    "errors": e.errors,
+                    "ejected": e.is_ejected(now),
+                    "ejections": e.ejections,
+                    "ewma_ms": round(e.ewma * 1000, 2) if e.ewma is not None else None,
+                    "avg_latency_ms": round(e.latency_total / e.latency_samples * 1000, 2)
+                    if e.latency_samples > 0 else None
+                }
+                for e in self.endpoints
+            ]
@@ -0,0 +1,224 @@
+"""
+断路器模块
+按模型统计正常上游的空响应率，空响应率过高时直接将该模型的请求路由到备用上游
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from app.config import (
+    BREAKER_ENABLED, BREAKER_WINDOW, BREAKER_MIN_REQUESTS,
+    BREAKER_THRESHOLD, BREAKER_OPEN_SECONDS
+)
+from app.histogram import MAX_MODELS
+
+logger = logging.getLogger(__name__)
+
+# 断路器状态
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+# 路由决策
+ROUTE_NORMAL = "normal"
+ROUTE_PROBE = "probe"
+ROUTE_FALLBACK = "fallback"
+
+
+class ModelBreaker:
+    """单个模型的断路器状态"""
+
+    def __init__(self, window: int):
+        # 最近 window 次正常上游结果，True 表示空响应
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.empty_count = 0
+        self.state = STATE_CLOSED
+        self.opened_at = 0.0
+        self.probe_started_at: Optional[float] = None
+        self.skipped = 0
+        # 最近一次记录结果的时间，用于淘汰空闲的断路器
+        self.last_seen = time.monotonic()
+
+    @property
+    def empty_rate(self) -> float:
+        """窗口内的空响应率（0-1）"""
+        if not self.outcomes:
+            return 0.0
+        return self.empty_count / len(self.outcomes)
+
+    def add(self, is_empty: bool) -> None:
+        """记录一次结果并维护窗口内的空响应计数"""
+        if len(self.outcomes) == self.outcomes.maxlen and self.outcomes[0]:
+            self.empty_count -= 1
+        self.outcomes.append(is_empty)
+        if is_empty:
+            self.empty_count += 1
+
+    def reset(self) -> None:
+        """清空窗口"""
+        self.outcomes.clear()
+        self.empty_count = 0
+
+
+class CircuitBreaker:
+    """
+    按模型的自适应断路器
+
+    closed: 正常请求，记录结果；空响应率超过阈值时打开
+    open: 直接使用备用上游；经过 open_seconds 后放行一次探测请求
+    half_open: 探测请求结果非空则关闭，否则重新打开
+    """
+
+    def __init__(
+        self,
+        enabled: bool = BREAKER_ENABLED,
+        window: int = BREAKER_WINDOW,
+        min_requests: int = BREAKER_MIN_REQUESTS,
+        threshold: float = BREAKER_THRESHOLD,
+        open_seconds: float = BREAKER_OPEN_SECONDS
+    ):
+        """
+        初始化断路器
+
+        Args:
+            enabled: 是否启用
+            window: 滑动窗口大小（请求数）
+            min_requests: 窗口内至少需要的请求数
+            threshold: 打开断路器的空响应率阈值（百分比）
+            open_seconds: 打开后多久发起探测（秒）
+        """
+        self.enabled = enabled
+        self.window = window
+        self.min_requests = min_requests
+        self.threshold = threshold / 100
+        self.open_seconds = open_seconds
+        # 模型名称由客户端决定，最多跟踪 MAX_MODELS 个（与统计模块一致）
+        self._models: Dict[str, ModelBreaker] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model: str) -> Optional[ModelBreaker]:
+        """获取模型的断路器；已满时淘汰最久未使用的关闭状态断路器，无可淘汰时返回 None"""
+        breaker = self._models.get(model)
+        if breaker is None:
+            if len(self._models) >= MAX_MODELS:
+                idle = [
+                    (item.last_seen, name) for name, item in self._models.items()
+                    if item.state == STATE_CLOSED
+                ]
+                if not idle:
+                    return None
+                del self._models[min(idle)[1]]
+            breaker = self._models[model] = ModelBreaker(self.window)
+        breaker.last_seen = time.monotonic()
+        return breaker
+
+    def route(self, model: str) -> str:
+        """
+        决定请求的路由
+
+        Returns:
+            ROUTE_NORMAL / ROUTE_PROBE / ROUTE_FALLBACK
+        """
+        if not self.enabled:
+            return ROUTE_NORMAL
+
+        with self._lock:
+            breaker = self._models.get(model)
+            if breaker is None or breaker.state == STATE_CLOSED:
+                return ROUTE_NORMAL
+
+            now = time.time()
+            if breaker.state == STATE_OPEN and now - breaker.opened_at >= self.open_seconds:
+                breaker.state = STATE_HALF_OPEN
+                breaker.probe_started_at = None
+
+            if breaker.state == STATE_HALF_OPEN:
+                # 同一时间只放行一个探测请求；探测请求长时间无结果时允许重新探测
+                probe_started_at = breaker.probe_started_at
+                if probe_started_at is None or now - probe_started_at >= self.open_seconds:
+                    breaker.probe_started_at = now
+                    logger.info(f"断路器半开，发送探测请求到正常上游: {model}")
+                    return ROUTE_PROBE
+
+            breaker.skipped += 1
+            return ROUTE_FALLBACK
+
+    def record(self, model: str, is_empty: bool, probe: bool = False) -> None:
+        """
+        记录正常上游的一次结果
+
+        Args:
+            model: 模型名称
+            is_empty: 正常上游是否返回空响应
+            probe: 是否为半开状态下的探测请求
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            breaker = self._get(model)
+            if breaker is None:
+                # 跟踪的模型已满且都处于打开状态，新模型暂不统计
+                return
+
+            if probe:
+                if breaker.state != STATE_HALF_OPEN:
+                    return
+                breaker.probe_started_at = None
+                if is_empty:
+                    breaker.state = STATE_OPEN
+                    breaker.opened_at = time.time()
+                    logger.warning(f"断路器探测失败，保持打开: {model}")
+                else:
+                    breaker.state = STATE_CLOSED
+                    breaker.reset()
+                    logger.info(f"断路器探测成功，恢复正常上游: {model}")
+                return
+
+            if breaker.state != STATE_CLOSED:
+                # 断路器打开前已发出的请求，结果不再计入
+                return
+
+            breaker.add(is_empty)
+            if len(breaker.outcomes) >= self.min_requests and breaker.empty_rate >= self.threshold:
+                breaker.state = STATE_OPEN
+                breaker.opened_at = time.time()
+                logger.warning(
+                    f"模型 {model} 正常上游空响应率 {breaker.empty_rate * 100:.1f}%，"
+                    f"断路器打开，请求将直接使用备用上游"
+                )
+
+    def snapshot(self) -> list:
+        """
+        获取所有模型的断路器状态
+
+        Returns:
+            状态列表，按模型名称排序
+        """
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "model": model,
+                    "state": breaker.state,
+                    "empty_rate": round(breaker.empty_rate * 100, 2),
+                    "samples": len(breaker.outcomes),
+                    "skipped": breaker.skipped,
+                    "open_seconds": round(now - breaker.opened_at, 0) if breaker.state != STATE_CLOSED else 0
+                }
+                for model, breaker in sorted(self._models.items())
+            ]
+
+
+# 全局断路器实例
+_breaker_instance: Optional[CircuitBreaker] = None
+
+
+def get_breaker() -> CircuitBreaker:
+    """获取断路器单例实例"""
+    global _breaker_instance
+    if _breaker_instance is None:
+        _breaker_instance = CircuitBreaker()
+    return _breaker_instance
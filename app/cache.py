@@ -0,0 +1,203 @@
+"""
+响应缓存模块
+缓存确定性（temperature 为 0）的非流式补全结果，流式请求可以以 SSE 形式回放
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from app.codec import dumps, loads
+from app.config import RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# 不影响生成结果、不参与缓存键计算的字段
+_IGNORED_FIELDS = ("stream", "stream_options", "user")
+
+
+def response_cache_key(body: dict, authorization: str = "") -> Optional[bytes]:
+    """
+    计算请求体的规范哈希
+
+    只有 temperature 为 0 且只生成一个候选的请求才可缓存；
+    stream 相关字段不参与计算，因此流式请求可以命中非流式请求写入的缓存
+
+    Args:
+        body: 请求体
+        authorization: 客户端的 Authorization 请求头；端点转发客户端自己的 Key 时传入，
+            避免一个客户端拿到用另一个客户端的 Key 生成（并计费）的结果
+
+    Returns:
+        缓存键，请求不可缓存时返回 None
+    """
+    if body.get("temperature") != 0 or body.get("n", 1) != 1:
+        return None
+    canonical = {k: v for k, v in body.items() if k not in _IGNORED_FIELDS}
+    digest = hashlib.blake2b(dumps(canonical, sort_keys=True), digest_size=16)
+    digest.update(authorization.encode("utf-8"))
+    return digest.digest()
+
+
+def completion_to_sse(content: bytes, include_usage: bool = False) -> bytes:
+    """
+    把缓存的 chat.completion 响应转换为 SSE 数据
+
+    每个候选生成一个包含完整内容的增量事件和一个结束事件，最后是 [DONE]
+
+    Args:
+        content: 缓存的响应 JSON 字节
+        include_usage: 是否附加 usage 事件（对应 stream_options.include_usage）
+
+    Returns:
+        完整的 SSE 响应字节
+    """
+    completion = loads(content)
+    base = {
+        "id": completion.get("id", ""),
+        "object": "chat.completion.chunk",
+        "created": completion.get("created", int(time.time())),
+        "model": completion.get("model", "")
+    }
+
+    events = []
+    for choice in completion.get("choices", []):
+        index = choice.get("index", 0)
+        message = choice.get("message") or {}
+        delta = {"role": message.get("role", "assistant"), "content": message.get("content") or ""}
+        if message.get("tool_calls"):
+            delta["tool_calls"] = [
+                dict(call, index=i) for i, call in enumerate(message["tool_calls"])
+            ]
+        events.append({**base, "choices": [{"index": index, "delta": delta, "finish_reason": None}]})
+        events.append({**base, "choices": [{
+            "index": index, "delta": {}, "finish_reason": choice.get("finish_reason", "stop")
+        }]})
+
+    if include_usage and completion.get("usage"):
+        events.append({**base, "choices": [], "usage": completion["usage"]})
+
+    parts = [
+        b"data: " + dumps(event) + b"\n\n"
+        for event in events
+    ]
+    parts.append(b"data: [DONE]\n\n")
+    return b"".join(parts)
+
+
+@dataclass
+class CachedResponse:
+    """缓存条目"""
+    content: bytes
+    upstream: str
+    expires_at: float
+
+
+class ResponseCache:
+    """
+    响应缓存
+
+    按总字节数限制容量，超出时按 LRU 淘汰；条目过期后在访问时删除
+    """
+
+    def __init__(
+        self,
+        enabled: bool = RESPONSE_CACHE_ENABLED,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl: float = RESPONSE_CACHE_TTL
+    ):
+        """
+        初始化响应缓存
+
+        Args:
+            enabled: 是否启用
+            max_bytes: 缓存内容的最大总字节数
+            ttl: 条目有效期（秒）
+        """
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[bytes, CachedResponse]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Optional[bytes]) -> Optional[CachedResponse]:
+        """
+        查询缓存
+
+        Returns:
+            缓存条目，未命中或已过期时返回 None
+        """
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Optional[bytes], content: bytes, upstream: str) -> None:
+        """
+        写入缓存
+
+        Args:
+            key: response_cache_key 返回的缓存键
+            content: 最终返回给客户端的响应 JSON 字节
+            upstream: 提供响应的上游类型
+        """
+        if key is None or len(content) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CachedResponse(content, upstream, time.time() + self.ttl)
+            self._size += len(content)
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key: bytes) -> None:
+        """删除条目并更新容量（调用方需持有锁）"""
+        entry = self._entries.pop(key)
+        self._size -= len(entry.content)
+
+    def snapshot(self) -> dict:
+        """获取缓存统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups * 100, 2) if lookups > 0 else 0,
+                "evictions": self.evictions
+            }
+
+
+# 全局响应缓存实例
+_cache_instance: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> ResponseCache:
+    """获取响应缓存单例实例"""
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = ResponseCache()
+    return _cache_instance
@@ -0,0 +1,271 @@
+"""
+请求合并模块
+客户端超时重试时，同一个请求体可能同时有多份在处理。启用后，请求体规范哈希相同的并发请求
+只有第一个（领头请求）访问上游，其余请求等待并共享它的结果；流式请求订阅领头请求的数据块
+"""
+import asyncio
+import hashlib
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, TypeVar
+
+from app.codec import dumps
+from app.config import COALESCE_ENABLED, COALESCE_STREAM_BUFFER
+from app.context import RequestContext
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 数据块队列中的结束标记和溢出标记
+_END = object()
+_OVERFLOW = object()
+
+
+class StreamOverflowError(Exception):
+    """订阅者跟不上共享的上游数据块，已被断开（中断连接，避免客户端把不完整的响应当作正常结束）"""
+
+
+class StreamFlight:
+    """
+    一次共享的流式上游调用
+
+    上游数据块由独立的任务读取并分发给所有订阅者，某个客户端断开不影响其他订阅者；
+    所有订阅者都断开后才取消上游调用。只剩一个订阅者时等待它读取（与不合并时一样施加背压），
+    有多个订阅者时断开跟不上的订阅者
+    """
+
+    def __init__(self, ctx: RequestContext, buffer_chunks: int):
+        self.ctx = ctx
+        self.buffer_chunks = buffer_chunks
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers: Set[asyncio.Queue] = set()
+        # 已分发的数据块，供后加入的订阅者补发；超过缓冲上限后不再接受新的订阅者
+        self.history: List[bytes] = []
+        self.joinable = True
+        self.done = False
+        # 上游调用出错时的异常，每个订阅者都会重新抛出
+        self.error: Optional[BaseException] = None
+        # 订阅者每取出一个数据块时置位，供只剩一个订阅者时等待
+        self.drained = asyncio.Event()
+
+    def subscribe(self) -> asyncio.Queue:
+        # 多留一个位置给结束标记
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.buffer_chunks + 1)
+        for chunk in self.history:
+            queue.put_nowait(chunk)
+        if self.done:
+            queue.put_nowait(_END)
+        self.subscribers.add(queue)
+        return queue
+
+    async def publish(self, chunk: bytes) -> int:
+        """
+        分发一个数据块
+
+        Returns:
+            因跟不上而被断开的订阅者数
+        """
+        # 只剩一个订阅者时不断开它，等它读取出空位
+        while len(self.subscribers) == 1:
+            queue = next(iter(self.subscribers))
+            if queue.qsize() < self.buffer_chunks:
+                break
+            self.drained.clear()
+            await self.drained.wait()
+
+        if self.joinable:
+            self.history.append(chunk)
+            if len(self.history) >= self.buffer_chunks:
+                self.joinable = False
+                self.history = []
+        dropped = 0
+        for queue in list(self.subscribers):
+            if queue.qsize() >= self.buffer_chunks:
+                # 订阅者的缓冲已满：断开它，不让慢客户端拖住上游和其他订阅者
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(_OVERFLOW)
+                self.subscribers.discard(queue)
+                dropped += 1
+            else:
+                queue.put_nowait(chunk)
+        return dropped
+
+    def close(self) -> None:
+        """上游调用结束，通知所有订阅者"""
+        self.done = True
+        self.joinable = False
+        for queue in self.subscribers:
+            queue.put_nowait(_END)
+
+
+class RequestCoalescer:
+    """
+    相同请求合并器（单个事件循环内使用）
+
+    非流式请求共享领头请求的上游调用结果；流式请求订阅领头请求的数据块，
+    每个订阅者的缓冲有上限，已分发的数据块超过上限后的相同请求不再合并
+    """
+
+    def __init__(self, enabled: bool = COALESCE_ENABLED, buffer_chunks: int = COALESCE_STREAM_BUFFER):
+        """
+        初始化合并器
+
+        Args:
+            enabled: 是否启用
+            buffer_chunks: 流式请求每个订阅者最多缓冲的数据块数
+        """
+        self.enabled = enabled
+        self.buffer_chunks = buffer_chunks
+        self._requests: Dict[bytes, tuple] = {}
+        self._streams: Dict[bytes, StreamFlight] = {}
+        # 访问了上游的请求数、合并到进行中请求的请求数（即节省的上游调用数）、因缓冲溢出被断开的订阅者数
+        self.leaders = 0
+        self.followers = 0
+        self.dropped = 0
+
+    def key(self, body: dict, headers: dict) -> Optional[bytes]:
+        """
+        计算合并键：请求体的规范哈希加上客户端 Key（端点可能使用客户端的 Key）
+
+        Returns:
+            合并键，未启用时返回 None
+        """
+        if not self.enabled:
+            return None
+        digest = hashlib.blake2b(dumps(body, sort_keys=True), digest_size=16)
+        digest.update(headers.get("authorization", "").encode("utf-8"))
+        return digest.digest()
+
+    async def run(self, key: bytes, ctx: RequestContext, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        执行非流式请求，相同的请求正在进行时等待其结果
+
+        Args:
+            key: 合并键
+            ctx: 本请求的上下文
+            call: 访问上游的协程函数（只有领头请求会调用）
+
+        Returns:
+            上游调用的结果（多个请求共享同一个对象）
+        """
+        flight = self._requests.get(key)
+        if flight is None:
+            task = asyncio.create_task(call())
+            flight = (ctx, task)
+            self._requests[key] = flight
+            task.add_done_callback(lambda _: self._finish_request(key, flight))
+            self.leaders += 1
+        else:
+            ctx.coalesced = True
+            self.followers += 1
+            logger.info("相同请求正在处理，等待其结果")
+
+        leader, task = flight
+        # 客户端断开时不取消共享的上游调用
+        result = await asyncio.shield(task)
+        if ctx.coalesced:
+            ctx.follow(leader)
+        return result
+
+    async def stream(
+        self,
+        key: bytes,
+        ctx: RequestContext,
+        open_stream: Callable[[], AsyncIterator[bytes]]
+    ) -> AsyncIterator[bytes]:
+        """
+        执行流式请求，相同的请求正在进行时订阅其数据块
+
+        Args:
+            key: 合并键
+            ctx: 本请求的上下文
+            open_stream: 创建上游数据块迭代器的函数（只有领头请求会调用）
+
+        Yields:
+            数据块
+        """
+        flight = self._streams.get(key)
+        if flight is None or not flight.joinable:
+            flight = StreamFlight(ctx, self.buffer_chunks)
+            self._streams[key] = flight
+            flight.task = asyncio.create_task(self._pump(key, flight, open_stream()))
+            self.leaders += 1
+        else:
+            ctx.coalesced = True
+            self.followers += 1
+            logger.info("相同的流式请求正在处理，订阅其数据块")
+
+        queue = flight.subscribe()
+        try:
+            while True:
+                chunk = await queue.get()
+                flight.drained.set()
+                if chunk is _END:
+                    if flight.error is not None:
+                        # 与不合并时一样中断响应，而不是以看似完整的响应结束
+                        raise flight.error
+                    break
+                if chunk is _OVERFLOW:
+                    logger.warning("订阅者跟不上上游数据块，已断开")
+                    raise StreamOverflowError()
+                yield chunk
+        finally:
+            flight.subscribers.discard(queue)
+            if ctx.coalesced:
+                ctx.follow(flight.ctx)
+            if not flight.subscribers and not flight.done:
+                # 所有客户端都已断开，停止读取上游
+                flight.task.cancel()
+
+    async def _pump(self, key: bytes, flight: StreamFlight, chunks: AsyncIterator[bytes]) -> None:
+        """读取上游数据块并分发给订阅者"""
+        try:
+            async for chunk in chunks:
+                self.dropped += await flight.publish(chunk)
+                if not flight.subscribers:
+                    # 订阅者全部因缓冲溢出被断开
+                    break
+                if not flight.joinable:
+                    self._release(self._streams, key, flight)
+        except Exception as e:
+            logger.error(f"共享的流式请求出错: {e}")
+            flight.error = e
+        finally:
+            flight.close()
+            self._release(self._streams, key, flight)
+            await chunks.aclose()
+
+    def _finish_request(self, key: bytes, flight: tuple) -> None:
+        """非流式调用结束：移除调用；所有等待者都已断开时标记异常为已读取"""
+        self._release(self._requests, key, flight)
+        task = flight[1]
+        if not task.cancelled():
+            task.exception()
+
+    @staticmethod
+    def _release(flights: dict, key: bytes, flight) -> None:
+        """移除已结束（或不再接受订阅）的调用，新的相同请求将重新访问上游"""
+        if flights.get(key) is flight:
+            del flights[key]
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._requests) + len(self._streams),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "dropped_subscribers": self.dropped
+        }
+
+
+# 全局请求合并器实例
+_coalescer_instance: Optional[RequestCoalescer] = None
+
+
+def get_coalescer() -> RequestCoalescer:
+    """获取请求合并器单例实例"""
+    global _coalescer_instance
+    if _coalescer_instance is None:
+        _coalescer_instance = RequestCoalescer()
+    return _coalescer_instance
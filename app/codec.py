@@ -0,0 +1,116 @@
+"""
+JSON 编解码模块
+优先使用 orjson 或 msgspec，未安装时退回到标准库 json；热路径上的编解码统一经过本模块
+"""
+import json
+import logging
+from typing import Any, Union
+
+from starlette.responses import JSONResponse
+
+from app.config import JSON_CODEC
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 可选依赖
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover - 可选依赖
+    msgspec = None
+
+
+def _select_backend(preferred: str) -> str:
+    """根据配置和已安装的库选择后端"""
+    available = {
+        "orjson": orjson is not None,
+        "msgspec": msgspec is not None,
+        "json": True
+    }
+    if preferred != "auto":
+        if available.get(preferred):
+            return preferred
+        logger.warning(f"JSON 编解码后端 {preferred} 不可用，自动选择")
+    for name in ("orjson", "msgspec", "json"):
+        if available[name]:
+            return name
+    return "json"
+
+
+# 当前使用的后端名称
+BACKEND = _select_backend(JSON_CODEC)
+
+if BACKEND == "orjson":
+    _loads = orjson.loads
+
+    def _dumps(obj: Any, sort_keys: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+    def _dumps_pretty(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+elif BACKEND == "msgspec":
+    _decoder = msgspec.json.Decoder()
+    _encoder = msgspec.json.Encoder()
+    _sorted_encoder = msgspec.json.Encoder(order="sorted")
+    _decode = _decoder.decode
+
+    def _loads(data: Union[bytes, str]) -> Any:
+        # msgspec.DecodeError 不是 ValueError 子类，统一转换
+        try:
+            return _decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def _dumps(obj: Any, sort_keys: bool = False) -> bytes:
+        return (_sorted_encoder if sort_keys else _encoder).encode(obj)
+
+    def _dumps_pretty(obj: Any) -> bytes:
+        return msgspec.json.format(_encoder.encode(obj), indent=2)
+
+else:
+    _loads = json.loads
+
+    def _dumps(obj: Any, sort_keys: bool = False) -> bytes:
+        return json.dumps(
+            obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys
+        ).encode("utf-8")
+
+    def _dumps_pretty(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    解析 JSON
+
+    Raises:
+        ValueError: 不是合法的 JSON（各后端的解析异常统一为 ValueError 或其子类）
+    """
+    return _loads(data)
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """
+    序列化为紧凑的 UTF-8 JSON 字节
+
+    Args:
+        obj: 要序列化的对象
+        sort_keys: 是否按键排序（用于计算哈希等需要规范形式的场景）
+    """
+    return _dumps(obj, sort_keys)
+
+
+def dumps_pretty(obj: Any) -> bytes:
+    """序列化为缩进 2 格的 UTF-8 JSON 字节（用于写入文件）"""
+    return _dumps_pretty(obj)
+
+
+class FastJSONResponse(JSONResponse):
+    """使用当前编解码后端序列化内容的 JSON 响应"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
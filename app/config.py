@@ -23,12 +23,141 @@ logger = logging.getLogger(__name__)
 # 服务配置
 SERVER_PORT = int(os.getenv("SERVER_PORT", "8003"))
 MIDDLEWARE_API_KEY = os.getenv("MIDDLEWARE_API_KEY", "")
+# 管理端点（如 /debug/profile）使用的独立 Key，留空则禁用管理端点
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "")
 
 # 上游配置
+# 地址、Key 和权重均可用逗号分隔配置多个端点（Key 只配置一个时所有端点共用）
 UPSTREAM_NORMAL = os.getenv("UPSTREAM_NORMAL", "")
 UPSTREAM_FALLBACK = os.getenv("UPSTREAM_FALLBACK", "")
 UPSTREAM_NORMAL_KEY = os.getenv("UPSTREAM_NORMAL_KEY", "")
 UPSTREAM_FALLBACK_KEY = os.getenv("UPSTREAM_FALLBACK_KEY", "")
+UPSTREAM_NORMAL_WEIGHTS = os.getenv("UPSTREAM_NORMAL_WEIGHTS", "")
+UPSTREAM_FALLBACK_WEIGHTS = os.getenv("UPSTREAM_FALLBACK_WEIGHTS", "")
+# 上游端点配置文件（存在时优先于上面的环境变量）
+UPSTREAMS_FILE = os.getenv("UPSTREAMS_FILE", "upstreams.json")
+
+# 端点负载均衡配置
+# least_outstanding: 选择进行中请求最少的端点; ewma: 按响应延迟的指数移动平均选择
+BALANCE_STRATEGY = os.getenv("BALANCE_STRATEGY", "least_outstanding").lower()
+# 连续失败多少次后暂时摘除端点
+EJECT_CONSECUTIVE_ERRORS = int(os.getenv("EJECT_CONSECUTIVE_ERRORS", "5"))
+# 端点被摘除的时长（秒）
+EJECT_SECONDS = float(os.getenv("EJECT_SECONDS", "30"))
+
+# 上游连接池配置
+# 每个上游使用独立的连接池，NORMAL_POOL_* / FALLBACK_POOL_* 覆盖 POOL_* 的默认值
+def _pool_config(prefix: str) -> dict:
+    """读取指定上游的连接池配置"""
+    def setting(name: str, default: str) -> str:
+        return os.getenv(f"{prefix}_POOL_{name}", os.getenv(f"POOL_{name}", default))
+    
+    return {
+        "max_connections": int(setting("MAX_CONNECTIONS", "100")),
+        "max_keepalive_connections": int(setting("MAX_KEEPALIVE", "20")),
+        "keepalive_expiry": float(setting("KEEPALIVE_EXPIRY", "5")),
+        "http2": setting("HTTP2", "false").lower() == "true"
+    }
+
+
+NORMAL_POOL = _pool_config("NORMAL")
+FALLBACK_POOL = _pool_config("FALLBACK")
+# 等待连接池空闲连接的超时时间（秒）
+POOL_TIMEOUT = float(os.getenv("POOL_TIMEOUT", "10"))
+
+# 流式响应提交配置
+# early: 正常上游产生有效内容后立即透传（回退只能发生在提交点之前）
+# buffered: 缓冲完整响应后再判断是否回退
+STREAM_COMMIT_MODE = os.getenv("STREAM_COMMIT_MODE", "early").lower()
+# 提交前至少需要收到的非空内容增量数
+STREAM_COMMIT_TOKENS = int(os.getenv("STREAM_COMMIT_TOKENS", "1"))
+# 提交前累计内容字节数达到该值时也会提交（0 表示不按字节判断）
+STREAM_COMMIT_BYTES = int(os.getenv("STREAM_COMMIT_BYTES", "0"))
+# 为哪些上游的流式请求补充 stream_options.include_usage 以统计 token 用量
+# off / normal / fallback / all；客户端会收到上游附加的 usage 事件（choices 为空）
+STREAM_INCLUDE_USAGE = os.getenv("STREAM_INCLUDE_USAGE", "off").lower()
+
+# 对冲请求配置
+# 正常上游超过对冲延迟仍未得出结果时，提前向备用上游发起请求，先得到有效结果的一方胜出
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+# 固定对冲延迟（秒），为 0 时使用正常上游延迟的分位数
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "0"))
+# 自适应对冲延迟使用的分位数
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# 对冲预算：对冲请求数占总请求数的最大百分比
+HEDGE_BUDGET_PERCENT = float(os.getenv("HEDGE_BUDGET_PERCENT", "10"))
+
+# 断路器配置
+# 某个模型的正常上游空响应率过高时，直接将该模型的请求路由到备用上游
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "false").lower() == "true"
+# 滑动窗口大小（最近 N 次正常上游结果）
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "50"))
+# 窗口内至少需要的请求数
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "20"))
+# 打开断路器的空响应率阈值（百分比）
+BREAKER_THRESHOLD = float(os.getenv("BREAKER_THRESHOLD", "80"))
+# 断路器打开后多久发送一次探测请求（秒）
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "60"))
+
+# 对话回退记忆配置
+# 多轮对话上一轮回退过时，本轮直接使用备用上游
+AFFINITY_ENABLED = os.getenv("AFFINITY_ENABLED", "false").lower() == "true"
+# 最多记住的对话数
+AFFINITY_MAX_ENTRIES = int(os.getenv("AFFINITY_MAX_ENTRIES", "10000"))
+# 记忆有效期（秒）
+AFFINITY_TTL = float(os.getenv("AFFINITY_TTL", "1800"))
+
+# 响应缓存配置
+# 缓存 temperature 为 0 的非流式补全结果，流式请求可以回放缓存
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+# 缓存内容的最大总字节数
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 缓存有效期（秒）
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+
+# 模型列表缓存配置
+# 缓存有效期（秒），0 表示每次都请求上游
+MODELS_CACHE_TTL = float(os.getenv("MODELS_CACHE_TTL", "60"))
+# 过期后仍可返回旧列表的时长（秒），期间在后台刷新
+MODELS_STALE_TTL = float(os.getenv("MODELS_STALE_TTL", "300"))
+# 合并正常上游和备用上游的模型列表
+MODELS_MERGE_UPSTREAMS = os.getenv("MODELS_MERGE_UPSTREAMS", "false").lower() == "true"
+# 把模型映射中的模型名称加入模型列表
+MODELS_INCLUDE_ALIASES = os.getenv("MODELS_INCLUDE_ALIASES", "false").lower() == "true"
+
+# 相同请求合并配置
+# 请求体相同的并发请求只访问一次上游，其余请求共享结果（流式请求订阅领头请求的数据块）
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "false").lower() == "true"
+# 流式请求每个订阅者最多缓冲的数据块数，领头请求已发出的数据块超过该值后不再合并新的请求
+COALESCE_STREAM_BUFFER = int(os.getenv("COALESCE_STREAM_BUFFER", "256"))
+
+# 采样分析配置
+# GET /debug/profile 单次采样的最长时长（秒），0 表示禁用该端点（默认禁用，启用时还需要配置 ADMIN_API_KEY）
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "0"))
+
+# JSON 编解码后端：auto（依次尝试 orjson、msgspec、json）/ orjson / msgspec / json
+JSON_CODEC = os.getenv("JSON_CODEC", "auto").lower()
+
+# 原始字节透传（可选，默认关闭）
+# 启用时只从请求体中提取 model 和 stream，转发原始字节并原样返回上游响应体，请求体不再做完整的 JSON 校验；
+# 关闭时会完整解析并校验每个请求体
+RAW_PASSTHROUGH = os.getenv("RAW_PASSTHROUGH", "false").lower() == "true"
+
+# WebUI 运行方式
+# thread: 在代理进程的后台线程中运行; mount: 挂载到代理服务上（同一端口、同一事件循环）;
+# process: 在独立进程中运行，通过共享统计数据库读取数据（需要 STATS_BACKEND=sqlite）
+WEBUI_MODE = os.getenv("WEBUI_MODE", "thread").lower()
+# 仪表板实时推送间隔（秒），所有打开的页面共享同一份快照
+DASHBOARD_PUSH_INTERVAL = float(os.getenv("DASHBOARD_PUSH_INTERVAL", "1"))
+
+# 统计后端
+# memory: 进程内统计（单 worker）; sqlite: 多 worker 共享的 SQLite（WAL）数据库
+STATS_BACKEND = os.getenv("STATS_BACKEND", "memory").lower()
+# 各 worker 向共享存储发布统计增量的间隔（秒）
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "1"))
+
+# 进程内统计的日志压缩间隔（秒），压缩时把追加日志合并进按天的快照文件
+STATS_COMPACT_INTERVAL = float(os.getenv("STATS_COMPACT_INTERVAL", "300"))
 
 # 模型映射文件路径
 MODEL_MAPPING_FILE = os.getenv("MODEL_MAPPING_FILE", "model_mapping.json")
@@ -75,15 +204,98 @@ def get_mapped_model(original_model: str, is_fallback: bool, mapping: dict) -> s
     return model_config.get(target_key, original_model)
 
 
+def _split_list(value: str) -> list:
+    """拆分逗号分隔的配置值"""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def _endpoints_from_env(urls: str, keys: str, weights: str) -> list:
+    """根据逗号分隔的环境变量生成端点列表"""
+    url_list = _split_list(urls)
+    key_list = _split_list(keys)
+    weight_list = _split_list(weights)
+    
+    if len(key_list) > 1 and len(key_list) != len(url_list):
+        raise ValueError(f"上游 Key 数量 ({len(key_list)}) 与地址数量 ({len(url_list)}) 不一致")
+    if weight_list and len(weight_list) != len(url_list):
+        raise ValueError(f"上游权重数量 ({len(weight_list)}) 与地址数量 ({len(url_list)}) 不一致")
+    
+    endpoints = []
+    for index, url in enumerate(url_list):
+        if len(key_list) > 1:
+            key = key_list[index]
+        else:
+            key = key_list[0] if key_list else ""
+        endpoints.append({
+            "url": url,
+            "key": key,
+            "weight": float(weight_list[index]) if weight_list else 1.0
+        })
+    return endpoints
+
+
+def load_upstream_endpoints() -> dict:
+    """
+    加载上游端点配置
+    
+    UPSTREAMS_FILE 存在时从文件读取，格式为
+    {"normal": [{"url": "...", "key": "...", "weight": 1}], "fallback": [...]}；
+    否则从 UPSTREAM_* 环境变量读取
+    
+    Returns:
+        {"normal": [端点配置], "fallback": [端点配置]}
+    """
+    upstreams_path = Path(UPSTREAMS_FILE)
+    if upstreams_path.exists():
+        with open(upstreams_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        logger.info(f"已从 {UPSTREAMS_FILE} 加载上游端点配置")
+        return {
+            tier: [
+                {
+                    "url": item["url"],
+                    "key": item.get("key", ""),
+                    "weight": float(item.get("weight", 1))
+                }
+                for item in data.get(tier, [])
+            ]
+            for tier in ("normal", "fallback")
+        }
+    
+    return {
+        "normal": _endpoints_from_env(UPSTREAM_NORMAL, UPSTREAM_NORMAL_KEY, UPSTREAM_NORMAL_WEIGHTS),
+        "fallback": _endpoints_from_env(UPSTREAM_FALLBACK, UPSTREAM_FALLBACK_KEY, UPSTREAM_FALLBACK_WEIGHTS)
+    }
+
+
 # 验证必要配置
 def validate_config():
     """验证必要的配置项是否已设置"""
     errors = []
     
-    if not UPSTREAM_NORMAL:
-        errors.append("UPSTREAM_NORMAL 未配置")
-    if not UPSTREAM_FALLBACK:
-        errors.append("UPSTREAM_FALLBACK 未配置")
+    try:
+        endpoints = load_upstream_endpoints()
+    except Exception as e:
+        endpoints = {"normal": [], "fallback": []}
+        errors.append(f"上游端点配置错误: {e}")
+    else:
+        if not endpoints["normal"]:
+            errors.append("UPSTREAM_NORMAL 未配置")
+        if not endpoints["fallback"]:
+            errors.append("UPSTREAM_FALLBACK 未配置")
+    
+    if STREAM_COMMIT_MODE not in ("early", "buffered"):
+        errors.append(f"STREAM_COMMIT_MODE 无效: {STREAM_COMMIT_MODE}")
+    if BALANCE_STRATEGY not in ("least_outstanding", "ewma"):
+        errors.append(f"BALANCE_STRATEGY 无效: {BALANCE_STRATEGY}")
+    if STREAM_INCLUDE_USAGE not in ("off", "normal", "fallback", "all"):
+        errors.append(f"STREAM_INCLUDE_USAGE 无效: {STREAM_INCLUDE_USAGE}")
+    if STATS_BACKEND not in ("memory", "sqlite"):
+        errors.append(f"STATS_BACKEND 无效: {STATS_BACKEND}")
+    if WEBUI_MODE not in ("thread", "mount", "process"):
+        errors.append(f"WEBUI_MODE 无效: {WEBUI_MODE}")
+    elif WEBUI_MODE == "process" and STATS_BACKEND != "sqlite":
+        errors.append("WEBUI_MODE=process 需要 STATS_BACKEND=sqlite")
     
     if errors:
         for error in errors:
@@ -91,6 +303,6 @@ def validate_config():
         raise ValueError("配置验证失败: " + ", ".join(errors))
     
     logger.info("配置验证通过")
-    logger.info(f"正常上游: {UPSTREAM_NORMAL}")
-    logger.info(f"备用上游: {UPSTREAM_FALLBACK}")
+    logger.info(f"正常上游: {', '.join(e['url'] for e in endpoints['normal'])}")
+    logger.info(f"备用上游: {', '.join(e['url'] for e in endpoints['fallback'])}")
     logger.info(f"服务端口: {SERVER_PORT}")
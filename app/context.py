@@ -0,0 +1,169 @@
+"""
+请求上下文模块
+记录单次请求的路由结果与时间、流量信息，供统计等模块使用
+"""
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+# 上游类型
+UPSTREAM_NORMAL = "normal"
+UPSTREAM_FALLBACK = "fallback"
+
+
+@dataclass
+class RequestContext:
+    """
+    单次请求的路由上下文
+
+    每个请求独立持有一个实例，并发请求之间互不影响。
+    时间戳均来自 time.monotonic()，只用于计算耗时
+    """
+    model: str = ""
+    stream: bool = False
+    # 最终提供响应的上游
+    upstream: str = UPSTREAM_NORMAL
+    # 回退原因（status: 非 200 状态码, empty: 内容为空, hedge: 对冲请求胜出,
+    # breaker: 断路器打开, affinity: 对话上一轮使用了备用上游），未回退时为 None
+    fallback_reason: Optional[str] = None
+    # 最终返回给客户端的状态码
+    status_code: int = 0
+    # 是否发起了对冲请求
+    hedged: bool = False
+    # 是否为断路器半开状态下的探测请求
+    breaker_probe: bool = False
+    # 是否跳过正常上游直接使用备用上游（对话回退记忆命中）
+    prefer_fallback: bool = False
+    # 最终响应是否为空（非流式请求）
+    empty_response: bool = False
+    # 是否由响应缓存提供
+    cache_hit: bool = False
+    # 是否合并到了进行中的相同请求（没有单独访问上游）
+    coalesced: bool = False
+    started_at: float = field(default_factory=time.monotonic)
+    # 上游响应头到达时间
+    connected_at: Optional[float] = None
+    # 收到上游首个数据块的时间
+    first_byte_at: Optional[float] = None
+    # 收到上游最后一个数据块的时间
+    last_byte_at: Optional[float] = None
+    # 向客户端发出首个数据块的时间
+    first_sent_at: Optional[float] = None
+    # 决定回退的时间
+    fallback_at: Optional[float] = None
+    # 请求处理完成的时间
+    finished_at: Optional[float] = None
+    # 从上游接收的字节数（包括被丢弃的正常上游响应）
+    bytes_in: int = 0
+    # 发送给客户端的字节数
+    bytes_out: int = 0
+    # 各级上游返回的 token 用量：上游 -> (提示 token, 补全 token)
+    usage: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+    # 各处理步骤的耗时（秒），多次尝试累加；步骤含义见 app.histogram.STEPS
+    steps: Dict[str, float] = field(default_factory=dict)
+
+    @classmethod
+    def from_payload(cls, payload) -> 'RequestContext':
+        """根据请求体（ChatPayload）创建上下文"""
+        return cls(model=payload.model, stream=payload.stream)
+
+    @property
+    def is_fallback(self) -> bool:
+        """是否由备用上游提供响应"""
+        return self.upstream == UPSTREAM_FALLBACK
+
+    @property
+    def duration(self) -> float:
+        """请求总耗时（秒）"""
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    def mark_connected(self) -> None:
+        """记录上游响应头到达（只记录第一次）"""
+        if self.connected_at is None:
+            self.connected_at = time.monotonic()
+
+    def mark_received(self, size: int) -> None:
+        """记录从上游收到的数据"""
+        now = time.monotonic()
+        if self.first_byte_at is None:
+            self.first_byte_at = now
+        self.last_byte_at = now
+        self.bytes_in += size
+
+    def record_usage(self, upstream: str, usage) -> None:
+        """记录某一级上游响应中的 usage 字段（缺失或格式不对时忽略）"""
+        if not isinstance(usage, dict):
+            return
+        try:
+            prompt = int(usage.get("prompt_tokens") or 0)
+            completion = int(usage.get("completion_tokens") or 0)
+        except (TypeError, ValueError):
+            return
+        self.usage[upstream] = (prompt, completion)
+
+    def add_step(self, step: str, seconds: float) -> None:
+        """累加某个处理步骤的耗时"""
+        self.steps[step] = self.steps.get(step, 0.0) + seconds
+
+    def mark_sent(self) -> None:
+        """记录向客户端发出数据（只记录第一次）"""
+        if self.first_sent_at is None:
+            self.first_sent_at = time.monotonic()
+
+    def mark_fallback(self, reason: str) -> None:
+        """记录回退到备用上游"""
+        self.upstream = UPSTREAM_FALLBACK
+        self.fallback_reason = reason
+        self.fallback_at = time.monotonic()
+
+    def attempt(self) -> 'RequestContext':
+        """创建对冲中单次上游尝试的上下文，并发的尝试各自记录连接时间、流量和步骤耗时"""
+        return RequestContext(
+            model=self.model,
+            stream=self.stream,
+            breaker_probe=self.breaker_probe,
+            started_at=self.started_at
+        )
+
+    def adopt(self, attempt: 'RequestContext') -> None:
+        """采用胜出尝试记录的连接时间、流量、步骤耗时和用量"""
+        self.connected_at = attempt.connected_at
+        self.first_byte_at = attempt.first_byte_at
+        self.last_byte_at = attempt.last_byte_at
+        if attempt.status_code:
+            self.status_code = attempt.status_code
+        self.discard(attempt)
+        for step, seconds in attempt.steps.items():
+            self.add_step(step, seconds)
+
+    def discard(self, attempt: 'RequestContext') -> None:
+        """合并已完整接收但被丢弃的尝试的流量和用量（被取消的尝试不计入）"""
+        self.bytes_in += attempt.bytes_in
+        self.usage.update(attempt.usage)
+
+    def follow(self, leader: 'RequestContext') -> None:
+        """合并到相同请求时沿用其路由结果"""
+        self.coalesced = True
+        self.upstream = leader.upstream
+        self.fallback_reason = leader.fallback_reason
+        self.status_code = leader.status_code
+        self.empty_response = leader.empty_response
+
+    def finish(self) -> None:
+        """标记请求处理完成"""
+        if self.finished_at is None:
+            self.finished_at = time.monotonic()
+
+    def latencies(self) -> Dict[str, Optional[float]]:
+        """各阶段相对请求开始的耗时（秒），未经历的阶段为 None；阶段含义见 app.histogram.PHASES"""
+        def since_start(at: Optional[float]) -> Optional[float]:
+            return at - self.started_at if at is not None else None
+
+        return {
+            "connect": since_start(self.connected_at),
+            "first_byte": since_start(self.first_byte_at),
+            "first_client_byte": since_start(self.first_sent_at),
+            "total": self.duration,
+            "fallback_delay": since_start(self.fallback_at)
+        }
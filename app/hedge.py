@@ -0,0 +1,128 @@
+"""
+对冲请求模块
+在正常上游迟迟没有结果时提前向备用上游发起请求，并用预算限制额外的上游开销
+"""
+import math
+import time
+from collections import deque
+from typing import Deque, Optional
+
+
+class LatencyWindow:
+    """最近若干次请求的延迟样本，用于估算分位数"""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        """
+        初始化延迟窗口
+
+        Args:
+            size: 保留的样本数量
+            min_samples: 计算分位数所需的最少样本数
+        """
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float) -> None:
+        """记录一次延迟（秒）"""
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        计算分位数
+
+        Args:
+            q: 分位数（0-100）
+
+        Returns:
+            延迟（秒），样本不足时返回 None
+        """
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+
+class HedgeBudget:
+    """
+    对冲预算
+
+    每个请求积累 percent% 个令牌，每次对冲消耗一个令牌，
+    因此长期来看对冲请求数不超过总请求数的 percent%
+    """
+
+    def __init__(self, percent: float, max_tokens: float = 10.0):
+        self.ratio = percent / 100
+        self.max_tokens = max_tokens
+        self._tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.denied = 0
+
+    def on_request(self) -> None:
+        """记录一次请求，积累令牌"""
+        self.requests += 1
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_acquire(self) -> bool:
+        """尝试消耗一个令牌发起对冲"""
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            self.hedges += 1
+            return True
+        self.denied += 1
+        return False
+
+
+class HedgePolicy:
+    """对冲策略：决定何时发起对冲请求"""
+
+    def __init__(self, delay: float, percentile: float, budget: HedgeBudget, min_samples: int = 20):
+        """
+        初始化对冲策略
+
+        Args:
+            delay: 固定对冲延迟（秒），为 0 时使用正常上游延迟的分位数
+            percentile: 自适应延迟使用的分位数
+            budget: 共享的对冲预算
+            min_samples: 自适应延迟所需的最少样本数
+        """
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.budget = budget
+        self.latency = LatencyWindow(min_samples=min_samples)
+
+    def delay(self) -> Optional[float]:
+        """
+        获取本次请求的对冲延迟
+
+        Returns:
+            延迟（秒），样本不足无法估算时返回 None（不对冲）
+        """
+        if self.fixed_delay > 0:
+            return self.fixed_delay
+        return self.latency.percentile(self.percentile)
+
+    def record_latency(self, started_at: float) -> None:
+        """记录正常上游从请求开始到得出结果的耗时"""
+        self.latency.record(time.monotonic() - started_at)
+
+    def record_cancelled(self, started_at: float) -> None:
+        """
+        记录因对冲请求胜出而被取消的正常上游请求
+
+        实际耗时至少为已经过的时间，按此记录（删失样本）；否则分位数只来自快于对冲延迟的响应，
+        会不断偏低，对冲越来越频繁直到只受预算限制
+        """
+        self.record_latency(started_at)
+
+    def snapshot(self) -> dict:
+        """获取策略状态"""
+        delay = self.delay()
+        return {
+            "delay_seconds": round(delay, 3) if delay is not None else None,
+            "samples": len(self.latency),
+        }
@@ -0,0 +1,239 @@
+"""
+延迟直方图模块
+HDR 风格的对数分桶直方图：每个桶的上界按固定比例增长，分位数的相对误差有上限，内存固定
+"""
+import math
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 记录范围（毫秒），超出范围的值计入首尾两个桶
+MIN_VALUE_MS = 1.0
+MAX_VALUE_MS = 600_000.0
+
+# 相邻桶上界之比，分位数相对误差不超过 5%
+GROWTH = 1.05
+_LOG_GROWTH = math.log(GROWTH)
+BUCKET_COUNT = math.ceil(math.log(MAX_VALUE_MS / MIN_VALUE_MS) / _LOG_GROWTH) + 1
+
+# 统计的阶段：
+# connect: 收到上游响应头, first_byte: 收到上游首个数据块, first_client_byte: 向客户端发出首个数据块,
+# total: 请求总耗时, fallback_delay: 回退前在正常上游上耗费的时间（仅回退请求）
+PHASES = ("connect", "first_byte", "first_client_byte", "total", "fallback_delay")
+
+# 请求处理各步骤的耗时（多次尝试，如回退和对冲，累加）：
+# parse: 解析请求体, mapping: 模型映射并编码转发的请求体, pool_wait: 等待上游连接池分配连接,
+# upstream_ttfb: 拿到连接后到上游返回响应头, decision: 从收到响应头到判断出是否需要回退,
+# respond: 输出响应（流式请求为从首个数据块发出到流结束，非流式请求为编码响应体）
+STEPS = ("parse", "mapping", "pool_wait", "upstream_ttfb", "decision", "respond")
+
+# 步骤耗时直方图的记录下限（毫秒），解析、映射等步骤通常远小于 1 毫秒
+STEP_MIN_VALUE_MS = 0.01
+
+# 按模型分组的最大模型数，超出的模型合并为 other（由调用方归并）
+MAX_MODELS = 32
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def bucket_upper(index: int, min_value_ms: float = MIN_VALUE_MS) -> float:
+    """桶的上界（毫秒）"""
+    return min_value_ms * GROWTH ** index
+
+
+class LatencyHistogram:
+    """单个指标的对数分桶直方图，第 i 个桶记录 (上界(i-1), 上界(i)] 内的值"""
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    # 记录下限（毫秒）、桶数和快照保留的小数位数
+    min_value_ms = MIN_VALUE_MS
+    bucket_count = BUCKET_COUNT
+    digits = 1
+
+    def __init__(self):
+        self.counts = array("q", [0]) * self.bucket_count
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value_ms: float) -> None:
+        """记录一个值（毫秒）"""
+        if value_ms <= self.min_value_ms:
+            index = 0
+        else:
+            index = min(math.ceil(math.log(value_ms / self.min_value_ms) / _LOG_GROWTH), self.bucket_count - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value_ms
+        if value_ms > self.max:
+            self.max = value_ms
+
+    def quantile(self, q: float) -> float:
+        """估算分位数（毫秒），返回所在桶的上界，不超过记录到的最大值"""
+        if self.count == 0:
+            return 0.0
+        target = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(bucket_upper(index, self.min_value_ms), self.max)
+        return self.max
+
+    def copy(self) -> 'LatencyHistogram':
+        clone = type(self)()
+        clone.counts = array("q", self.counts)
+        clone.count = self.count
+        clone.sum = self.sum
+        clone.max = self.max
+        return clone
+
+    def cumulative(self, bounds_ms: Sequence[float]) -> List[Tuple[float, int]]:
+        """
+        按给定上界（毫秒，升序）累计计数，用于导出固定分桶的直方图
+
+        细分桶跨越上界时整桶计入下一个上界，误差不超过一个细分桶（5%）
+        """
+        result = []
+        seen = 0
+        index = 0
+        for bound in bounds_ms:
+            while index < self.bucket_count and bucket_upper(index, self.min_value_ms) <= bound * (1 + 1e-9):
+                seen += self.counts[index]
+                index += 1
+            result.append((bound, seen))
+        return result
+
+    def snapshot(self) -> dict:
+        result = {
+            "count": self.count,
+            "mean": round(self.sum / self.count, self.digits) if self.count else 0.0,
+            "max": round(self.max, self.digits)
+        }
+        for q in QUANTILES:
+            result[f"p{round(q * 100)}"] = round(self.quantile(q), self.digits)
+        return result
+
+
+class StepHistogram(LatencyHistogram):
+    """请求处理步骤的耗时直方图：记录下限为 STEP_MIN_VALUE_MS，快照保留 3 位小数"""
+
+    __slots__ = ()
+
+    min_value_ms = STEP_MIN_VALUE_MS
+    bucket_count = math.ceil(math.log(MAX_VALUE_MS / STEP_MIN_VALUE_MS) / _LOG_GROWTH) + 1
+    digits = 3
+
+
+class LatencyStats:
+    """
+    按上游和模型分组的各阶段延迟直方图
+
+    不是线程安全的，由调用方（RequestStats 的聚合器）加锁
+    """
+
+    def __init__(self):
+        self._upstreams: Dict[str, Dict[str, LatencyHistogram]] = {}
+        self._models: Dict[str, Dict[str, LatencyHistogram]] = {}
+
+    @staticmethod
+    def _new_group() -> Dict[str, LatencyHistogram]:
+        return {phase: LatencyHistogram() for phase in PHASES}
+
+    def record(self, upstream: str, model: str, latencies: Dict[str, Optional[float]]) -> None:
+        """
+        记录一次请求各阶段的耗时
+
+        Args:
+            upstream: 最终提供响应的上游
+            model: 模型名称（调用方已限制基数）
+            latencies: 阶段 -> 耗时（秒），未经历的阶段为 None
+        """
+        upstream_group = self._upstreams.get(upstream)
+        if upstream_group is None:
+            upstream_group = self._upstreams[upstream] = self._new_group()
+        model_group = self._models.get(model)
+        if model_group is None:
+            model_group = self._models[model] = self._new_group()
+        for phase, seconds in latencies.items():
+            if seconds is None:
+                continue
+            value_ms = seconds * 1000
+            upstream_group[phase].record(value_ms)
+            model_group[phase].record(value_ms)
+
+    def copy(self) -> Dict[str, Dict[str, Dict[str, LatencyHistogram]]]:
+        """
+        复制全部直方图，调用方可以在锁外读取
+
+        Returns:
+            {"upstream": {上游: {阶段: 直方图}}, "model": {模型: {阶段: 直方图}}}
+        """
+        def clone(groups: Dict[str, Dict[str, LatencyHistogram]]) -> dict:
+            return {
+                key: {phase: histogram.copy() for phase, histogram in group.items() if histogram.count}
+                for key, group in groups.items()
+            }
+
+        return {"upstream": clone(self._upstreams), "model": clone(self._models)}
+
+    def snapshot(self) -> dict:
+        """
+        获取各分组各阶段的分位数
+
+        Returns:
+            {"upstreams": {上游: {阶段: 统计}}, "models": {模型: {阶段: 统计}}}，省略没有样本的阶段
+        """
+        def summarize(groups: Dict[str, Dict[str, LatencyHistogram]]) -> dict:
+            return {
+                key: {
+                    phase: histogram.snapshot()
+                    for phase, histogram in group.items()
+                    if histogram.count
+                }
+                for key, group in sorted(groups.items())
+            }
+
+        return {
+            "upstreams": summarize(self._upstreams),
+            "models": summarize(self._models)
+        }
+
+
+class StepStats:
+    """
+    按最终上游分组的请求处理步骤耗时直方图
+
+    不是线程安全的，由调用方（RequestStats 的聚合器）加锁
+    """
+
+    def __init__(self):
+        self._upstreams: Dict[str, Dict[str, StepHistogram]] = {}
+
+    def record(self, upstream: str, steps: Dict[str, float]) -> None:
+        """
+        记录一次请求各步骤的耗时
+
+        Args:
+            upstream: 最终提供响应的上游
+            steps: 步骤 -> 耗时（秒），只包含经历过的步骤
+        """
+        group = self._upstreams.get(upstream)
+        if group is None:
+            group = self._upstreams[upstream] = {step: StepHistogram() for step in STEPS}
+        for step, seconds in steps.items():
+            group[step].record(seconds * 1000)
+
+    def copy(self) -> Dict[str, Dict[str, StepHistogram]]:
+        """复制全部直方图：{上游: {步骤: 直方图}}，省略没有样本的步骤"""
+        return {
+            upstream: {step: histogram.copy() for step, histogram in group.items() if histogram.count}
+            for upstream, group in self._upstreams.items()
+        }
+
+    def snapshot(self) -> Dict[str, Dict[str, dict]]:
+        """获取各上游各步骤的分位数：{上游: {步骤: 统计}}，省略没有样本的步骤"""
+        return {
+            upstream: {step: histogram.snapshot() for step, histogram in group.items() if histogram.count}
+            for upstream, group in sorted(self._upstreams.items())
+        }
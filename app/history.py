@@ -0,0 +1,185 @@
+"""
+历史统计缓存模块
+已经结束的日期不会再变化：第一次访问时序列化并计算 ETag，之后直接复用字节；
+只有今天（以及刚过零点时的昨天）每次重新计算
+"""
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from app.codec import dumps
+
+# 过零点后多久冻结昨天（秒），留给缓冲区中的事件和其他 worker 的增量写入
+FREEZE_AFTER_SECONDS = 60
+
+# 最多缓存的已冻结日期数
+MAX_FROZEN_DAYS = 400
+
+# 近 N 天统计最多返回的天数
+MAX_RECENT_DAYS = MAX_FROZEN_DAYS
+
+_MISSING = object()
+
+
+class HistoryEntry(NamedTuple):
+    """一份历史数据及其序列化结果"""
+    data: object
+    body: bytes
+    etag: str
+
+
+def make_entry(data: object) -> HistoryEntry:
+    """序列化并计算强 ETag"""
+    body = dumps(data)
+    return HistoryEntry(data, body, _etag(body))
+
+
+def _etag(content: bytes) -> str:
+    return '"' + hashlib.blake2b(content, digest_size=12).hexdigest() + '"'
+
+
+def empty_day(date: str) -> dict:
+    """没有数据的日期"""
+    return {
+        "date": date,
+        "total_requests": 0,
+        "total_normal": 0,
+        "total_fallback": 0,
+        "fallback_rate": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "wasted_tokens": 0,
+        "hourly_stats": {}
+    }
+
+
+def is_valid_date(date: str) -> bool:
+    """是否为 YYYY-MM-DD 格式的合法日期"""
+    if len(date) != 10:
+        return False
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    判断 If-None-Match 是否命中（弱比较）
+
+    Args:
+        if_none_match: 请求头的值
+        etag: 当前响应的 ETag
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class HistoryCache:
+    """
+    按日期缓存的历史统计
+
+    日期列表只在跨天时重新生成；已冻结的日期保存字典、字节和 ETag，
+    近 N 天的响应体由各日期的字节直接拼接，不重新序列化
+    """
+
+    def __init__(self, load_day: Callable[[str], Optional[dict]]):
+        """
+        初始化缓存
+
+        Args:
+            load_day: 读取指定日期统计的函数，没有数据时返回 None
+        """
+        self._load_day = load_day
+        self._lock = threading.Lock()
+        self._frozen: Dict[str, Optional[HistoryEntry]] = {}
+        # 没有数据的日期的零值（与日期是否结束无关）
+        self._empty: Dict[str, HistoryEntry] = {}
+        # 今天零点和明天零点的时间戳
+        self._midnight = 0.0
+        self._next_midnight = 0.0
+        # 从今天开始倒序的日期字符串
+        self._dates: List[str] = []
+
+    def _dates_until(self, days: int, now: float) -> List[str]:
+        """获取从今天开始倒序的 days 个日期（跨天时重新生成）"""
+        with self._lock:
+            if now >= self._next_midnight or now < self._midnight:
+                today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+                self._midnight = today.timestamp()
+                self._next_midnight = (today + timedelta(days=1)).timestamp()
+                self._dates = []
+            if len(self._dates) < days:
+                today = datetime.fromtimestamp(self._midnight)
+                self._dates.extend(
+                    (today - timedelta(days=i)).strftime("%Y-%m-%d")
+                    for i in range(len(self._dates), days)
+                )
+            return self._dates[:days]
+
+    def _is_frozen(self, date: str, now: float) -> bool:
+        """日期是否已经结束且不会再有写入"""
+        dates = self._dates_until(2, now)
+        if date < dates[1]:
+            return True
+        return date == dates[1] and now >= self._midnight + FREEZE_AFTER_SECONDS
+
+    def _remember(self, cache: dict, date: str, entry: Optional[HistoryEntry]) -> None:
+        with self._lock:
+            if len(cache) >= MAX_FROZEN_DAYS:
+                cache.pop(next(iter(cache)))
+            cache[date] = entry
+
+    def _empty_entry(self, date: str) -> HistoryEntry:
+        entry = self._empty.get(date)
+        if entry is None:
+            entry = make_entry(empty_day(date))
+            self._remember(self._empty, date, entry)
+        return entry
+
+    def day(self, date: str, now: Optional[float] = None) -> Optional[HistoryEntry]:
+        """
+        获取指定日期的统计
+
+        Returns:
+            统计数据及其序列化结果，没有数据时返回 None
+        """
+        entry = self._frozen.get(date, _MISSING)
+        if entry is not _MISSING:
+            return entry
+        now = time.time() if now is None else now
+        data = self._load_day(date)
+        entry = make_entry(data) if data is not None else None
+        if self._is_frozen(date, now):
+            self._remember(self._frozen, date, entry)
+        return entry
+
+    def recent(self, days: int) -> HistoryEntry:
+        """
+        获取近 N 天的统计（按日期降序，没有数据的日期返回零值），最多 MAX_RECENT_DAYS 天
+
+        Returns:
+            统计列表及其序列化结果，ETag 由各日期的 ETag 组合而成
+        """
+        now = time.time()
+        entries = []
+        for date in self._dates_until(min(max(days, 0), MAX_RECENT_DAYS), now):
+            entry = self.day(date, now)
+            if entry is None:
+                entry = self._empty_entry(date)
+            entries.append(entry)
+        body = b"[" + b",".join(entry.body for entry in entries) + b"]"
+        etag = _etag("".join(entry.etag for entry in entries).encode())
+        return HistoryEntry([entry.data for entry in entries], body, etag)
@@ -0,0 +1,115 @@
+"""
+仪表板实时推送模块
+每个推送周期只生成一次快照，通过 SSE 广播给所有已连接的仪表板，且只发送发生变化的字段，
+仪表板的开销与打开的页面数量无关
+"""
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Set, Tuple
+
+from app.codec import dumps
+
+logger = logging.getLogger(__name__)
+
+# 每个订阅者最多积压的消息数，超出时丢弃积压的增量，改为发送一次完整快照
+SUBSCRIBER_QUEUE_SIZE = 8
+
+_MISSING = object()
+
+
+def _encode(fields: Dict[str, Any]) -> bytes:
+    """编码为一个 SSE 事件"""
+    return b"data: " + dumps(fields) + b"\n\n"
+
+
+class LiveBroadcaster:
+    """
+    快照广播器
+
+    第一个订阅者连接时启动推送任务，最后一个订阅者断开后停止；
+    数据源在线程中计算，不阻塞事件循环。订阅者连接时先收到完整快照，
+    之后每个周期收到与上一周期相比发生变化的顶层字段，由页面合并到本地状态
+    """
+
+    def __init__(self, sources: List[Tuple[float, Callable[[], Dict[str, Any]]]], interval: float):
+        """
+        初始化广播器
+
+        Args:
+            sources: (刷新间隔秒数, 数据源) 列表，数据源返回顶层字段字典
+            interval: 推送周期（秒）
+        """
+        self.sources = sources
+        self.interval = interval
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._state: Dict[str, Any] = {}
+        self._due = [0.0] * len(sources)
+        self._task = None
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """
+        订阅推送
+
+        Yields:
+            SSE 事件字节，客户端断开时由框架取消
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        if self._state:
+            queue.put_nowait(_encode(self._state))
+        self._subscribers.add(queue)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers.discard(queue)
+
+    async def _run(self) -> None:
+        """推送循环"""
+        loop = asyncio.get_running_loop()
+        while self._subscribers:
+            started = loop.time()
+            try:
+                fields = await asyncio.to_thread(self._collect, started)
+            except Exception as e:
+                logger.error(f"生成仪表板快照失败: {e}")
+            else:
+                self._publish(fields)
+            await asyncio.sleep(max(0.0, self.interval - (loop.time() - started)))
+        # 没有订阅者时丢弃状态，下一个订阅者从新的快照开始
+        self._state = {}
+        self._due = [0.0] * len(self.sources)
+        self._task = None
+
+    def _collect(self, now: float) -> Dict[str, Any]:
+        """调用到期的数据源"""
+        fields = {}
+        for index, (interval, source) in enumerate(self.sources):
+            if now >= self._due[index]:
+                fields.update(source())
+                self._due[index] = now + interval
+        return fields
+
+    def _publish(self, fields: Dict[str, Any]) -> None:
+        """把变化的字段发送给所有订阅者"""
+        changed = {
+            key: value for key, value in fields.items()
+            if self._state.get(key, _MISSING) != value
+        }
+        if not changed:
+            return
+        self._state.update(changed)
+
+        message = _encode(changed)
+        snapshot = None
+        for queue in self._subscribers:
+            if queue.full():
+                # 订阅者跟不上推送：积压的增量已无意义，改为完整快照
+                while not queue.empty():
+                    queue.get_nowait()
+                if snapshot is None:
+                    snapshot = _encode(self._state)
+                queue.put_nowait(snapshot)
+            else:
+                queue.put_nowait(message)
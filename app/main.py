@@ -2,14 +2,32 @@
 FastAPI 主应用
 API 中间件入口
 """
+import asyncio
+import hmac
 import logging
+import os
+import subprocess
+import sys
 import threading
+import time
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from typing import Optional
-from app.config import SERVER_PORT, MIDDLEWARE_API_KEY, validate_config
+from app.config import (
+    SERVER_PORT, MIDDLEWARE_API_KEY, ADMIN_API_KEY, PROFILE_MAX_SECONDS, RAW_PASSTHROUGH,
+    STATS_FLUSH_INTERVAL, WEBUI_MODE, validate_config
+)
+from app.affinity import get_affinity, conversation_keys
+from app.cache import get_response_cache, response_cache_key, completion_to_sse
+from app.coalesce import get_coalescer
+from app.codec import FastJSONResponse
+from app.context import RequestContext, UPSTREAM_FALLBACK
+from app.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render_metrics
+from app.models import get_models_cache
+from app.payload import ChatPayload
+from app.profiler import ProfilerBusyError, get_profiler
 from app.proxy import get_proxy
 from app.stats import get_stats
 
@@ -40,27 +58,105 @@ async def verify_api_key(credentials: Optional[HTTPAuthorizationCredentials] = D
     return credentials.credentials
 
 
+async def verify_admin_key(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    """
+    验证管理端点的 Key
+    未配置 ADMIN_API_KEY 时管理端点不可用（返回 404）；不接受 MIDDLEWARE_API_KEY
+    """
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=404, detail="Not Found")
+    
+    if not credentials or not hmac.compare_digest(credentials.credentials, ADMIN_API_KEY):
+        logger.warning("管理端点 Key 验证失败")
+        raise HTTPException(status_code=401, detail="Invalid admin key")
+    
+    return credentials.credentials
+
+
+# process 模式下由本 worker 启动的 WebUI 进程
+webui_process: Optional[subprocess.Popen] = None
+
+
+def start_webui_if_leader() -> bool:
+    """
+    如果当前 worker 赢得选举，启动 WebUI 仪表板
+    
+    thread 模式在后台线程中运行，process 模式启动独立的 Python 进程，
+    不与代理竞争 GIL 和事件循环
+    
+    Returns:
+        True 如果当前 worker 提供仪表板
+    """
+    global webui_process
+    from app.webui import run_webui, acquire_webui_lock, WEBUI_PORT
+    if not acquire_webui_lock():
+        return False
+    if WEBUI_MODE == "process":
+        webui_process = subprocess.Popen([sys.executable, "-m", "app.webui"])
+        logger.info(f"WebUI 仪表板已在独立进程中启动 (pid {webui_process.pid})，端口 {WEBUI_PORT}")
+    else:
+        webui_thread = threading.Thread(target=run_webui, daemon=True)
+        webui_thread.start()
+        logger.info(f"WebUI 仪表板已启动在端口 {WEBUI_PORT}")
+    return True
+
+
+async def stats_background_loop(is_leader: bool):
+    """
+    后台任务：定期向共享存储发布统计增量；未提供仪表板的 worker 同时尝试接管仪表板
+    """
+    from app.webui import collect_components
+    stats = get_stats()
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            if not is_leader:
+                is_leader = start_webui_if_leader()
+            if stats.shared:
+                # SQLite 写入在线程池中进行，不阻塞事件循环
+                await asyncio.to_thread(stats.publish, collect_components())
+            else:
+                # 合并事件缓冲区在线程池中进行，写入交给后台写入线程
+                await asyncio.to_thread(stats.persist)
+        except Exception as e:
+            logger.warning(f"统计后台任务出错: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     # 启动时验证配置
     validate_config()
+    # 先创建统计器：memory 后端在多 worker 下会拒绝启动
+    stats = get_stats()
     if MIDDLEWARE_API_KEY:
         logger.info("中间件 API Key 验证已启用")
     else:
         logger.warning("中间件 API Key 未配置，所有请求将被放行")
     
-    # 启动 WebUI 仪表板（在后台线程）
-    from app.webui import run_webui, WEBUI_PORT
-    webui_thread = threading.Thread(target=run_webui, daemon=True)
-    webui_thread.start()
-    logger.info(f"WebUI 仪表板已启动在端口 {WEBUI_PORT}")
+    # 启动 WebUI 仪表板；多 worker 部署时只有赢得选举的 worker 提供仪表板
+    # mount 模式下仪表板直接挂载在代理服务上，每个 worker 都提供
+    if WEBUI_MODE == "mount":
+        is_leader = True
+        logger.info(f"WebUI 仪表板已挂载在端口 {SERVER_PORT}")
+        logger.warning("mount 模式下仪表板及其 /api/* 接口不经过 API Key 验证，会随代理端口一起暴露")
+    else:
+        is_leader = start_webui_if_leader()
+        if not is_leader:
+            logger.info("WebUI 仪表板由其他 worker 提供")
+    
+    background_task = asyncio.create_task(stats_background_loop(is_leader))
     
     logger.info("内容审查中间件已启动")
     
     yield
     
     # 关闭时清理资源
+    background_task.cancel()
+    # 发布或持久化剩余的增量
+    await asyncio.to_thread(stats.close)
+    if webui_process is not None:
+        webui_process.terminate()
     proxy = get_proxy()
     await proxy.close()
     logger.info("内容审查中间件已关闭")
@@ -80,17 +176,22 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/metrics")
+async def metrics(_: str = Depends(verify_api_key)):
+    """Prometheus 指标（当前 worker 进程）"""
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/v1/models")
 async def list_models(request: Request, _: str = Depends(verify_api_key)):
-    """获取模型列表（透传上游）"""
-    proxy = get_proxy()
+    """获取模型列表（缓存上游结果，直接返回响应字节）"""
+    headers = {"authorization": request.headers.get("authorization", "")}
+    models = await get_models_cache().get(headers)
     
-    headers = dict(request.headers)
-    response = await proxy.forward_models_request(headers)
-    
-    return JSONResponse(
-        content=response.json(),
-        status_code=response.status_code
+    return Response(
+        content=models.content,
+        status_code=models.status_code,
+        media_type="application/json"
     )
 
 
@@ -100,8 +201,18 @@ async def chat_completions(request: Request, _: str = Depends(verify_api_key)):
     聊天补全接口
     始终先请求正常上游，如果返回为空则回退到备用上游
     """
+    affinity = get_affinity()
+    cache = get_response_cache()
+    coalescer = get_coalescer()
+    
+    # 只读取一次原始请求体；只有需要完整内容的功能启用时才完整解析
+    raw_body = await request.body()
+    parse_started_at = time.perf_counter()
     try:
-        body = await request.json()
+        payload = ChatPayload.from_bytes(
+            raw_body,
+            parse=not RAW_PASSTHROUGH or affinity.enabled or cache.enabled or coalescer.enabled
+        )
     except Exception as e:
         logger.error(f"解析请求体失败: {e}")
         raise HTTPException(status_code=400, detail="Invalid JSON body")
@@ -113,45 +224,116 @@ async def chat_completions(request: Request, _: str = Depends(verify_api_key)):
     headers = {k.lower(): v for k, v in request.headers.items()}
     
     # 判断是否为流式请求
-    is_stream = body.get("stream", False)
+    is_stream = payload.stream
     
     # 获取统计器
     stats = get_stats()
     
+    # 每个请求独立的路由上下文，并发请求之间互不干扰
+    ctx = RequestContext.from_payload(payload)
+    ctx.add_step("parse", time.perf_counter() - parse_started_at)
+    
+    # 对话回退记忆：上一轮回退过的对话直接使用备用上游
+    remember_key = None
+    if affinity.enabled:
+        lookup_key, remember_key = conversation_keys(ctx.model, payload.body.get("messages"))
+        ctx.prefer_fallback = affinity.lookup(lookup_key) == UPSTREAM_FALLBACK
+    
+    def finish_request():
+        """请求结束：记录统计与对话使用的上游"""
+        ctx.finish()
+        if is_stream and ctx.first_sent_at is not None:
+            ctx.add_step("respond", ctx.finished_at - ctx.first_sent_at)
+        stats.record_context(ctx)
+        if remember_key is not None and ctx.status_code == 200:
+            affinity.remember(remember_key, ctx.upstream)
+    
+    # 响应缓存：确定性请求直接返回缓存的最终结果
+    # 端点转发客户端自己的 Key 时按客户端 Key 区分缓存
+    cache_key = response_cache_key(
+        payload.body,
+        headers.get("authorization", "") if proxy.forwards_client_key() else ""
+    ) if cache.enabled else None
+    cached = cache.get(cache_key)
+    if cached is not None:
+        logger.info("命中响应缓存")
+        ctx.cache_hit = True
+        ctx.upstream = cached.upstream
+        ctx.status_code = 200
+        if is_stream:
+            include_usage = bool((payload.body.get("stream_options") or {}).get("include_usage"))
+            content = completion_to_sse(cached.content, include_usage)
+            media_type = "text/event-stream"
+        else:
+            content = cached.content
+            media_type = "application/json"
+        ctx.bytes_out = len(content)
+        finish_request()
+        return Response(content=content, media_type=media_type)
+    
+    # 相同请求合并：请求体相同的并发请求共享一次上游调用
+    coalesce_key = coalescer.key(payload.body, headers) if coalescer.enabled else None
+    
     if is_stream:
         # 流式响应：使用带回退的流式方法
         logger.info("处理流式请求，先尝试正常上游")
         
+        if coalesce_key is not None:
+            chunks = coalescer.stream(
+                coalesce_key, ctx,
+                lambda: proxy.forward_stream_with_fallback(payload, headers, ctx)
+            )
+        else:
+            chunks = proxy.forward_stream_with_fallback(payload, headers, ctx)
+        
         async def stream_with_stats():
             """包装流式响应，记录统计数据"""
-            is_fallback = False
-            async for chunk in proxy.forward_stream_with_fallback(body, headers):
-                # 检测是否发生了回退（通过日志或标记）
-                yield chunk
-            # 流结束后记录统计（通过 proxy 的回退标记）
-            stats.record_request(proxy.last_stream_was_fallback)
+            try:
+                async for chunk in chunks:
+                    ctx.mark_sent()
+                    ctx.bytes_out += len(chunk)
+                    yield chunk
+            finally:
+                # 流结束（或客户端断开）后根据上下文记录统计
+                finish_request()
         
         return StreamingResponse(
             stream_with_stats(),
             media_type="text/event-stream"
         )
     else:
-        # 非流式响应：先请求正常上游
+        # 非流式响应：先请求正常上游，为空时由代理回退到备用上游
         logger.info("处理非流式请求，先尝试正常上游")
-        response, response_json, is_empty = await proxy.forward_request(body, False, headers)
+        if coalesce_key is not None:
+            response, response_json = await coalescer.run(
+                coalesce_key, ctx,
+                lambda: proxy.forward_request_with_fallback(payload, headers, ctx)
+            )
+        else:
+            response, response_json = await proxy.forward_request_with_fallback(payload, headers, ctx)
         
-        if is_empty:
-            # 正常上游返回为空，回退到备用上游
-            logger.warning("正常上游响应为空，回退到备用上游")
-            response, response_json, _ = await proxy.forward_request(body, True, headers)
-            stats.record_request(is_fallback=True)
+        respond_started_at = time.perf_counter()
+        if RAW_PASSTHROUGH and response.headers.get("content-type", "").startswith("application/json"):
+            # 上游响应体原样返回，不再重新编码
+            final_response = Response(
+                content=response.content,
+                status_code=response.status_code,
+                media_type="application/json"
+            )
         else:
-            stats.record_request(is_fallback=False)
+            final_response = FastJSONResponse(
+                content=response_json,
+                status_code=response.status_code
+            )
+        ctx.bytes_out = len(final_response.body)
+        ctx.add_step("respond", time.perf_counter() - respond_started_at)
+        ctx.mark_sent()
+        finish_request()
         
-        return JSONResponse(
-            content=response_json,
-            status_code=response.status_code
-        )
+        if cache_key is not None and not ctx.coalesced and ctx.status_code == 200 and not ctx.empty_response:
+            cache.put(cache_key, final_response.body, ctx.upstream)
+        
+        return final_response
 
 
 @app.post("/reload")
@@ -161,11 +343,48 @@ async def reload_config(_: str = Depends(verify_api_key)):
     """
     proxy = get_proxy()
     proxy.reload_model_mapping()
+    # 模型列表可能包含映射中的模型名称
+    get_models_cache().clear()
     
     logger.info("配置已手动重新加载")
     return {"status": "reloaded"}
 
 
+@app.get("/debug/profile")
+async def profile(seconds: float = 10, interval_ms: float = 10, _: str = Depends(verify_admin_key)):
+    """
+    采样分析当前 worker 进程，返回折叠栈格式的火焰图数据
+    """
+    if PROFILE_MAX_SECONDS <= 0:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}]")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be in [1, 1000]")
+    
+    # 采样在线程中进行，事件循环照常处理请求（也会被采样到）
+    try:
+        content, rounds = await asyncio.to_thread(get_profiler().profile, seconds, interval_ms / 1000)
+    except ProfilerBusyError:
+        raise HTTPException(status_code=409, detail="Profiling already in progress")
+    
+    filename = f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded"
+    return Response(
+        content=content,
+        media_type="text/plain; charset=utf-8",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Profile-Samples": str(rounds)
+        }
+    )
+
+
+
+if WEBUI_MODE == "mount":
+    # 仪表板挂载在根路径，上面定义的 API 路由优先匹配
+    from app.webui import app as webui_app
+    app.mount("/", webui_app)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
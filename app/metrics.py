@@ -0,0 +1,198 @@
+"""
+Prometheus 指标模块
+把统计器、连接池和端点的计数渲染为 Prometheus 文本格式（0.0.4）
+
+渲染时只复制统计器的计数和直方图（持有统计锁的时间很短），连接池和端点的计数不加锁读取，
+不会阻塞请求路径
+"""
+from typing import Dict, Iterable, List, Tuple
+
+from app.histogram import LatencyHistogram
+from app.models import get_models_cache
+from app.proxy import get_proxy
+from app.stats import get_stats
+
+# Prometheus 文本格式的 Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+PREFIX = "content_filter"
+
+# 导出的延迟直方图上界（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# 导出的处理步骤耗时直方图上界（秒），解析、映射等步骤需要亚毫秒的分辨率
+STEP_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class _Writer:
+    """逐行拼接指标文本"""
+
+    def __init__(self):
+        self.lines: List[str] = []
+
+    def family(self, name: str, metric_type: str, help_text: str) -> str:
+        name = f"{PREFIX}_{name}"
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+        return name
+
+    def sample(self, name: str, value: float, labels: Dict[str, str] = None) -> None:
+        self.lines.append(f"{name}{_labels(labels or {})} {_format_value(value)}")
+
+    def metric(
+        self,
+        name: str,
+        metric_type: str,
+        help_text: str,
+        samples: Iterable[Tuple[Dict[str, str], float]]
+    ) -> None:
+        """输出一个指标族及其全部样本"""
+        name = self.family(name, metric_type, help_text)
+        for labels, value in samples:
+            self.sample(name, value, labels)
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        histograms: Iterable[Tuple[Dict[str, str], LatencyHistogram]],
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        """输出直方图（毫秒直方图按秒导出）"""
+        name = self.family(name, "histogram", help_text)
+        bounds_ms = [bound * 1000 for bound in buckets]
+        for labels, histogram in histograms:
+            for (_, count), bound in zip(histogram.cumulative(bounds_ms), buckets):
+                self.sample(f"{name}_bucket", count, {**labels, "le": _format_value(float(bound))})
+            self.sample(f"{name}_bucket", histogram.count, {**labels, "le": "+Inf"})
+            self.sample(f"{name}_sum", histogram.sum / 1000, labels)
+            self.sample(f"{name}_count", histogram.count, labels)
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def render_metrics() -> str:
+    """渲染当前进程的全部指标"""
+    stats = get_stats().metrics_snapshot()
+    proxy = get_proxy().metrics_snapshot()
+    out = _Writer()
+
+    out.metric(
+        "requests_total", "counter", "按最终上游、模型和回退原因统计的请求数",
+        (
+            ({"upstream": upstream, "model": model, "fallback_reason": reason}, count)
+            for (upstream, model, reason), count in sorted(stats["requests"].items())
+        )
+    )
+    tokens = sorted(stats["tokens"].items())
+    out.metric(
+        "tokens_total", "counter", "按生成响应的上游和模型统计的 token 数（discarded 表示被丢弃的正常上游响应）",
+        (
+            ({"upstream": upstream, "model": model, "type": token_type, "discarded": discarded}, value)
+            for (upstream, model), counts in tokens
+            for token_type, discarded, value in (
+                ("prompt", "false", counts[0]),
+                ("completion", "false", counts[1]),
+                ("prompt", "true", counts[2]),
+                ("completion", "true", counts[3])
+            )
+        )
+    )
+    out.metric(
+        "generation_seconds_total", "counter", "最终响应从首个数据块到结束的总耗时（秒），与补全 token 数相除得到生成速度",
+        (({"upstream": upstream, "model": model}, counts[4]) for (upstream, model), counts in tokens)
+    )
+    out.metric(
+        "models_cache_requests_total", "counter", "模型列表请求按缓存结果（hit/stale/miss）统计",
+        (({"result": result}, count) for result, count in get_models_cache().counters().items())
+    )
+    out.metric("hedged_requests_total", "counter", "发起了对冲请求的请求数", [({}, stats["hedged"])])
+    out.metric("cached_requests_total", "counter", "由响应缓存提供的请求数", [({}, stats["cached"])])
+    out.metric(
+        "coalesced_requests_total", "counter", "合并到进行中的相同请求的请求数（节省的上游调用数）",
+        [({}, stats["coalesced"])]
+    )
+    out.metric("upstream_received_bytes_total", "counter", "从上游接收的字节数", [({}, stats["bytes_in"])])
+    out.metric("client_sent_bytes_total", "counter", "发送给客户端的字节数", [({}, stats["bytes_out"])])
+
+    out.metric(
+        "endpoint_in_flight_requests", "gauge", "各上游端点进行中的请求数",
+        (
+            ({"tier": tier, "endpoint": url}, outstanding)
+            for tier, endpoints in proxy["endpoints"].items()
+            for url, outstanding in endpoints
+        )
+    )
+    pools = proxy["pools"]
+    out.metric(
+        "pool_waiting_requests", "gauge", "正在等待连接的请求数",
+        (({"pool": pool["name"]}, pool["waiting"]) for pool in pools)
+    )
+    out.metric(
+        "pool_requests_total", "counter", "经过连接池的请求数",
+        (({"pool": pool["name"]}, pool["requests"]) for pool in pools)
+    )
+    out.metric(
+        "pool_timeouts_total", "counter", "等待连接超时的请求数",
+        (({"pool": pool["name"]}, pool["pool_timeouts"]) for pool in pools)
+    )
+    out.metric(
+        "pool_wait_seconds_total", "counter", "等待连接的总时间（秒）",
+        (({"pool": pool["name"]}, pool["wait_seconds_total"]) for pool in pools)
+    )
+
+    latency = stats["latency"]
+    out.histogram(
+        "upstream_latency_seconds", "按最终上游统计的各阶段耗时（秒）",
+        (
+            ({"upstream": upstream, "phase": phase}, histogram)
+            for upstream, phases in sorted(latency["upstream"].items())
+            for phase, histogram in phases.items()
+        )
+    )
+    out.histogram(
+        "model_latency_seconds", "按模型统计的各阶段耗时（秒）",
+        (
+            ({"model": model, "phase": phase}, histogram)
+            for model, phases in sorted(latency["model"].items())
+            for phase, histogram in phases.items()
+        )
+    )
+    out.histogram(
+        "request_step_seconds", "按最终上游统计的请求处理各步骤耗时（秒）",
+        (
+            ({"upstream": upstream, "step": step}, histogram)
+            for upstream, steps in sorted(stats["steps"].items())
+            for step, histogram in steps.items()
+        ),
+        STEP_BUCKETS
+    )
+
+    timings = sorted(stats["persist_timings"].items())
+    out.metric(
+        "stats_persist_operations_total", "counter", "统计持久化操作次数",
+        (({"operation": operation}, count) for operation, (count, _) in timings)
+    )
+    out.metric(
+        "stats_persist_seconds_total", "counter", "统计持久化操作总耗时（秒）",
+        (({"operation": operation}, seconds) for operation, (_, seconds) in timings)
+    )
+
+    return out.render()
@@ -0,0 +1,209 @@
+"""
+模型列表缓存模块
+缓存 /v1/models 的响应字节：有效期内直接返回；过期后在宽限期内先返回旧列表并在后台刷新；
+同一缓存键同一时间只有一个刷新请求发往上游，避免大量客户端同时启动时压垮上游
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from app.codec import dumps, loads
+from app.config import MODELS_CACHE_TTL, MODELS_INCLUDE_ALIASES, MODELS_MERGE_UPSTREAMS, MODELS_STALE_TTL
+from app.proxy import get_proxy
+
+logger = logging.getLogger(__name__)
+
+# 最多缓存的模型列表数（端点使用客户端 Key 时按 Key 分别缓存）
+MAX_SCOPES = 64
+
+
+class ModelList(NamedTuple):
+    """一次模型列表请求的结果"""
+    status_code: int
+    content: bytes
+    fetched_at: float
+
+
+def _merge_model_lists(bodies: List[dict], aliases: List[str]) -> dict:
+    """按模型 ID 去重合并多个模型列表，并补充映射中的模型名称"""
+    merged = dict(bodies[0])
+    seen = set()
+    models = []
+    for body in bodies:
+        for model in body.get("data") or []:
+            model_id = model.get("id") if isinstance(model, dict) else None
+            if model_id is None or model_id in seen:
+                continue
+            seen.add(model_id)
+            models.append(model)
+    for alias in aliases:
+        if alias not in seen:
+            seen.add(alias)
+            models.append({"id": alias, "object": "model", "created": 0, "owned_by": "model_mapping"})
+    merged["object"] = "list"
+    merged["data"] = models
+    return merged
+
+
+async def fetch_model_list(headers: dict) -> ModelList:
+    """
+    向上游请求模型列表
+
+    Args:
+        headers: 客户端请求头（端点未配置 Key 时使用其中的 Authorization）
+
+    Returns:
+        状态码和响应体；需要合并或补充映射时重新序列化，否则为上游的原始字节
+    """
+    proxy = get_proxy()
+    if MODELS_MERGE_UPSTREAMS:
+        results = await asyncio.gather(
+            proxy.forward_models_request(headers),
+            proxy.forward_models_request(headers, use_fallback=True),
+            return_exceptions=True
+        )
+    else:
+        results = [await proxy.forward_models_request(headers)]
+    now = time.time()
+
+    bodies = []
+    for result in results:
+        if isinstance(result, BaseException) or result.status_code != 200:
+            continue
+        try:
+            body = loads(result.content) if MODELS_MERGE_UPSTREAMS or MODELS_INCLUDE_ALIASES else None
+        except ValueError as e:
+            logger.warning(f"模型列表解析失败: {e}")
+            continue
+        if body is None:
+            return ModelList(200, result.content, now)
+        if isinstance(body, dict):
+            bodies.append(body)
+
+    if not bodies:
+        # 没有可用的列表：返回正常上游的结果（包括错误）
+        first = results[0]
+        if isinstance(first, BaseException):
+            raise first
+        return ModelList(first.status_code, first.content, now)
+
+    aliases = list(proxy.model_mapping) if MODELS_INCLUDE_ALIASES else []
+    return ModelList(200, dumps(_merge_model_lists(bodies, aliases)), now)
+
+
+class ModelListCache:
+    """
+    模型列表缓存（单个事件循环内使用）
+
+    端点都配置了 Key 时所有客户端共享一份列表；否则上游看到的是客户端自己的 Key，
+    按 Key 的哈希分别缓存
+    """
+
+    def __init__(self, ttl: float = MODELS_CACHE_TTL, stale_ttl: float = MODELS_STALE_TTL):
+        """
+        初始化缓存
+
+        Args:
+            ttl: 有效期（秒），0 表示不缓存
+            stale_ttl: 过期后仍可返回旧列表的时长（秒）
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries: Dict[str, ModelList] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _scope(self, headers: dict) -> str:
+        """缓存键：所有端点都有自己的 Key 时为空，否则为客户端 Key 的哈希"""
+        if not get_proxy().forwards_client_key(include_fallback=MODELS_MERGE_UPSTREAMS):
+            return ""
+        authorization = headers.get("authorization", "")
+        return hashlib.blake2b(authorization.encode("utf-8"), digest_size=16).hexdigest()
+
+    async def get(self, headers: dict) -> ModelList:
+        """
+        获取模型列表
+
+        Args:
+            headers: 客户端请求头
+
+        Returns:
+            缓存或上游的模型列表
+        """
+        if not self.enabled:
+            return await fetch_model_list(headers)
+
+        scope = self._scope(headers)
+        entry = self._entries.get(scope)
+        if entry is not None:
+            age = time.time() - entry.fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return entry
+            if age < self.ttl + self.stale_ttl:
+                # 先返回旧列表，由后台任务刷新
+                self.stale_hits += 1
+                self._refresh(scope, headers)
+                return entry
+
+        self.misses += 1
+        # 客户端断开时不取消共享的刷新任务
+        return await asyncio.shield(self._refresh(scope, headers))
+
+    def _refresh(self, scope: str, headers: dict) -> asyncio.Task:
+        """启动刷新任务；已有刷新进行中时复用"""
+        task = self._refreshing.get(scope)
+        if task is None:
+            task = asyncio.create_task(self._fetch(scope, headers))
+            task.add_done_callback(_consume_exception)
+            self._refreshing[scope] = task
+        return task
+
+    async def _fetch(self, scope: str, headers: dict) -> ModelList:
+        try:
+            result = await fetch_model_list(headers)
+        except Exception as e:
+            logger.warning(f"刷新模型列表失败: {e}")
+            raise
+        finally:
+            self._refreshing.pop(scope, None)
+
+        if result.status_code == 200:
+            self._entries.pop(scope, None)
+            if len(self._entries) >= MAX_SCOPES:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[scope] = result
+        return result
+
+    def clear(self) -> None:
+        """清空缓存（模型映射重新加载后调用）"""
+        self._entries.clear()
+
+    def counters(self) -> dict:
+        return {"hit": self.hits, "stale": self.stale_hits, "miss": self.misses}
+
+
+def _consume_exception(task: asyncio.Task) -> None:
+    """后台刷新的异常已记录日志，这里只标记为已读取"""
+    if not task.cancelled():
+        task.exception()
+
+
+# 全局模型列表缓存实例
+_models_cache_instance: Optional[ModelListCache] = None
+
+
+def get_models_cache() -> ModelListCache:
+    """获取模型列表缓存单例实例"""
+    global _models_cache_instance
+    if _models_cache_instance is None:
+        _models_cache_instance = ModelListCache()
+    return _models_cache_instance
@@ -0,0 +1,220 @@
+"""
+请求体模块
+保留客户端发送的原始请求体字节，转发时只替换模型名称，避免重复解析和序列化
+"""
+import re
+from typing import Optional, Tuple
+
+from app.codec import dumps, loads
+
+# 快速扫描用的词法单元：完整的 JSON 字符串或容器括号（字符串内部的引号必然被转义，括号不会被误判）
+_TOKEN_PATTERN = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+_COLON_PATTERN = re.compile(rb'\s*:\s*')
+_STRING_PATTERN = re.compile(rb'"((?:[^"\\]|\\.)*)"')
+_BOOL_PATTERN = re.compile(rb'true|false')
+
+
+class _Fields:
+    """快速扫描得到的顶层字段"""
+
+    __slots__ = ("model_span", "stream", "include_usage")
+
+    def __init__(self):
+        # 顶层 model 字符串内容在原始字节中的位置
+        self.model_span: Optional[Tuple[int, int]] = None
+        self.stream: Optional[bool] = None
+        # 顶层 stream_options 对象中的 include_usage 是否为 true
+        self.include_usage = False
+
+
+def _scan_fields(raw: bytes) -> Optional[_Fields]:
+    """
+    按对象层级扫描原始字节，只接受位于顶层对象的 model、stream 和 stream_options.include_usage
+
+    Returns:
+        扫描结果；结构无法确定（括号不平衡、重复字段、键名含转义等）时返回 None
+    """
+    start = raw.find(b"{")
+    if start < 0:
+        return None
+
+    fields = _Fields()
+    # 容器栈：(括号, 所属的键)，栈深度为 1 表示位于顶层对象内
+    stack = []
+    key = None
+    closed = False
+    for token in _TOKEN_PATTERN.finditer(raw, start):
+        if closed:
+            # 顶层对象之后还有其他内容
+            return None
+        text = token.group()
+        char = text[:1]
+        if char == b'"':
+            colon = _COLON_PATTERN.match(raw, token.end()) if stack[-1][0] == b"{" else None
+            if colon is None:
+                # 字符串值
+                key = None
+                continue
+            key = text
+            value_at = colon.end()
+            if len(stack) == 1:
+                if b"\\" in key:
+                    return None
+                if key == b'"model"':
+                    value = _STRING_PATTERN.match(raw, value_at)
+                    if value is None or fields.model_span is not None:
+                        return None
+                    fields.model_span = value.span(1)
+                elif key == b'"stream"':
+                    value = _BOOL_PATTERN.match(raw, value_at)
+                    if value is None or fields.stream is not None:
+                        return None
+                    fields.stream = value.group() == b"true"
+            elif len(stack) == 2 and key == b'"include_usage"' and stack[1][1] == b'"stream_options"':
+                fields.include_usage = raw.startswith(b"true", value_at)
+        elif char in b"{[":
+            stack.append((char, key))
+            key = None
+        else:
+            if not stack or stack.pop()[0] != (b"{" if char == b"}" else b"["):
+                return None
+            key = None
+            closed = not stack
+    if not closed:
+        return None
+    return fields
+
+
+class ChatPayload:
+    """
+    聊天请求体
+
+    快速路径只按层级扫描顶层的 model 和 stream，完整 JSON 在第一次访问 body 时才解析；
+    转发时把映射后的模型名称直接拼接进原始字节
+    """
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.model = ""
+        self.stream = False
+        self._body: Optional[dict] = None
+        # 原始字节中 model 字符串内容的位置
+        self._model_span: Optional[Tuple[int, int]] = None
+        self._include_usage: Optional[bool] = None
+
+    @classmethod
+    def from_bytes(cls, raw: bytes, parse: bool = False) -> 'ChatPayload':
+        """
+        从原始字节创建请求体
+
+        Args:
+            raw: 客户端发送的请求体
+            parse: 是否立即完整解析（同时校验 JSON 格式）
+
+        Returns:
+            请求体对象
+
+        Raises:
+            ValueError: 需要完整解析且请求体不是合法的 JSON 对象
+        """
+        payload = cls(raw)
+        if parse or not payload._scan():
+            payload._parse()
+        return payload
+
+    @property
+    def body(self) -> dict:
+        """完整解析后的请求体（惰性解析）"""
+        if self._body is None:
+            self._parse()
+        return self._body
+
+    def _scan(self) -> bool:
+        """
+        快速提取 model 和 stream
+
+        Returns:
+            True 如果顶层字段可以无歧义地确定
+        """
+        if not self.raw.lstrip().startswith(b"{"):
+            return False
+
+        fields = _scan_fields(self.raw)
+        if fields is None or fields.model_span is None:
+            return False
+
+        start, end = fields.model_span
+        try:
+            self.model = loads(b'"' + self.raw[start:end] + b'"')
+        except ValueError:
+            return False
+        self._model_span = fields.model_span
+        self.stream = bool(fields.stream)
+        self._include_usage = fields.include_usage
+        return True
+
+    def _parse(self) -> None:
+        """完整解析请求体"""
+        body = loads(self.raw)
+        if not isinstance(body, dict):
+            raise ValueError("请求体必须是 JSON 对象")
+        self._body = body
+        self.model = body.get("model", "")
+        self.stream = bool(body.get("stream", False))
+
+        stream_options = body.get("stream_options")
+        self._include_usage = isinstance(stream_options, dict) and stream_options.get("include_usage") is True
+
+        if self._model_span is None:
+            fields = _scan_fields(self.raw)
+            if fields is not None and fields.model_span is not None:
+                start, end = fields.model_span
+                try:
+                    if loads(b'"' + self.raw[start:end] + b'"') == self.model:
+                        self._model_span = fields.model_span
+                except ValueError:
+                    pass
+
+    @property
+    def include_usage(self) -> bool:
+        """客户端是否请求了流式 usage（stream_options.include_usage）"""
+        if self._include_usage is None:
+            self._parse()
+        return self._include_usage
+
+    def encode(self, model: str, include_usage: bool = False) -> bytes:
+        """
+        生成转发给上游的请求体
+
+        Args:
+            model: 映射后的模型名称
+            include_usage: 是否补充 stream_options.include_usage
+
+        Returns:
+            请求体字节；无需修改时直接返回原始字节
+        """
+        if include_usage and not self.include_usage:
+            if b'"stream_options"' in self.raw:
+                # 客户端已有 stream_options，合并后重新序列化
+                body = dict(self.body)
+                body["model"] = model
+                body["stream_options"] = {**(body.get("stream_options") or {}), "include_usage": True}
+                return dumps(body)
+            # 在对象开头插入字段，其余字节不变
+            content = self._encode_model(model)
+            start = content.index(b"{") + 1
+            return content[:start] + b'"stream_options":{"include_usage":true},' + content[start:]
+        return self._encode_model(model)
+
+    def _encode_model(self, model: str) -> bytes:
+        """替换模型名称"""
+        if model == self.model:
+            return self.raw
+        if self._model_span is not None:
+            start, end = self._model_span
+            escaped = dumps(model)[1:-1]
+            return self.raw[:start] + escaped + self.raw[end:]
+        # 无法定位模型字段时退回到重新序列化
+        body = dict(self.body)
+        body["model"] = model
+        return dumps(body)
@@ -0,0 +1,239 @@
+"""
+统计持久化模块
+后台线程把小时统计增量追加写入日志文件，定期压缩为按天存放的快照文件；
+快照通过临时文件加重命名原子替换，历史数据按需加载
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from app.codec import dumps, dumps_pretty, loads
+from app.stats_store import HOUR_FIELDS
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 小时增量：(日期, 小时) -> 按 HOUR_FIELDS 排列的计数
+HourDeltas = Dict[Tuple[str, str], List[int]]
+
+# 写入线程的结束标记
+_STOP = object()
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    """写入临时文件后原子替换目标文件，写入中途崩溃不会损坏原文件"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class StatsWriter:
+    """
+    统计数据后台写入器
+
+    事件循环只负责把批量增量放入队列；写入线程把每批增量作为一行追加到日志，
+    每隔 compact_interval 秒把日志合并进按天的快照文件并清空日志。
+    每个快照记录已合并的最大日志序号，合并过程中崩溃后重放日志不会重复计数
+    """
+
+    def __init__(self, data_dir: str, compact_interval: float = 300, retention_days: int = 30):
+        """
+        初始化写入器并合并上次运行遗留的日志
+
+        Args:
+            data_dir: 数据目录
+            compact_interval: 日志压缩间隔（秒）
+            retention_days: 快照保留天数
+
+        Raises:
+            RuntimeError: 另一个进程已经在使用同一数据目录的写入器
+        """
+        self.history_dir = os.path.join(data_dir, "history")
+        self.log_file = os.path.join(data_dir, "stats_log.jsonl")
+        self.compact_interval = compact_interval
+        self.retention_days = retention_days
+        os.makedirs(self.history_dir, exist_ok=True)
+        self._lock_handle = self._acquire_lock(os.path.join(data_dir, "stats_writer.lock"))
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._last_seq = 0
+        # 操作 -> [次数, 总耗时（秒）]，只由写入线程更新
+        self._timings: Dict[str, List[float]] = {"append": [0, 0.0], "compact": [0, 0.0]}
+        self.compact()
+        self._log = open(self.log_file, "ab")
+        self._last_compact = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="stats-writer", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _acquire_lock(path: str):
+        """
+        独占数据目录：各进程的快照只包含自己的计数，多个写入器压缩同一份日志会互相覆盖、丢失数据
+
+        使用非阻塞的 flock 排他锁，进程退出后由操作系统自动释放
+        """
+        if fcntl is None:
+            return None
+        handle = open(path, "a")
+        try:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            raise RuntimeError(
+                "统计数据目录已被其他进程使用：memory 统计后端只支持单个 worker，"
+                "多 worker 部署请设置 STATS_BACKEND=sqlite"
+            )
+        return handle
+
+    def submit(self, hours: HourDeltas) -> None:
+        """提交一批小时增量（不阻塞）"""
+        if hours:
+            self._queue.put(hours)
+
+    def close(self) -> None:
+        """写入剩余数据、压缩日志并停止写入线程"""
+        self._queue.put(_STOP)
+        self._thread.join(timeout=10)
+
+    def timings(self) -> Dict[str, Tuple[int, float]]:
+        """获取追加日志和压缩的次数与总耗时（秒）"""
+        return {operation: tuple(timing) for operation, timing in self._timings.items()}
+
+    def _timed(self, operation: str, func, *args) -> None:
+        start = time.perf_counter()
+        func(*args)
+        timing = self._timings[operation]
+        timing[0] += 1
+        timing[1] += time.perf_counter() - start
+
+    def _next_seq(self) -> int:
+        # 纳秒时间戳保证跨重启递增
+        self._last_seq = max(self._last_seq + 1, time.time_ns())
+        return self._last_seq
+
+    def _run(self) -> None:
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                item = None
+
+            try:
+                if item is _STOP:
+                    self._log.close()
+                    self._timed("compact", self.compact)
+                    return
+                if item is not None:
+                    self._timed("append", self._append, item)
+                if time.monotonic() - self._last_compact >= self.compact_interval:
+                    self._log.close()
+                    self._timed("compact", self.compact)
+                    self._log = open(self.log_file, "ab")
+                    self._last_compact = time.monotonic()
+            except Exception as e:
+                logger.warning(f"写入统计数据失败: {e}")
+
+    def _append(self, hours: HourDeltas) -> None:
+        """把一批增量追加到日志"""
+        line = dumps({
+            "seq": self._next_seq(),
+            "hours": [[date, hour, *counts] for (date, hour), counts in hours.items()]
+        })
+        self._log.write(line + b"\n")
+        self._log.flush()
+
+    def _day_path(self, date: str) -> str:
+        return os.path.join(self.history_dir, f"{date}.json")
+
+    def load_day(self, date: str) -> Optional[dict]:
+        """
+        读取指定日期的快照
+
+        Returns:
+            DailyStats.to_dict() 格式的数据（附带已合并的日志序号 seq），不存在时返回 None
+        """
+        path = self._day_path(date)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return loads(f.read())
+
+    def write_day(self, data: dict) -> None:
+        """原子写入一天的快照"""
+        atomic_write(self._day_path(data["date"]), dumps_pretty(data))
+
+    def compact(self) -> None:
+        """把日志中的增量合并进按天的快照，然后清空日志并清理过期快照"""
+        per_day: Dict[str, List[Tuple[int, str, List[int]]]] = {}
+        if os.path.exists(self.log_file):
+            with open(self.log_file, "rb") as f:
+                for line in f:
+                    try:
+                        entry = loads(line)
+                    except ValueError:
+                        # 崩溃时写了一半的行
+                        continue
+                    seq = entry["seq"]
+                    self._last_seq = max(self._last_seq, seq)
+                    # 旧版日志每行只有正常数和回退数
+                    for date, hour, *counts in entry["hours"]:
+                        per_day.setdefault(date, []).append((seq, hour, counts))
+
+        for date, items in per_day.items():
+            data = self.load_day(date) or {"date": date, "hourly_stats": {}}
+            applied_seq = data.get("seq", 0)
+            hourly = data.setdefault("hourly_stats", {})
+            max_seq = applied_seq
+            for seq, hour, counts in items:
+                if seq <= applied_seq:
+                    continue
+                max_seq = max(max_seq, seq)
+                hour_stats = hourly.setdefault(hour, {"total": 0})
+                for name, value in zip(HOUR_FIELDS, counts):
+                    hour_stats[name] = hour_stats.get(name, 0) + value
+                hour_stats["total"] = hour_stats["normal"] + hour_stats["fallback"]
+            data["seq"] = max_seq
+            data["total_normal"] = sum(h["normal"] for h in hourly.values())
+            data["total_fallback"] = sum(h["fallback"] for h in hourly.values())
+            data["total_requests"] = data["total_normal"] + data["total_fallback"]
+            for name in HOUR_FIELDS[2:]:
+                data[name] = sum(h.get(name, 0) for h in hourly.values())
+            self.write_day(data)
+
+        # 所有快照都已落盘后才清空日志
+        with open(self.log_file, "wb"):
+            pass
+
+        cutoff = (datetime.now() - timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+        for name in os.listdir(self.history_dir):
+            if name.endswith(".json") and name[:-5] < cutoff:
+                os.remove(os.path.join(self.history_dir, name))
+
+        if per_day:
+            logger.debug(f"统计日志已压缩，涉及 {len(per_day)} 天")
+
+    def migrate_legacy(self, stats_file: str) -> None:
+        """把旧版单文件 stats_data.json 拆分为按天的快照（只执行一次）"""
+        if not os.path.exists(stats_file):
+            return
+        try:
+            with open(stats_file, "rb") as f:
+                data = loads(f.read())
+            for date, daily in data.get("daily_stats", {}).items():
+                if self.load_day(date) is None:
+                    self.write_day(daily)
+            os.replace(stats_file, f"{stats_file}.migrated")
+            logger.info(f"已迁移旧版统计数据，共 {len(data.get('daily_stats', {}))} 天")
+        except Exception as e:
+            logger.warning(f"迁移旧版统计数据失败: {e}")
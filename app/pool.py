@@ -0,0 +1,180 @@
+"""
+连接池模块
+每个上游使用独立的 HTTP 客户端和连接池，并统计连接池占用和等待时间
+"""
+import logging
+import threading
+import time
+
+import httpx
+
+from app.hedge import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover - 可选依赖
+    HTTP2_AVAILABLE = False
+
+# 表示请求已经拿到连接的 httpcore 跟踪事件（新建连接或复用已有连接）
+_ACQUIRED_EVENTS = (
+    "connection.connect_tcp.started",
+    "http11.send_request_headers.started",
+    "http2.send_request_headers.started",
+)
+
+# 响应扩展字段：本次请求等待连接池分配连接的时间（秒）
+POOL_WAIT_EXTENSION = "pool_wait"
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """
+    带统计的传输层
+
+    包装 httpx.AsyncHTTPTransport，通过 httpcore 的 trace 扩展记录每个请求从进入连接池
+    到拿到连接的等待时间；统计数据会被 WebUI 线程读取，因此用锁保护
+    """
+
+    def __init__(self, name: str, limits: httpx.Limits, http2: bool = False):
+        self.name = name
+        self.limits = limits
+        self.http2 = http2
+        self._transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+        self._lock = threading.Lock()
+        self._wait_times = LatencyWindow(size=500, min_samples=1)
+        self.requests = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.pool_timeouts = 0
+
+    def _on_acquired(self, started_at: float) -> float:
+        """记录一次连接获取，返回等待时间（秒）"""
+        wait = time.monotonic() - started_at
+        with self._lock:
+            self.waiting -= 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self._wait_times.record(wait)
+        return wait
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started_at = time.monotonic()
+        acquired = False
+        wait = 0.0
+
+        async def trace(event_name: str, info: dict) -> None:
+            nonlocal acquired, wait
+            if not acquired and event_name in _ACQUIRED_EVENTS:
+                acquired = True
+                wait = self._on_acquired(started_at)
+
+        request.extensions = {**request.extensions, "trace": trace}
+        with self._lock:
+            self.requests += 1
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+
+        try:
+            response = await self._transport.handle_async_request(request)
+            response.extensions[POOL_WAIT_EXTENSION] = wait
+            return response
+        except httpx.PoolTimeout:
+            with self._lock:
+                self.pool_timeouts += 1
+            logger.warning(f"{self.name} 上游连接池等待超时")
+            raise
+        finally:
+            if not acquired:
+                acquired = True
+                with self._lock:
+                    self.waiting -= 1
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+    def counters(self) -> dict:
+        """不加锁读取计数（单个整数/浮点数的读取是原子的），供 /metrics 使用"""
+        return {
+            "name": self.name,
+            "requests": self.requests,
+            "waiting": self.waiting,
+            "pool_timeouts": self.pool_timeouts,
+            "wait_seconds_total": self.wait_total
+        }
+
+    def snapshot(self) -> dict:
+        """获取连接池占用和等待时间统计"""
+        # 连接列表属于 httpcore 内部状态，读取失败时只返回请求统计
+        try:
+            connections = list(self._transport._pool.connections)
+            active = sum(1 for conn in connections if not conn.is_idle())
+            total = len(connections)
+        except Exception:
+            active = total = None
+
+        with self._lock:
+            acquired = self.requests - self.waiting
+            p95 = self._wait_times.percentile(95)
+            return {
+                "name": self.name,
+                "http2": self.http2,
+                "max_connections": self.limits.max_connections,
+                "max_keepalive_connections": self.limits.max_keepalive_connections,
+                "connections": total,
+                "active_connections": active,
+                "idle_connections": total - active if total is not None else None,
+                "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+                "requests": self.requests,
+                "pool_timeouts": self.pool_timeouts,
+                "wait_avg_ms": round(self.wait_total / acquired * 1000, 2) if acquired > 0 else 0,
+                "wait_p95_ms": round(p95 * 1000, 2) if p95 is not None else 0,
+                "wait_max_ms": round(self.wait_max * 1000, 2)
+            }
+
+
+class UpstreamPool:
+    """单个上游的 HTTP 客户端和连接池"""
+
+    def __init__(self, name: str, timeout: httpx.Timeout, config: dict):
+        """
+        初始化上游连接池
+
+        Args:
+            name: 上游名称（normal / fallback）
+            timeout: 请求超时配置
+            config: 连接池配置（max_connections, max_keepalive_connections,
+                keepalive_expiry, http2）
+        """
+        http2 = config["http2"]
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning(f"{name} 上游启用了 HTTP/2 但未安装 h2（pip install httpx[http2]），使用 HTTP/1.1")
+            http2 = False
+
+        limits = httpx.Limits(
+            max_connections=config["max_connections"],
+            max_keepalive_connections=config["max_keepalive_connections"],
+            keepalive_expiry=config["keepalive_expiry"]
+        )
+        self.name = name
+        self.transport = InstrumentedTransport(name, limits, http2)
+        self.client = httpx.AsyncClient(timeout=timeout, transport=self.transport)
+        logger.info(
+            f"{name} 上游连接池: 最大连接数 {limits.max_connections}，"
+            f"最大保活连接数 {limits.max_keepalive_connections}，HTTP/2 {'开启' if http2 else '关闭'}"
+        )
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    def snapshot(self) -> dict:
+        """获取连接池统计"""
+        return self.transport.snapshot()
+
+    def counters(self) -> dict:
+        """不加锁读取连接池计数"""
+        return self.transport.counters()
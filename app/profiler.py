@@ -0,0 +1,118 @@
+"""
+采样分析器模块
+纯 Python 的统计采样分析器：在独立线程中按固定间隔读取所有线程的调用栈（sys._current_frames），
+按调用栈计数，输出折叠栈格式（每行“帧;帧;... 次数”），可直接交给 flamegraph.pl、speedscope 等工具生成火焰图
+"""
+import logging
+import sys
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 单个调用栈最多保留的帧数（从最内层开始），避免深递归时生成过长的行
+MAX_STACK_DEPTH = 128
+
+
+class ProfilerBusyError(Exception):
+    """已有采样正在进行"""
+
+
+def _frame_label(frame) -> str:
+    """帧的显示名称：模块.函数"""
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}.{getattr(code, 'co_qualname', code.co_name)}"
+
+
+class SamplingProfiler:
+    """
+    统计采样分析器
+
+    同一时间只允许一个采样；采样在调用线程中阻塞进行，异步代码应通过 asyncio.to_thread 调用
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 帧代码对象 -> 显示名称的缓存，采样期间有效
+        self._labels: Dict[Tuple[object, str], str] = {}
+
+    def _stack(self, frame, thread_name: str) -> Tuple[str, ...]:
+        """从最外层到最内层的调用栈，根节点为线程名"""
+        labels = []
+        while frame is not None and len(labels) < MAX_STACK_DEPTH:
+            key = (frame.f_code, frame.f_globals.get("__name__", "?"))
+            label = self._labels.get(key)
+            if label is None:
+                label = self._labels[key] = _frame_label(frame)
+            labels.append(label)
+            frame = frame.f_back
+        labels.append(thread_name)
+        labels.reverse()
+        return tuple(labels)
+
+    def profile(self, seconds: float, interval: float) -> Tuple[str, int]:
+        """
+        采样所有线程（不含采样线程自身）
+
+        Args:
+            seconds: 采样时长（秒）
+            interval: 采样间隔（秒）
+
+        Returns:
+            (折叠栈文本, 采样轮数)
+
+        Raises:
+            ProfilerBusyError: 已有采样正在进行
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError()
+        try:
+            return self._profile(seconds, interval)
+        finally:
+            self._labels.clear()
+            self._lock.release()
+
+    def _profile(self, seconds: float, interval: float) -> Tuple[str, int]:
+        own_ident = threading.get_ident()
+        counts: Dict[Tuple[str, ...], int] = {}
+        rounds = 0
+        deadline = time.monotonic() + seconds
+        next_at = time.monotonic()
+        logger.info(f"开始采样分析: {seconds:g} 秒，间隔 {interval * 1000:g} 毫秒")
+
+        while True:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = self._stack(frame, names.get(ident, f"thread-{ident}"))
+                counts[stack] = counts.get(stack, 0) + 1
+            rounds += 1
+
+            next_at += interval
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if next_at > now:
+                time.sleep(min(next_at - now, deadline - now))
+            else:
+                # 采样本身跟不上间隔时不补采，从当前时间重新计时
+                next_at = now
+
+        logger.info(f"采样分析结束: {rounds} 轮，{len(counts)} 个不同的调用栈")
+        lines = [f"{';'.join(stack)} {count}" for stack, count in sorted(counts.items())]
+        return "\n".join(lines) + "\n", rounds
+
+
+# 全局采样分析器实例
+_profiler_instance: Optional[SamplingProfiler] = None
+
+
+def get_profiler() -> SamplingProfiler:
+    """获取采样分析器单例实例"""
+    global _profiler_instance
+    if _profiler_instance is None:
+        _profiler_instance = SamplingProfiler()
+    return _profiler_instance
@@ -2,15 +2,25 @@
 代理请求处理模块
 负责将请求转发到上游服务
 """
-import json
+import asyncio
 import logging
+import time
 from typing import AsyncGenerator, Optional
 import httpx
 from app.config import (
-    UPSTREAM_NORMAL, UPSTREAM_FALLBACK,
-    UPSTREAM_NORMAL_KEY, UPSTREAM_FALLBACK_KEY,
-    load_model_mapping, get_mapped_model
+    NORMAL_POOL, FALLBACK_POOL, POOL_TIMEOUT,
+    STREAM_COMMIT_MODE, STREAM_COMMIT_TOKENS, STREAM_COMMIT_BYTES, STREAM_INCLUDE_USAGE,
+    HEDGE_ENABLED, HEDGE_DELAY, HEDGE_PERCENTILE, HEDGE_BUDGET_PERCENT,
+    load_model_mapping, load_upstream_endpoints, get_mapped_model
 )
+from app.balancer import Endpoint, EndpointCall, EndpointPool
+from app.breaker import get_breaker, ROUTE_FALLBACK, ROUTE_PROBE
+from app.codec import loads
+from app.context import RequestContext, UPSTREAM_FALLBACK, UPSTREAM_NORMAL
+from app.hedge import HedgeBudget, HedgePolicy
+from app.payload import ChatPayload
+from app.pool import POOL_WAIT_EXTENSION, UpstreamPool
+from app.sse import StreamContentDetector, StreamUsageTracker
 
 logger = logging.getLogger(__name__)
 
@@ -19,68 +29,238 @@ TIMEOUT = httpx.Timeout(
     connect=10.0,
     read=300.0,  # 流式响应可能需要较长时间
     write=10.0,
-    pool=10.0
+    pool=POOL_TIMEOUT
 )
 
+# 流式尝试结束标记
+_STREAM_END = object()
+
+
+class EmptyStreamError(Exception):
+    """流式响应在提交点之前结束且没有有效内容（或上游返回错误状态码）"""
+    
+    def __init__(self, reason: str, status_code: int, held: bytes):
+        """
+        Args:
+            reason: 回退原因（status / empty）
+            status_code: 上游状态码
+            held: 已暂存的响应数据，作为最后手段返回给客户端
+        """
+        super().__init__(reason)
+        self.reason = reason
+        self.status_code = status_code
+        self.held = held
+
+
+class _StreamAttempt:
+    """在后台任务中运行一次流式请求尝试，数据块经由有界队列传递"""
+    
+    def __init__(self, chunks: AsyncGenerator[bytes, None], queue_size: int = 64):
+        self._chunks = chunks
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._task = asyncio.create_task(self._pump())
+    
+    async def _pump(self):
+        """把数据块搬运到队列，结束时放入结束标记或异常"""
+        try:
+            async for chunk in self._chunks:
+                await self._queue.put(chunk)
+            await self._queue.put(_STREAM_END)
+        except Exception as e:
+            await self._queue.put(e)
+        finally:
+            await self._chunks.aclose()
+    
+    def next(self) -> asyncio.Future:
+        """获取下一个数据块的 Future"""
+        return asyncio.ensure_future(self._queue.get())
+    
+    async def get(self):
+        """获取下一个数据块、结束标记或异常"""
+        return await self._queue.get()
+    
+    def cancel(self):
+        """取消本次尝试（关闭上游连接）"""
+        self._task.cancel()
+
 
 class UpstreamProxy:
     """上游代理处理器"""
     
     def __init__(self):
-        self.client = httpx.AsyncClient(timeout=TIMEOUT)
+        # 每个上游独立的连接池，备用上游的流量不会占用正常上游的连接
+        self.normal_pool = UpstreamPool("normal", TIMEOUT, NORMAL_POOL)
+        self.fallback_pool = UpstreamPool("fallback", TIMEOUT, FALLBACK_POOL)
+        # 每一级上游的端点池
+        endpoints = load_upstream_endpoints()
+        self.normal_endpoints = EndpointPool("normal", endpoints["normal"])
+        self.fallback_endpoints = EndpointPool("fallback", endpoints["fallback"])
         self.model_mapping = load_model_mapping()
         self._mapping_last_check = 0
-        self.last_stream_was_fallback = False  # 追踪最后一次流式请求是否使用了回退
+        
+        # 对冲策略：非流式按完整响应耗时、流式按到达提交点的耗时估算延迟，共享同一预算
+        self._hedge_budget = HedgeBudget(HEDGE_BUDGET_PERCENT)
+        self._request_hedge = HedgePolicy(HEDGE_DELAY, HEDGE_PERCENTILE, self._hedge_budget)
+        self._stream_hedge = HedgePolicy(HEDGE_DELAY, HEDGE_PERCENTILE, self._hedge_budget)
+        self._breaker = get_breaker()
     
     async def close(self):
         """关闭 HTTP 客户端"""
-        await self.client.aclose()
+        await self.normal_pool.aclose()
+        await self.fallback_pool.aclose()
+    
+    def _client(self, use_fallback: bool) -> httpx.AsyncClient:
+        """获取上游对应的 HTTP 客户端"""
+        return self.fallback_pool.client if use_fallback else self.normal_pool.client
+    
+    def pool_snapshot(self) -> list:
+        """获取各上游连接池的统计"""
+        return [self.normal_pool.snapshot(), self.fallback_pool.snapshot()]
+    
+    def endpoint_snapshot(self) -> dict:
+        """获取各级上游端点的统计"""
+        return {
+            "normal": self.normal_endpoints.snapshot(),
+            "fallback": self.fallback_endpoints.snapshot()
+        }
+    
+    def metrics_snapshot(self) -> dict:
+        """不加锁读取连接池和端点的计数，供 /metrics 使用"""
+        return {
+            "pools": [self.normal_pool.counters(), self.fallback_pool.counters()],
+            "endpoints": {
+                "normal": self.normal_endpoints.in_flight(),
+                "fallback": self.fallback_endpoints.in_flight()
+            }
+        }
+    
+    def forwards_client_key(self, include_fallback: bool = True) -> bool:
+        """
+        是否有端点未配置 Key（此时上游看到的是客户端自己的 Key，共享的结果需要按客户端 Key 区分）
+        
+        Args:
+            include_fallback: 是否同时检查备用上游的端点
+        """
+        pools = [self.normal_endpoints]
+        if include_fallback:
+            pools.append(self.fallback_endpoints)
+        return not all(endpoint.key for pool in pools for endpoint in pool.endpoints)
     
     def reload_model_mapping(self):
         """重新加载模型映射配置"""
         self.model_mapping = load_model_mapping()
     
-    def _get_upstream_config(self, use_fallback: bool) -> tuple:
+    def _hedge_delay(self, policy: HedgePolicy) -> Optional[float]:
         """
-        获取上游配置
+        获取本次请求的对冲延迟
         
         Returns:
-            (上游地址, API Key)
+            延迟（秒），未启用对冲或样本不足时返回 None
         """
-        if use_fallback:
-            return UPSTREAM_FALLBACK, UPSTREAM_FALLBACK_KEY
-        return UPSTREAM_NORMAL, UPSTREAM_NORMAL_KEY
+        self._hedge_budget.on_request()
+        if not HEDGE_ENABLED:
+            return None
+        return policy.delay()
+    
+    def _skip_normal(self, ctx: RequestContext) -> bool:
+        """
+        根据对话回退记忆和断路器决定是否跳过正常上游
+        
+        Returns:
+            True 如果应直接请求备用上游
+        """
+        if ctx.prefer_fallback:
+            logger.info("对话上一轮使用了备用上游，直接请求备用上游")
+            ctx.mark_fallback("affinity")
+            return True
+        
+        route = self._breaker.route(ctx.model)
+        if route == ROUTE_FALLBACK:
+            logger.info(f"模型 {ctx.model} 断路器已打开，直接请求备用上游")
+            ctx.mark_fallback("breaker")
+            return True
+        ctx.breaker_probe = route == ROUTE_PROBE
+        return False
+    
+    def _record_normal_result(
+        self,
+        ctx: RequestContext,
+        policy: HedgePolicy,
+        started_at: float,
+        is_empty: bool
+    ) -> None:
+        """记录正常上游的一次结果（对冲延迟样本和断路器窗口）"""
+        policy.record_latency(started_at)
+        self._breaker.record(ctx.model, is_empty, ctx.breaker_probe)
+    
+    def _pick_endpoint(self, use_fallback: bool) -> EndpointCall:
+        """
+        从对应级别的端点池中选择一个端点
+        
+        Returns:
+            端点调用跟踪器，需要在 with 块中使用以便释放端点
+        """
+        pool = self.fallback_endpoints if use_fallback else self.normal_endpoints
+        return pool.call(pool.pick())
+    
+    def _auth_header(self, endpoint: Endpoint, original_headers: dict) -> str:
+        """构建 Authorization 请求头（端点未配置 Key 时使用请求中的原始 Key）"""
+        if endpoint.key:
+            return f"Bearer {endpoint.key}"
+        return original_headers.get("authorization", "")
+    
+    @staticmethod
+    def _record_connected(ctx: RequestContext, response: httpx.Response, sent_at: float) -> float:
+        """
+        记录等待连接池和上游返回响应头的耗时
+        
+        Args:
+            sent_at: 发起请求的时间（time.perf_counter()）
+        
+        Returns:
+            收到响应头的时间（time.perf_counter()）
+        """
+        now = time.perf_counter()
+        wait = response.extensions.get(POOL_WAIT_EXTENSION, 0.0)
+        ctx.add_step("pool_wait", wait)
+        ctx.add_step("upstream_ttfb", max(now - sent_at - wait, 0.0))
+        return now
     
     def _prepare_request(
         self,
-        request_body: dict,
+        payload: ChatPayload,
+        endpoint: Endpoint,
         use_fallback: bool,
-        original_headers: dict
+        original_headers: dict,
+        ctx: Optional[RequestContext] = None
     ) -> tuple:
         """
         准备转发请求
         
+        Args:
+            ctx: 可选的请求上下文，用于记录准备耗时
+        
         Returns:
-            (目标URL, 请求头, 请求体)
+            (目标URL, 请求头, 请求体字节)
         """
-        upstream_url, api_key = self._get_upstream_config(use_fallback)
-        
-        # 映射模型名称
-        original_model = request_body.get("model", "")
+        started_at = time.perf_counter()
+        # 映射模型名称（直接替换原始字节中的模型字段，不重新序列化请求体）
+        original_model = payload.model
         mapped_model = get_mapped_model(original_model, use_fallback, self.model_mapping)
         
         if mapped_model != original_model:
             logger.info(f"模型映射: {original_model} -> {mapped_model}")
-            request_body = request_body.copy()
-            request_body["model"] = mapped_model
+        tier = UPSTREAM_FALLBACK if use_fallback else UPSTREAM_NORMAL
+        include_usage = payload.stream and STREAM_INCLUDE_USAGE in ("all", tier)
+        content = payload.encode(mapped_model, include_usage)
         
         # 构建目标 URL
-        target_url = f"{upstream_url.rstrip('/')}/v1/chat/completions"
+        target_url = f"{endpoint.url}/v1/chat/completions"
         
         # 构建请求头
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}" if api_key else original_headers.get("authorization", "")
+            "Authorization": self._auth_header(endpoint, original_headers)
         }
         
         # 保留部分原始请求头
@@ -88,46 +268,209 @@ class UpstreamProxy:
             if key in original_headers:
                 headers[key] = original_headers[key]
         
-        return target_url, headers, request_body
+        if ctx is not None:
+            ctx.add_step("mapping", time.perf_counter() - started_at)
+        return target_url, headers, content
     
     async def forward_request(
         self,
-        request_body: dict,
+        payload: ChatPayload,
         use_fallback: bool,
-        original_headers: dict
+        original_headers: dict,
+        ctx: Optional[RequestContext] = None
     ) -> tuple:
         """
         转发非流式请求
         
+        Args:
+            ctx: 可选的请求上下文，用于记录连接时间和流量
+        
         Returns:
             (上游响应, 响应内容JSON, 是否为空响应)
         """
-        target_url, headers, body = self._prepare_request(
-            request_body, use_fallback, original_headers
-        )
-        
-        upstream_type = "备用" if use_fallback else "正常"
-        logger.info(f"转发请求到{upstream_type}上游: {target_url}")
-        
-        response = await self.client.post(
-            target_url,
-            json=body,
-            headers=headers
-        )
+        call = self._pick_endpoint(use_fallback)
+        # 选出端点后立即进入 with 块，准备请求时出错也能释放端点
+        with call:
+            target_url, headers, body = self._prepare_request(
+                payload, call.endpoint, use_fallback, original_headers, ctx
+            )
+            
+            upstream_type = "备用" if use_fallback else "正常"
+            logger.info(f"转发请求到{upstream_type}上游: {target_url}")
+            
+            client = self._client(use_fallback)
+            request = client.build_request(
+                "POST",
+                target_url,
+                content=body,
+                headers=headers
+            )
+            sent_at = time.perf_counter()
+            response = await client.send(request, stream=True)
+            call.connected(response.status_code)
+            try:
+                if ctx is not None:
+                    ctx.mark_connected()
+                    connected_at = self._record_connected(ctx, response, sent_at)
+                content = await response.aread()
+            finally:
+                await response.aclose()
+        if ctx is not None:
+            ctx.mark_received(len(content))
         
         logger.info(f"上游响应状态码: {response.status_code}")
         
         # 解析响应内容
         try:
-            response_json = response.json()
+            response_json = loads(content)
         except Exception:
             response_json = {"error": response.text}
         
+        if ctx is not None and isinstance(response_json, dict):
+            ctx.record_usage(UPSTREAM_FALLBACK if use_fallback else UPSTREAM_NORMAL, response_json.get("usage"))
+        
         # 检查响应是否为空
         is_empty = self._is_empty_response(response_json, response.status_code)
+        if ctx is not None:
+            ctx.add_step("decision", time.perf_counter() - connected_at)
         
         return response, response_json, is_empty
     
+    async def forward_request_with_fallback(
+        self,
+        payload: ChatPayload,
+        original_headers: dict,
+        ctx: RequestContext
+    ) -> tuple:
+        """
+        转发非流式请求，带回退功能
+        先请求正常上游，如果响应为空则转向备用上游，路由结果记录在 ctx 中
+        
+        Returns:
+            (上游响应, 响应内容JSON)
+        """
+        if self._skip_normal(ctx):
+            response, response_json, is_empty = await self.forward_request(
+                payload, True, original_headers, ctx
+            )
+        else:
+            delay = self._hedge_delay(self._request_hedge)
+            if delay is not None:
+                response, response_json, is_empty = await self._forward_request_hedged(
+                    payload, original_headers, ctx, delay
+                )
+            else:
+                started_at = time.monotonic()
+                response, response_json, is_empty = await self.forward_request(
+                    payload, False, original_headers, ctx
+                )
+                self._record_normal_result(ctx, self._request_hedge, started_at, is_empty)
+                
+                if is_empty:
+                    # 正常上游返回为空，回退到备用上游
+                    logger.warning("正常上游响应为空，回退到备用上游")
+                    ctx.mark_fallback("status" if response.status_code != 200 else "empty")
+                    response, response_json, is_empty = await self.forward_request(
+                        payload, True, original_headers, ctx
+                    )
+        
+        ctx.status_code = response.status_code
+        ctx.empty_response = is_empty
+        return response, response_json
+    
+    async def _forward_request_hedged(
+        self,
+        payload: ChatPayload,
+        original_headers: dict,
+        ctx: RequestContext,
+        delay: float
+    ) -> tuple:
+        """
+        带对冲的非流式请求
+        正常上游超过 delay 秒仍未返回时，在预算允许的情况下同时请求备用上游，
+        先返回有效结果的一方胜出，另一方被取消
+        
+        Returns:
+            (上游响应, 响应内容JSON, 是否为空响应)
+        """
+        started_at = time.monotonic()
+        # 两次尝试并发进行，各自使用独立的上下文，只有最终采用的结果合并到请求上下文
+        normal_ctx = ctx.attempt()
+        fallback_ctx = ctx.attempt()
+        normal = asyncio.create_task(
+            self.forward_request(payload, False, original_headers, normal_ctx)
+        )
+        fallback = None
+        fallback_reason = "hedge"
+        pending = {normal}
+        timeout = delay
+        last_result = None
+        error = None
+        # 正常上游是否已有结果（成功、为空或出错）
+        normal_settled = False
+        
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                timeout = None
+                
+                if not done:
+                    # 到达对冲延迟，正常上游仍未返回
+                    if self._hedge_budget.try_acquire():
+                        logger.info(f"正常上游 {delay:.2f}s 内未返回，发起对冲请求到备用上游")
+                        ctx.hedged = True
+                        fallback = asyncio.create_task(
+                            self.forward_request(payload, True, original_headers, fallback_ctx)
+                        )
+                        pending.add(fallback)
+                    continue
+                
+                for task in done:
+                    if task is normal:
+                        normal_settled = True
+                    if task.exception() is not None:
+                        error = task.exception()
+                        logger.warning(f"上游请求失败: {error!r}")
+                        continue
+                    
+                    response, response_json, is_empty = task.result()
+                    attempt_ctx = normal_ctx if task is normal else fallback_ctx
+                    if task is normal:
+                        self._record_normal_result(attempt_ctx, self._request_hedge, started_at, is_empty)
+                    if not is_empty:
+                        if task is fallback:
+                            ctx.mark_fallback(fallback_reason)
+                            if not normal_settled:
+                                self._request_hedge.record_cancelled(started_at)
+                        ctx.adopt(attempt_ctx)
+                        return response, response_json, False
+                    
+                    if task is normal:
+                        fallback_reason = "status" if response.status_code != 200 else "empty"
+                        # 被丢弃的正常上游响应同样计入流量和浪费的 token
+                        ctx.discard(attempt_ctx)
+                        if fallback is None:
+                            logger.warning("正常上游响应为空，回退到备用上游")
+                            fallback = asyncio.create_task(
+                                self.forward_request(payload, True, original_headers, fallback_ctx)
+                            )
+                            pending.add(fallback)
+                    else:
+                        # 备用上游同样为空，仍作为最终结果
+                        last_result = (response, response_json, True)
+        finally:
+            for task in (normal, fallback):
+                if task is not None and not task.done():
+                    task.cancel()
+        
+        if last_result is not None:
+            ctx.mark_fallback(fallback_reason)
+            ctx.adopt(fallback_ctx)
+            return last_result
+        raise error
+    
     def _is_empty_response(self, response_json: dict, status_code: int) -> bool:
         """
         检查响应是否为空
@@ -161,115 +504,343 @@ class UpstreamProxy:
         
         return False
     
+    def _new_detector(self) -> StreamContentDetector:
+        """创建流式内容检测器（buffered 模式下只需判断是否有内容）"""
+        if STREAM_COMMIT_MODE == "buffered":
+            return StreamContentDetector()
+        return StreamContentDetector(STREAM_COMMIT_TOKENS, STREAM_COMMIT_BYTES)
+    
     async def forward_stream(
         self,
-        request_body: dict,
+        payload: ChatPayload,
         use_fallback: bool,
-        original_headers: dict
+        original_headers: dict,
+        detector: Optional[StreamContentDetector] = None,
+        ctx: Optional[RequestContext] = None
     ) -> AsyncGenerator[bytes, None]:
         """
         转发流式请求
         
+        Args:
+            detector: 可选的内容检测器，透传的同时检测响应是否包含有效内容
+            ctx: 可选的请求上下文，用于记录时间和流量
+        
         Yields:
             流式响应数据块
         """
-        target_url, headers, body = self._prepare_request(
-            request_body, use_fallback, original_headers
-        )
+        call = self._pick_endpoint(use_fallback)
+        # 选出端点后立即进入 with 块，准备请求时出错也能释放端点
+        with call:
+            target_url, headers, body = self._prepare_request(
+                payload, call.endpoint, use_fallback, original_headers, ctx
+            )
+            
+            upstream_type = "备用" if use_fallback else "正常"
+            logger.info(f"转发流式请求到{upstream_type}上游: {target_url}")
+            
+            sent_at = time.perf_counter()
+            async with self._client(use_fallback).stream(
+                "POST",
+                target_url,
+                content=body,
+                headers=headers
+            ) as response:
+                logger.info(f"上游流式响应状态码: {response.status_code}")
+                if ctx is not None:
+                    ctx.mark_connected()
+                    ctx.status_code = response.status_code
+                    self._record_connected(ctx, response, sent_at)
+                call.connected(response.status_code)
+                
+                if response.status_code != 200:
+                    # 如果上游返回错误，读取完整错误信息并返回
+                    error_content = await response.aread()
+                    if ctx is not None:
+                        ctx.mark_received(len(error_content))
+                    logger.error(f"上游错误响应: {error_content.decode('utf-8', errors='ignore')}")
+                    yield error_content
+                    return
+                
+                usage = StreamUsageTracker()
+                async for chunk in response.aiter_bytes():
+                    if ctx is not None:
+                        ctx.mark_received(len(chunk))
+                    if detector is not None:
+                        detector.feed(chunk)
+                    usage.feed(chunk)
+                    yield chunk
+                
+                if ctx is not None:
+                    ctx.record_usage(UPSTREAM_FALLBACK if use_fallback else UPSTREAM_NORMAL, usage.usage())
         
-        upstream_type = "备用" if use_fallback else "正常"
-        logger.info(f"转发流式请求到{upstream_type}上游: {target_url}")
+    async def _stream_attempt(
+        self,
+        payload: ChatPayload,
+        use_fallback: bool,
+        original_headers: dict,
+        ctx: RequestContext
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        带内容检测的流式请求尝试
+        只暂存提交点（首个有效内容）之前的数据；到达提交点后一次性发送暂存数据，
+        之后逐块透传。在提交点之前结束且没有有效内容时抛出 EmptyStreamError
         
-        async with self.client.stream(
-            "POST",
-            target_url,
-            json=body,
-            headers=headers
-        ) as response:
-            logger.info(f"上游流式响应状态码: {response.status_code}")
+        Yields:
+            流式响应数据块（第一次产出即表示已提交）
+        """
+        call = self._pick_endpoint(use_fallback)
+        # 选出端点后立即进入 with 块，准备请求时出错也能释放端点
+        with call:
+            target_url, headers, body = self._prepare_request(
+                payload, call.endpoint, use_fallback, original_headers, ctx
+            )
             
-            if response.status_code != 200:
-                # 如果上游返回错误，读取完整错误信息并返回
-                error_content = await response.aread()
-                logger.error(f"上游错误响应: {error_content.decode('utf-8', errors='ignore')}")
-                yield error_content
-                return
+            upstream_type = "备用" if use_fallback else "正常"
+            logger.info(f"转发流式请求到{upstream_type}上游: {target_url}")
             
-            async for chunk in response.aiter_bytes():
-                yield chunk
-    
+            started_at = time.monotonic()
+            detector = self._new_detector()
+            usage = StreamUsageTracker()
+            held_chunks = []
+            committed = False
+            
+            sent_at = time.perf_counter()
+            async with self._client(use_fallback).stream(
+                "POST",
+                target_url,
+                content=body,
+                headers=headers
+            ) as response:
+                logger.info(f"{upstream_type}上游流式响应状态码: {response.status_code}")
+                ctx.mark_connected()
+                connected_at = self._record_connected(ctx, response, sent_at)
+                call.connected(response.status_code)
+                
+                if response.status_code != 200:
+                    error_content = await response.aread()
+                    ctx.mark_received(len(error_content))
+                    ctx.add_step("decision", time.perf_counter() - connected_at)
+                    if not use_fallback:
+                        self._record_normal_result(ctx, self._stream_hedge, started_at, True)
+                    raise EmptyStreamError("status", response.status_code, error_content)
+                
+                async for chunk in response.aiter_bytes():
+                    ctx.mark_received(len(chunk))
+                    usage.feed(chunk)
+                    if committed:
+                        yield chunk
+                        continue
+                    
+                    held_chunks.append(chunk)
+                    if detector.feed(chunk) and STREAM_COMMIT_MODE != "buffered":
+                        # 到达提交点：发送暂存数据，之后直接透传
+                        committed = True
+                        ctx.status_code = response.status_code
+                        ctx.add_step("decision", time.perf_counter() - connected_at)
+                        if not use_fallback:
+                            self._record_normal_result(ctx, self._stream_hedge, started_at, False)
+                        logger.info(f"{upstream_type}上游已产生有效内容，开始透传流式响应")
+                        yield b"".join(held_chunks)
+                        held_chunks = []
+                
+                # 被丢弃的响应同样记录用量，用于统计浪费的 token
+                ctx.record_usage(UPSTREAM_FALLBACK if use_fallback else UPSTREAM_NORMAL, usage.usage())
+                
+                if not committed:
+                    has_content = detector.finish()
+                    ctx.add_step("decision", time.perf_counter() - connected_at)
+                    if not use_fallback:
+                        self._record_normal_result(ctx, self._stream_hedge, started_at, not has_content)
+                    if not has_content:
+                        raise EmptyStreamError("empty", response.status_code, b"".join(held_chunks))
+                    # 响应在到达提交点前结束，但内容有效
+                    ctx.status_code = response.status_code
+                    logger.info(f"{upstream_type}上游响应有效，返回收集的响应")
+                    yield b"".join(held_chunks)
+        
     async def forward_stream_with_fallback(
         self,
-        request_body: dict,
-        original_headers: dict
+        payload: ChatPayload,
+        original_headers: dict,
+        ctx: RequestContext
     ) -> AsyncGenerator[bytes, None]:
         """
         转发流式请求，带回退功能
-        先请求正常上游，如果响应为空则转向备用上游
+        先请求正常上游，只暂存提交点（首个有效内容）之前的数据；
+        到达提交点后立即发送暂存数据并透传后续数据块。
+        如果在提交点之前响应结束且内容为空，则转向备用上游。
+        路由结果记录在 ctx 中
         
         Yields:
             流式响应数据块
         """
-        # 先尝试正常上游（需要收集完整响应来判断是否为空）
-        target_url, headers, body = self._prepare_request(
-            request_body, False, original_headers
-        )
-        
-        logger.info(f"转发流式请求到正常上游: {target_url}")
+        if self._skip_normal(ctx):
+            async for chunk in self._stream_fallback(payload, original_headers, ctx):
+                yield chunk
+            return
         
-        collected_chunks = []
-        collected_content = ""
-        need_fallback = False
+        delay = self._hedge_delay(self._stream_hedge)
+        if delay is not None:
+            async for chunk in self._forward_stream_hedged(
+                payload, original_headers, ctx, delay
+            ):
+                yield chunk
+            return
         
-        async with self.client.stream(
-            "POST",
-            target_url,
-            json=body,
-            headers=headers
-        ) as response:
-            logger.info(f"正常上游流式响应状态码: {response.status_code}")
-            
-            if response.status_code != 200:
-                # 如果上游返回错误，需要回退
-                error_content = await response.aread()
-                logger.warning(f"正常上游返回错误，准备回退到备用上游")
-                need_fallback = True
-            else:
-                # 收集所有响应块
-                async for chunk in response.aiter_bytes():
-                    collected_chunks.append(chunk)
-                    # 尝试从 SSE 数据中提取内容
-                    try:
-                        chunk_str = chunk.decode('utf-8', errors='ignore')
-                        for line in chunk_str.split('\n'):
-                            if line.startswith('data: ') and line != 'data: [DONE]':
-                                data = json.loads(line[6:])
-                                choices = data.get('choices', [])
-                                if choices:
-                                    delta = choices[0].get('delta', {})
-                                    content = delta.get('content', '')
-                                    if content:
-                                        collected_content += content
-                    except Exception:
-                        pass
-                
-                # 检查收集的内容是否为空
-                if not collected_content.strip():
-                    logger.warning(f"正常上游响应内容为空，准备回退到备用上游")
-                    need_fallback = True
-        
-        if need_fallback:
-            # 回退到备用上游
-            self.last_stream_was_fallback = True
-            logger.info("执行回退：转发流式请求到备用上游")
-            async for chunk in self.forward_stream(request_body, True, original_headers):
+        try:
+            async for chunk in self._stream_attempt(payload, False, original_headers, ctx):
                 yield chunk
+            return
+        except EmptyStreamError as e:
+            fallback_reason = e.reason
+        
+        if fallback_reason == "status":
+            logger.warning("正常上游返回错误，准备回退到备用上游")
         else:
-            # 返回已收集的正常上游响应
-            self.last_stream_was_fallback = False
-            logger.info("正常上游响应有效，返回收集的响应")
-            for chunk in collected_chunks:
-                yield chunk
+            logger.warning("正常上游响应内容为空，准备回退到备用上游")
+        
+        # 回退到备用上游
+        ctx.mark_fallback(fallback_reason)
+        logger.info("执行回退：转发流式请求到备用上游")
+        async for chunk in self._stream_fallback(payload, original_headers, ctx):
+            yield chunk
+    
+    async def _stream_fallback(
+        self,
+        payload: ChatPayload,
+        original_headers: dict,
+        ctx: RequestContext
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        直接透传备用上游的流式响应
+        
+        Yields:
+            流式响应数据块
+        """
+        fallback_detector = StreamContentDetector()
+        async for chunk in self.forward_stream(
+            payload, True, original_headers, fallback_detector, ctx
+        ):
+            yield chunk
+        if not fallback_detector.finish():
+            logger.warning("备用上游响应内容同样为空")
+    
+    async def _forward_stream_hedged(
+        self,
+        payload: ChatPayload,
+        original_headers: dict,
+        ctx: RequestContext,
+        delay: float
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        带对冲的流式请求
+        正常上游超过 delay 秒仍未到达提交点时，在预算允许的情况下同时请求备用上游，
+        先到达提交点的一方胜出并继续透传，另一方被取消
+        
+        Yields:
+            流式响应数据块
+        """
+        started_at = time.monotonic()
+        # 两次尝试并发进行，各自使用独立的上下文，只有最终采用的结果合并到请求上下文
+        normal_ctx = ctx.attempt()
+        fallback_ctx = ctx.attempt()
+        normal = _StreamAttempt(
+            self._stream_attempt(payload, False, original_headers, normal_ctx)
+        )
+        fallback = None
+        fallback_reason = "hedge"
+        waiting = {normal.next(): normal}
+        timeout = delay
+        winner = None
+        first_chunk = None
+        last_empty = None
+        error = None
+        
+        try:
+            while waiting and winner is None:
+                done, _ = await asyncio.wait(
+                    waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                timeout = None
+                
+                if not done:
+                    # 到达对冲延迟，正常上游仍未提交
+                    if self._hedge_budget.try_acquire():
+                        logger.info(f"正常上游 {delay:.2f}s 内未产生有效内容，发起对冲请求到备用上游")
+                        ctx.hedged = True
+                        fallback = _StreamAttempt(
+                            self._stream_attempt(payload, True, original_headers, fallback_ctx)
+                        )
+                        waiting[fallback.next()] = fallback
+                    continue
+                
+                for future in done:
+                    attempt = waiting.pop(future)
+                    item = future.result()
+                    if not isinstance(item, BaseException):
+                        winner, first_chunk = attempt, item
+                        break
+                    
+                    if not isinstance(item, EmptyStreamError):
+                        error = item
+                        logger.warning(f"上游流式请求失败: {item!r}")
+                    
+                    if attempt is normal:
+                        if fallback is None and error is not None:
+                            raise error
+                        if isinstance(item, EmptyStreamError):
+                            fallback_reason = item.reason
+                            # 被丢弃的正常上游响应同样计入流量和浪费的 token
+                            ctx.discard(normal_ctx)
+                        if fallback is None:
+                            logger.warning("正常上游响应为空，回退到备用上游")
+                            fallback = _StreamAttempt(
+                                self._stream_attempt(payload, True, original_headers, fallback_ctx)
+                            )
+                            waiting[fallback.next()] = fallback
+                    elif isinstance(item, EmptyStreamError):
+                        last_empty = item
+            
+            if winner is None:
+                if last_empty is None:
+                    raise error
+                # 两个上游都没有有效内容，返回备用上游的响应
+                logger.warning("备用上游响应内容同样为空")
+                ctx.mark_fallback(fallback_reason)
+                ctx.adopt(fallback_ctx)
+                ctx.status_code = last_empty.status_code
+                yield last_empty.held
+                return
+            
+            if winner is fallback:
+                ctx.mark_fallback(fallback_reason)
+                if normal in waiting.values():
+                    # 正常上游尚未到达提交点，取消前记录已耗费的时间
+                    self._stream_hedge.record_cancelled(started_at)
+                normal.cancel()
+            elif fallback is not None:
+                logger.info("正常上游先产生有效内容，取消对冲请求")
+                fallback.cancel()
+            
+            # 胜出的尝试继续透传，之后的数据块直接记录到请求上下文
+            winner_ctx = fallback_ctx if winner is fallback else normal_ctx
+            ctx.adopt(winner_ctx)
+            yield first_chunk
+            while True:
+                item = await winner.get()
+                if item is _STREAM_END:
+                    ctx.usage.update(winner_ctx.usage)
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                ctx.mark_received(len(item))
+                yield item
+        finally:
+            for future in waiting:
+                future.cancel()
+            normal.cancel()
+            if fallback is not None:
+                fallback.cancel()
     
     async def forward_models_request(
         self,
@@ -282,16 +853,16 @@ class UpstreamProxy:
         Returns:
             上游响应
         """
-        upstream_url, api_key = self._get_upstream_config(use_fallback)
-        target_url = f"{upstream_url.rstrip('/')}/v1/models"
-        
-        headers = {
-            "Authorization": f"Bearer {api_key}" if api_key else original_headers.get("authorization", "")
-        }
-        
-        logger.info(f"转发模型列表请求: {target_url}")
-        
-        response = await self.client.get(target_url, headers=headers)
+        with self._pick_endpoint(use_fallback) as call:
+            target_url = f"{call.endpoint.url}/v1/models"
+            headers = {
+                "Authorization": self._auth_header(call.endpoint, original_headers)
+            }
+            
+            logger.info(f"转发模型列表请求: {target_url}")
+            
+            response = await self._client(use_fallback).get(target_url, headers=headers)
+            call.connected(response.status_code)
         return response
 
 
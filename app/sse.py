@@ -0,0 +1,228 @@
+"""
+SSE 解析模块
+增量解析上游返回的 Server-Sent Events 字节流，用于流式响应的内容检测
+"""
+import logging
+from collections import deque
+from typing import Deque, List, Optional
+
+from app.codec import loads
+
+logger = logging.getLogger(__name__)
+
+DONE_PAYLOAD = b"[DONE]"
+
+# 流结束时用于查找 usage 事件的尾部字节数
+USAGE_TAIL_BYTES = 16384
+
+
+class SSEParser:
+    """
+    增量 SSE 解析器
+
+    直接处理字节数据，未以换行结尾的残余部分保留在缓冲区中，
+    与下一个数据块拼接后继续解析，因此跨 TCP 数据块的事件不会丢失
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._data_lines: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """
+        喂入一个数据块
+
+        Args:
+            chunk: 上游返回的原始字节
+
+        Returns:
+            本次解析出的完整事件的 data 负载列表
+        """
+        buffer = self._buffer + chunk if self._buffer else chunk
+        events = []
+        start = 0
+
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = buffer[start:end]
+            start = end + 1
+
+            if line.endswith(b"\r"):
+                line = line[:-1]
+
+            if not line:
+                # 空行表示一个事件结束
+                if self._data_lines:
+                    events.append(self._dispatch())
+                continue
+
+            if line.startswith(b"data:"):
+                value = line[5:]
+                if value.startswith(b" "):
+                    value = value[1:]
+                self._data_lines.append(value)
+            # event / id / retry 字段及注释行与内容检测无关，直接忽略
+
+        self._buffer = buffer[start:]
+        return events
+
+    def flush(self) -> List[bytes]:
+        """
+        流结束时取出尚未以空行结尾的最后一个事件
+
+        Returns:
+            剩余事件的 data 负载列表
+        """
+        if self._buffer:
+            self.feed(b"\n")
+        if self._data_lines:
+            return [self._dispatch()]
+        return []
+
+    def _dispatch(self) -> bytes:
+        """合并当前事件的 data 行"""
+        lines = self._data_lines
+        self._data_lines = []
+        if len(lines) == 1:
+            return lines[0]
+        return b"\n".join(lines)
+
+
+class StreamContentDetector:
+    """
+    流式内容检测器
+
+    判断流式响应是否包含有效内容。只记录内容增量数和字节数，
+    不拼接完整内容；一旦判定完成就不再解析 JSON
+    """
+
+    def __init__(self, commit_tokens: int = 1, commit_bytes: int = 0):
+        """
+        初始化检测器
+
+        Args:
+            commit_tokens: 判定完成前至少需要的非空内容增量数
+            commit_bytes: 累计内容字节数达到该值时也视为判定完成（0 表示不启用）
+        """
+        self.commit_tokens = commit_tokens
+        self.commit_bytes = commit_bytes
+        self.parser = SSEParser()
+        self.has_content = False
+        self.content_deltas = 0
+        self.content_bytes = 0
+        self.decided = False
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        喂入一个数据块
+
+        Returns:
+            True 如果已经判定响应包含有效内容（到达提交点）
+        """
+        if self.decided:
+            return True
+
+        for payload in self.parser.feed(chunk):
+            self._inspect(payload)
+            if self.decided:
+                break
+        return self.decided
+
+    def finish(self) -> bool:
+        """
+        流结束时处理残余数据
+
+        Returns:
+            True 如果响应包含有效内容
+        """
+        if not self.decided:
+            for payload in self.parser.flush():
+                self._inspect(payload)
+        return self.has_content
+
+    def _inspect(self, payload: bytes) -> None:
+        """检查单个事件的 data 负载"""
+        if payload == DONE_PAYLOAD or b'"content"' not in payload:
+            # 不含 content 字段的事件（角色、结束标记等）无需解析
+            return
+
+        try:
+            data = loads(payload)
+        except ValueError as e:
+            logger.debug(f"SSE 事件解析失败: {e}")
+            return
+
+        if not isinstance(data, dict):
+            return
+        choices = data.get("choices") or []
+        if not choices:
+            return
+        delta = choices[0].get("delta") or {}
+        content = delta.get("content")
+        if not content:
+            return
+
+        if not self.has_content:
+            if not content.strip():
+                return
+            self.has_content = True
+
+        self.content_deltas += 1
+        self.content_bytes += len(content.encode("utf-8"))
+
+        if self.content_deltas >= self.commit_tokens:
+            self.decided = True
+        elif self.commit_bytes > 0 and self.content_bytes >= self.commit_bytes:
+            self.decided = True
+
+
+class StreamUsageTracker:
+    """
+    流式响应的 token 用量提取
+
+    usage 只出现在流的末尾（include_usage 的最后一个事件，或部分上游的最后一个内容事件），
+    因此透传时只保留最近的若干字节，不做任何解析；流结束后再从尾部查找 usage
+    """
+
+    def __init__(self, tail_bytes: int = USAGE_TAIL_BYTES):
+        self.tail_bytes = tail_bytes
+        self._chunks: Deque[bytes] = deque()
+        self._size = 0
+        self._truncated = False
+
+    def feed(self, chunk: bytes) -> None:
+        """记录一个数据块，丢弃超出尾部范围的旧数据块"""
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        while self._size - len(self._chunks[0]) >= self.tail_bytes:
+            self._size -= len(self._chunks.popleft())
+            self._truncated = True
+
+    def usage(self) -> Optional[dict]:
+        """
+        流结束后解析尾部数据
+
+        Returns:
+            最后一个带 usage 的事件中的 usage，没有时返回 None
+        """
+        tail = b"".join(self._chunks)
+        if b'"usage"' not in tail:
+            return None
+        if self._truncated:
+            # 尾部可能从一行的中间开始
+            tail = tail[tail.find(b"\n") + 1:]
+
+        parser = SSEParser()
+        events = parser.feed(tail) + parser.flush()
+        for payload in reversed(events):
+            if b'"usage"' not in payload:
+                continue
+            try:
+                data = loads(payload)
+            except ValueError:
+                continue
+            if isinstance(data, dict) and isinstance(data.get("usage"), dict):
+                return data["usage"]
+        return None
@@ -5,26 +5,113 @@
 """
 import time
 import threading
-import json
 import os
+from array import array
 from collections import deque
 from dataclasses import dataclass, field
-from typing import Deque, Optional, Dict, List
+from typing import Deque, Optional, Dict, List, Set, Tuple
 from datetime import datetime, timedelta
 import logging
+from app.config import STATS_BACKEND, STATS_COMPACT_INTERVAL
+from app.context import RequestContext, UPSTREAM_FALLBACK, UPSTREAM_NORMAL
+from app.histogram import MAX_MODELS, LatencyStats, StepStats
+from app.history import MAX_FROZEN_DAYS, HistoryCache, HistoryEntry
+from app.persistence import StatsWriter
+from app.stats_store import HOUR_FIELDS, SECOND_FIELDS, SQLiteStatsStore, StatsDelta, add_counts
 
 logger = logging.getLogger(__name__)
 
 # 数据文件路径
 DATA_DIR = os.getenv("DATA_DIR", "/app/data")
 STATS_FILE = os.path.join(DATA_DIR, "stats_data.json")
+# 多 worker 共享的统计数据库
+STATS_DB_FILE = os.path.join(DATA_DIR, "stats.db")
 
+# 同时统计的 RPM 窗口（秒）
+RPM_WINDOWS = (60, 300, 900)
 
-@dataclass
-class RequestRecord:
-    """单次请求记录"""
-    timestamp: float
-    is_fallback: bool
+
+class RollingCounter:
+    """
+    按秒分桶的环形计数器
+    
+    每个桶按列记录一秒内的计数（请求数、token 数等），并为每个窗口维护各列的滚动总数；
+    时间推进时只减去离开窗口的桶，记录和查询都是 O(1)，内存固定。
+    调用方需自行加锁
+    """
+    
+    def __init__(self, windows: Tuple[int, ...] = RPM_WINDOWS, width: int = len(SECOND_FIELDS)):
+        """
+        Args:
+            windows: 需要统计的窗口大小（秒），桶的数量等于最大的窗口
+            width: 每个桶的列数
+        """
+        self.windows = tuple(sorted(set(windows)))
+        self.size = self.windows[-1]
+        self.width = width
+        # 每个桶当前对应的秒，-1 表示空桶
+        self._seconds = array("q", [-1]) * self.size
+        self._columns = [array("q", [0]) * self.size for _ in range(width)]
+        # 窗口 -> 各列总数
+        self._sums: Dict[int, List[int]] = {window: [0] * width for window in self.windows}
+        # 已推进到的秒
+        self._head = 0
+    
+    def _clear(self, index: int, second: int) -> None:
+        self._seconds[index] = second
+        for column in self._columns:
+            column[index] = 0
+    
+    def _reset(self, second: int) -> None:
+        for i in range(self.size):
+            self._clear(i, -1)
+        for sums in self._sums.values():
+            sums[:] = [0] * self.width
+        self._head = second
+    
+    def advance(self, second: int) -> None:
+        """把时间推进到指定的秒，减去离开各窗口的桶"""
+        if second <= self._head:
+            return
+        if second - self._head >= self.size:
+            # 整个环都已过期
+            self._reset(second)
+            return
+        for current in range(self._head + 1, second + 1):
+            for window, sums in self._sums.items():
+                expired = current - window
+                index = expired % self.size
+                if self._seconds[index] == expired:
+                    for i, column in enumerate(self._columns):
+                        sums[i] -= column[index]
+            # 最大窗口离开的桶就是当前秒要复用的桶
+            self._clear(current % self.size, current)
+        self._head = second
+    
+    def add(self, second: int, counts: List[int]) -> None:
+        """记录某一秒的各列计数"""
+        self.advance(second)
+        if second <= self._head - self.size:
+            return
+        index = second % self.size
+        if self._seconds[index] != second:
+            self._clear(index, second)
+        for i, value in enumerate(counts):
+            self._columns[i][index] += value
+        for window, sums in self._sums.items():
+            if second > self._head - window:
+                for i, value in enumerate(counts):
+                    sums[i] += value
+    
+    def get(self, window: int, now: float) -> Tuple[int, ...]:
+        """
+        获取窗口内各列的总数
+        
+        Returns:
+            按列排列的计数
+        """
+        self.advance(int(now))
+        return tuple(self._sums[window])
 
 
 @dataclass
@@ -42,6 +129,11 @@ class DailyStats:
     total_requests: int = 0
     total_normal: int = 0
     total_fallback: int = 0
+    # 最终响应消耗的 token
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # 被丢弃的正常上游响应消耗的 token
+    wasted_tokens: int = 0
     hourly_stats: Dict[str, Dict[str, int]] = field(default_factory=dict)
     
     def to_dict(self) -> dict:
@@ -51,6 +143,9 @@ class DailyStats:
             "total_normal": self.total_normal,
             "total_fallback": self.total_fallback,
             "fallback_rate": round(self.total_fallback / self.total_requests * 100, 2) if self.total_requests > 0 else 0,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "wasted_tokens": self.wasted_tokens,
             "hourly_stats": self.hourly_stats
         }
     
@@ -61,6 +156,9 @@ class DailyStats:
             total_requests=data.get("total_requests", 0),
             total_normal=data.get("total_normal", 0),
             total_fallback=data.get("total_fallback", 0),
+            prompt_tokens=data.get("prompt_tokens", 0),
+            completion_tokens=data.get("completion_tokens", 0),
+            wasted_tokens=data.get("wasted_tokens", 0),
             hourly_stats=data.get("hourly_stats", {})
         )
 
@@ -68,42 +166,97 @@ class DailyStats:
 class RequestStats:
     """请求统计器"""
     
-    def __init__(self, window_seconds: int = 60):
+    def __init__(self, window_seconds: int = 60, backend: str = STATS_BACKEND):
         """
         初始化统计器
         
         Args:
             window_seconds: 统计窗口大小（秒），用于计算 RPM
+            backend: memory（进程内统计）或 sqlite（多 worker 共享统计）
         """
         self.window_seconds = window_seconds
-        self._records: Deque[RequestRecord] = deque()
+        self.windows = tuple(sorted({window_seconds, *RPM_WINDOWS}))
+        self._rolling = RollingCounter(self.windows, len(SECOND_FIELDS))
         self._lock = threading.Lock()
         
+        # 待聚合的事件缓冲区：请求路径只追加元组，不加锁；deque 的 append/popleft 是线程安全的
+        self._events: Deque[tuple] = deque()
+        
+        # 当前小时的时间范围和对应的日期/小时字符串，跨小时才重新计算
+        self._bucket_start = 0.0
+        self._bucket_end = 0.0
+        self._bucket_date = ""
+        self._bucket_hour = ""
+        
         # 总计数器
         self._total_normal = 0
         self._total_fallback = 0
         
-        # 每日统计
+        # 流量计数器（自启动以来）
+        self._bytes_in = 0
+        self._bytes_out = 0
+        
+        # 发起了对冲请求的请求数
+        self._total_hedged = 0
+        
+        # 由响应缓存提供的请求数
+        self._total_cached = 0
+        
+        # 合并到进行中的相同请求的请求数（节省的上游调用数）
+        self._total_coalesced = 0
+        
+        # 按上游和模型分组的各阶段延迟直方图（进程内）
+        self._latency = LatencyStats()
+        
+        # 按最终上游分组的请求处理步骤耗时直方图（进程内）
+        self._steps = StepStats()
+        
+        # (上游, 模型, 回退原因) -> 请求数（进程内，供 /metrics 使用）
+        self._request_counts: Dict[Tuple[str, str, str], int] = {}
+        # 已出现的模型，超过 MAX_MODELS 后新模型归并为 other
+        self._models: Set[str] = set()
+        # (生成响应的上游, 模型) -> [提示 token, 补全 token, 被丢弃的提示 token, 被丢弃的补全 token, 生成耗时（秒）]
+        self._token_counts: Dict[Tuple[str, str], List[float]] = {}
+        
+        # 统计持久化耗时：操作 -> [次数, 总耗时（秒）]
+        self._persist_timings: Dict[str, List[float]] = {}
+        
+        # 每日统计（历史日期按需从快照加载）
         self._daily_stats: Dict[str, DailyStats] = {}
+        # 已确认没有快照的日期
+        self._missing_days: Set[str] = set()
+        # 历史数据的序列化缓存（已结束的日期不再变化）
+        self._history = HistoryCache(self._load_daily_dict)
         
         # 启动时间
         self._start_time = time.time()
         
-        # 上次保存时间
-        self._last_save_time = time.time()
-        self._save_interval = 60  # 每60秒保存一次
+        # 待发布/持久化的增量
+        self._delta = StatsDelta()
+        self._pid = os.getpid()
         
-        # 加载历史数据
-        self._load_data()
+        # 共享存储：历史数据和合并统计从数据库读取
+        self._store: Optional[SQLiteStatsStore] = None
+        # 进程内统计的后台持久化
+        self._writer: Optional[StatsWriter] = None
+        
+        os.makedirs(DATA_DIR, exist_ok=True)
+        if backend == "sqlite":
+            self._store = SQLiteStatsStore(STATS_DB_FILE)
+        else:
+            self._writer = StatsWriter(DATA_DIR, STATS_COMPACT_INTERVAL)
+            self._writer.migrate_legacy(STATS_FILE)
+            self._load_data()
+    
+    @property
+    def shared(self) -> bool:
+        """是否使用多 worker 共享存储"""
+        return self._store is not None
     
     def _get_today(self) -> str:
         """获取今天的日期字符串"""
         return datetime.now().strftime("%Y-%m-%d")
     
-    def _get_current_hour(self) -> str:
-        """获取当前小时"""
-        return datetime.now().strftime("%H")
-    
     def _ensure_daily_stats(self, date: str) -> DailyStats:
         """确保指定日期的统计对象存在"""
         if date not in self._daily_stats:
@@ -111,111 +264,339 @@ class RequestStats:
         return self._daily_stats[date]
     
     def _load_data(self) -> None:
-        """从文件加载历史数据"""
-        try:
-            if os.path.exists(STATS_FILE):
-                with open(STATS_FILE, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                # 加载每日统计
-                for date_str, daily_data in data.get("daily_stats", {}).items():
-                    self._daily_stats[date_str] = DailyStats.from_dict(daily_data)
-                
-                # 加载总计数器（从今天的数据恢复）
-                today = self._get_today()
-                if today in self._daily_stats:
-                    today_stats = self._daily_stats[today]
-                    self._total_normal = today_stats.total_normal
-                    self._total_fallback = today_stats.total_fallback
-                
-                logger.info(f"已加载历史统计数据，共 {len(self._daily_stats)} 天")
-        except Exception as e:
-            logger.warning(f"加载统计数据失败: {e}")
+        """启动时只加载今天的快照，用于恢复总计数器；其他日期在访问时再加载"""
+        today = self._get_today()
+        today_stats = self._load_day(today)
+        if today_stats is not None:
+            self._total_normal = today_stats.total_normal
+            self._total_fallback = today_stats.total_fallback
+            logger.info(f"已加载今日统计数据，共 {today_stats.total_requests} 次请求")
     
-    def _save_data(self, force: bool = False) -> None:
-        """保存数据到文件"""
-        now = time.time()
-        if not force and now - self._last_save_time < self._save_interval:
-            return
+    def _load_day(self, date: str) -> Optional[DailyStats]:
+        """
+        获取指定日期的统计，内存中没有时从快照加载
         
-        self._last_save_time = now
+        文件读取在锁外进行，不阻塞请求记录
+        """
+        with self._lock:
+            if date in self._daily_stats:
+                return self._daily_stats[date]
+            if date in self._missing_days:
+                return None
         
         try:
-            # 确保目录存在
-            os.makedirs(DATA_DIR, exist_ok=True)
-            
-            # 只保留最近30天的数据
-            cutoff_date = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
-            filtered_stats = {
-                date: stats.to_dict() 
-                for date, stats in self._daily_stats.items() 
-                if date >= cutoff_date
-            }
-            
-            data = {
-                "daily_stats": filtered_stats,
-                "last_updated": datetime.now().isoformat()
-            }
-            
-            with open(STATS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            logger.debug("统计数据已保存")
+            data = self._writer.load_day(date)
         except Exception as e:
-            logger.warning(f"保存统计数据失败: {e}")
+            logger.warning(f"加载 {date} 的统计数据失败: {e}")
+            return None
+        
+        with self._lock:
+            if date in self._daily_stats:
+                return self._daily_stats[date]
+            if data is None:
+                if len(self._missing_days) >= MAX_FROZEN_DAYS:
+                    # 只是避免重复读取文件的缓存，超出上限时清空即可
+                    self._missing_days.clear()
+                self._missing_days.add(date)
+                return None
+            self._daily_stats[date] = DailyStats.from_dict(data)
+            return self._daily_stats[date]
     
     def record_request(self, is_fallback: bool) -> None:
         """
-        记录一次请求
+        记录一次请求（只追加到缓冲区，由 aggregate() 批量合并）
         
         Args:
             is_fallback: 是否是回退请求
         """
-        now = time.time()
-        record = RequestRecord(timestamp=now, is_fallback=is_fallback)
+        self._events.append((time.time(), is_fallback, 0, 0, False, False, False, "", None, None, None, None))
+    
+    def record_context(self, ctx: RequestContext) -> None:
+        """
+        根据请求上下文记录一次请求（只追加到缓冲区，由 aggregate() 批量合并）
         
+        Args:
+            ctx: 请求处理完成后的路由上下文
+        """
+        # 缓存命中和合并到相同请求的请求没有单独访问上游，不计入延迟
+        latencies = None if ctx.cache_hit or ctx.coalesced else ctx.latencies()
+        self._events.append((
+            time.time(), ctx.is_fallback, ctx.bytes_in, ctx.bytes_out, ctx.hedged, ctx.cache_hit, ctx.coalesced,
+            ctx.model, ctx.fallback_reason, latencies, ctx.usage or None, ctx.steps or None
+        ))
+    
+    def aggregate(self) -> int:
+        """
+        把缓冲区中的事件合并进每日/小时统计和待发布增量
+        
+        Returns:
+            本次合并的事件数
+        """
         with self._lock:
-            self._records.append(record)
-            
-            # 更新总计数器
-            if is_fallback:
-                self._total_fallback += 1
-                logger.debug(f"记录回退请求，总回退数: {self._total_fallback}")
-            else:
-                self._total_normal += 1
-                logger.debug(f"记录正常请求，总正常数: {self._total_normal}")
-            
-            # 更新每日统计
-            today = self._get_today()
-            hour = self._get_current_hour()
-            daily_stats = self._ensure_daily_stats(today)
-            
-            daily_stats.total_requests += 1
-            if is_fallback:
-                daily_stats.total_fallback += 1
-            else:
-                daily_stats.total_normal += 1
+            return self._aggregate()
+    
+    def _set_bucket(self, timestamp: float) -> None:
+        """计算时间戳所在小时的范围和日期/小时字符串"""
+        start = datetime.fromtimestamp(timestamp).replace(minute=0, second=0, microsecond=0)
+        self._bucket_start = start.timestamp()
+        self._bucket_end = (start + timedelta(hours=1)).timestamp()
+        self._bucket_date = start.strftime("%Y-%m-%d")
+        self._bucket_hour = start.strftime("%H")
+    
+    def _apply_hour(self, counts: List[int]) -> None:
+        """把同一小时内按 HOUR_FIELDS 排列的计数合并进当前小时（调用方需持有锁）"""
+        normal, fallback, prompt, completion, wasted = counts
+        if not normal and not fallback:
+            return
+        self._total_normal += normal
+        self._total_fallback += fallback
+        
+        daily_stats = self._ensure_daily_stats(self._bucket_date)
+        daily_stats.total_requests += normal + fallback
+        daily_stats.total_normal += normal
+        daily_stats.total_fallback += fallback
+        daily_stats.prompt_tokens += prompt
+        daily_stats.completion_tokens += completion
+        daily_stats.wasted_tokens += wasted
+        
+        hourly = daily_stats.hourly_stats.setdefault(self._bucket_hour, {"total": 0})
+        hourly["total"] += normal + fallback
+        for name, value in zip(HOUR_FIELDS, counts):
+            hourly[name] = hourly.get(name, 0) + value
+        
+        add_counts(self._delta.hours, (self._bucket_date, self._bucket_hour), counts)
+    
+    def _model_label(self, model: str) -> str:
+        """限制模型维度的基数（调用方需持有锁）"""
+        model = model or "unknown"
+        if model not in self._models:
+            if len(self._models) >= MAX_MODELS:
+                return "other"
+            self._models.add(model)
+        return model
+    
+    def _add_timing(self, operation: str, seconds: float) -> None:
+        timing = self._persist_timings.setdefault(operation, [0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+    
+    def _apply_second(self, second: int, counts: List[int]) -> None:
+        """把同一秒内按 SECOND_FIELDS 排列的计数合并进滚动窗口和待发布增量（调用方需持有锁）"""
+        if second < 0:
+            return
+        self._rolling.add(second, counts)
+        add_counts(self._delta.seconds, second, counts)
+    
+    def _apply_usage(
+        self,
+        upstream: str,
+        model: str,
+        usage: Dict[str, Tuple[int, int]],
+        latencies: Optional[Dict[str, Optional[float]]]
+    ) -> Tuple[int, int, int]:
+        """
+        按生成响应的上游和模型累计 token（调用方需持有锁）
+        
+        Returns:
+            (最终响应的提示 token, 最终响应的补全 token, 被丢弃的 token)
+        """
+        prompt = completion = wasted = 0
+        for tier, (tier_prompt, tier_completion) in usage.items():
+            counts = self._token_counts.get((tier, model))
+            if counts is None:
+                counts = self._token_counts[(tier, model)] = [0, 0, 0, 0, 0.0]
+            if tier != upstream:
+                counts[2] += tier_prompt
+                counts[3] += tier_completion
+                wasted += tier_prompt + tier_completion
+                continue
+            counts[0] += tier_prompt
+            counts[1] += tier_completion
+            prompt, completion = tier_prompt, tier_completion
+            # 生成耗时：从收到首个数据块到请求结束
+            if latencies is not None and latencies["first_byte"] is not None and tier_completion:
+                counts[4] += max(latencies["total"] - latencies["first_byte"], 0.0)
+        return prompt, completion, wasted
+    
+    def _aggregate(self) -> int:
+        """合并缓冲区中的事件（调用方需持有锁）"""
+        events = self._events
+        count = len(events)
+        if count == 0:
+            return 0
+        
+        popleft = events.popleft
+        request_counts = self._request_counts
+        current_second = -1
+        second_counts = [0] * len(SECOND_FIELDS)
+        hour_counts = [0] * len(HOUR_FIELDS)
+        bytes_in = bytes_out = hedged = cached = coalesced = 0
+        
+        for _ in range(count):
+            (timestamp, is_fallback, size_in, size_out, is_hedged, is_cached, is_coalesced,
+             model, fallback_reason, latencies, usage, steps) = popleft()
+            if not self._bucket_start <= timestamp < self._bucket_end:
+                # 跨小时：先合并上一小时的计数
+                self._apply_hour(hour_counts)
+                hour_counts = [0] * len(HOUR_FIELDS)
+                self._set_bucket(timestamp)
             
-            # 更新小时统计
-            if hour not in daily_stats.hourly_stats:
-                daily_stats.hourly_stats[hour] = {"total": 0, "normal": 0, "fallback": 0}
-            daily_stats.hourly_stats[hour]["total"] += 1
-            if is_fallback:
-                daily_stats.hourly_stats[hour]["fallback"] += 1
-            else:
-                daily_stats.hourly_stats[hour]["normal"] += 1
+            second = int(timestamp)
+            if second != current_second:
+                self._apply_second(current_second, second_counts)
+                current_second = second
+                second_counts = [0] * len(SECOND_FIELDS)
             
-            # 清理过期记录
-            self._cleanup_old_records(now)
+            hour_counts[is_fallback] += 1
+            second_counts[is_fallback] += 1
+            bytes_in += size_in
+            bytes_out += size_out
+            hedged += is_hedged
+            cached += is_cached
+            coalesced += is_coalesced
             
-            # 尝试保存数据
-            self._save_data()
+            upstream = UPSTREAM_FALLBACK if is_fallback else UPSTREAM_NORMAL
+            model = self._model_label(model)
+            key = (upstream, model, fallback_reason or "none")
+            request_counts[key] = request_counts.get(key, 0) + 1
+            if latencies is not None:
+                self._latency.record(upstream, model, latencies)
+            if steps is not None:
+                self._steps.record(upstream, steps)
+            if usage is not None:
+                prompt, completion, wasted = self._apply_usage(upstream, model, usage, latencies)
+                hour_counts[2] += prompt
+                hour_counts[3] += completion
+                hour_counts[4] += wasted
+                second_counts[2] += prompt
+                second_counts[3] += completion
+        
+        self._apply_second(current_second, second_counts)
+        self._apply_hour(hour_counts)
+        self._bytes_in += bytes_in
+        self._bytes_out += bytes_out
+        self._total_hedged += hedged
+        self._total_cached += cached
+        self._total_coalesced += coalesced
+        self._delta.add_total("bytes_in", bytes_in)
+        self._delta.add_total("bytes_out", bytes_out)
+        self._delta.add_total("hedged", hedged)
+        self._delta.add_total("cached", cached)
+        self._delta.add_total("coalesced", coalesced)
+        return count
+    
+    def persist(self) -> None:
+        """合并事件缓冲区并把累积的小时增量交给后台写入线程（合并事件较多时耗时，应在线程池中调用）"""
+        if self._writer is None:
+            return
+        with self._lock:
+            self._aggregate()
+            delta, self._delta = self._delta, StatsDelta()
+        self._writer.submit(delta.hours)
+    
+    def close(self) -> None:
+        """持久化剩余数据并停止后台写入（会阻塞，关闭时调用）"""
+        if self._store is not None:
+            self.publish()
+        elif self._writer is not None:
+            self.persist()
+            self._writer.close()
+    
+    def publish(self, components: Optional[dict] = None) -> None:
+        """
+        把累积的增量写入共享存储（会阻塞，应在后台线程中调用）
+        
+        Args:
+            components: 本 worker 组件状态快照，供仪表板展示
+        """
+        if self._store is None:
+            return
+        
+        with self._lock:
+            self._aggregate()
+            delta, self._delta = self._delta, StatsDelta()
+        
+        try:
+            start = time.perf_counter()
+            self._store.publish(delta, self._pid, self._start_time, components)
+            with self._lock:
+                self._add_timing("publish", time.perf_counter() - start)
+        except Exception as e:
+            logger.warning(f"发布统计数据失败: {e}")
+            # 写入失败的增量合并回去，下次重试
+            with self._lock:
+                self._delta.merge(delta)
+    
+    def get_published_components(self) -> dict:
+        """获取最近一次由存活 worker 发布的组件状态快照"""
+        if self._store is None:
+            return {}
+        alive = [w for w in self._store.get_workers() if w["alive"] and w["components"]]
+        if not alive:
+            return {}
+        return max(alive, key=lambda w: w["updated_at"])["components"]
     
-    def _cleanup_old_records(self, now: float) -> None:
-        """清理超出窗口的旧记录"""
-        cutoff = now - self.window_seconds
-        while self._records and self._records[0].timestamp < cutoff:
-            self._records.popleft()
+    def get_workers(self) -> List[dict]:
+        """获取共享存储中各 worker 的状态（不含组件快照）"""
+        if self._store is None:
+            return []
+        return [
+            {key: value for key, value in worker.items() if key != "components"}
+            for worker in self._store.get_workers()
+        ]
+    
+    def metrics_snapshot(self) -> dict:
+        """
+        获取本进程的计数器和直方图副本，供 /metrics 在锁外渲染
+        
+        Returns:
+            请求计数、token 计数、流量计数、延迟直方图、处理步骤耗时直方图和统计持久化耗时
+        """
+        with self._lock:
+            self._aggregate()
+            timings = {operation: tuple(timing) for operation, timing in self._persist_timings.items()}
+            snapshot = {
+                "requests": dict(self._request_counts),
+                "tokens": {key: tuple(counts) for key, counts in self._token_counts.items()},
+                "bytes_in": self._bytes_in,
+                "bytes_out": self._bytes_out,
+                "hedged": self._total_hedged,
+                "cached": self._total_cached,
+                "coalesced": self._total_coalesced,
+                "latency": self._latency.copy(),
+                "steps": self._steps.copy()
+            }
+        if self._writer is not None:
+            timings.update(self._writer.timings())
+        snapshot["persist_timings"] = timings
+        return snapshot
+    
+    def token_snapshot(self) -> List[dict]:
+        """获取本进程按生成响应的上游和模型统计的 token 用量与生成速度"""
+        with self._lock:
+            self._aggregate()
+            items = sorted(self._token_counts.items())
+        return [
+            {
+                "upstream": upstream,
+                "model": model,
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "wasted_prompt_tokens": wasted_prompt,
+                "wasted_completion_tokens": wasted_completion,
+                # 平均生成速度：补全 token 数 / 从首个数据块到结束的耗时
+                "tokens_per_second": round(completion / generation, 2) if generation > 0 else None
+            }
+            for (upstream, model), (prompt, completion, wasted_prompt, wasted_completion, generation) in items
+        ]
+    
+    def latency_snapshot(self) -> dict:
+        """获取本进程各阶段延迟的分位数（按上游和模型分组）以及各处理步骤耗时的分位数（按上游分组）"""
+        with self._lock:
+            self._aggregate()
+            snapshot = self._latency.snapshot()
+            snapshot["steps"] = self._steps.snapshot()
+            return snapshot
     
     def get_stats(self) -> dict:
         """
@@ -226,46 +607,157 @@ class RequestStats:
         """
         now = time.time()
         
+        if self._store is not None:
+            # 多 worker 合并后的数据
+            counters = self._store.get_counters(self.windows)
+            totals = counters["totals"]
+            started_at = counters["started_at"] or self._start_time
+            today = counters["today"]
+            return self._build_stats(
+                today["normal"], today["fallback"],
+                counters["windows"],
+                {name: today[name] for name in HOUR_FIELDS[2:]},
+                totals.get("bytes_in", 0), totals.get("bytes_out", 0),
+                totals.get("hedged", 0), totals.get("cached", 0), totals.get("coalesced", 0),
+                now - started_at
+            )
+        
         with self._lock:
-            self._cleanup_old_records(now)
-            
-            # 计算窗口内的请求数
-            window_normal = sum(1 for r in self._records if not r.is_fallback)
-            window_fallback = sum(1 for r in self._records if r.is_fallback)
-            window_total = len(self._records)
+            self._aggregate()
             
-            # 计算 RPM（每分钟请求数）
-            # 基于窗口时间计算
-            rpm_normal = window_normal * (60 / self.window_seconds)
-            rpm_fallback = window_fallback * (60 / self.window_seconds)
-            rpm_total = window_total * (60 / self.window_seconds)
+            # 各窗口内的请求数和 token 数
+            windows = {window: self._rolling.get(window, now) for window in self.windows}
+            today = self._daily_stats.get(self._get_today())
+            today_tokens = {name: getattr(today, name, 0) for name in HOUR_FIELDS[2:]}
             
-            # 计算回退率
-            total_requests = self._total_normal + self._total_fallback
-            fallback_rate = (self._total_fallback / total_requests * 100) if total_requests > 0 else 0
-            
-            # 窗口内的回退率
-            window_fallback_rate = (window_fallback / window_total * 100) if window_total > 0 else 0
-            
-            # 运行时间
-            uptime_seconds = now - self._start_time
-            
-            return {
-                "total_requests": total_requests,
-                "total_normal": self._total_normal,
-                "total_fallback": self._total_fallback,
-                "fallback_rate": round(fallback_rate, 2),
-                "window_seconds": self.window_seconds,
-                "window_normal": window_normal,
-                "window_fallback": window_fallback,
-                "window_total": window_total,
-                "window_fallback_rate": round(window_fallback_rate, 2),
-                "rpm_normal": round(rpm_normal, 2),
-                "rpm_fallback": round(rpm_fallback, 2),
-                "rpm_total": round(rpm_total, 2),
-                "uptime_seconds": round(uptime_seconds, 0),
-                "uptime_formatted": self._format_uptime(uptime_seconds)
-            }
+            return self._build_stats(
+                self._total_normal, self._total_fallback,
+                windows,
+                today_tokens,
+                self._bytes_in, self._bytes_out,
+                self._total_hedged, self._total_cached, self._total_coalesced,
+                now - self._start_time
+            )
+    
+    def _build_stats(
+        self,
+        total_normal: int,
+        total_fallback: int,
+        windows: Dict[int, Tuple[int, ...]],
+        today_tokens: Dict[str, int],
+        bytes_in: int,
+        bytes_out: int,
+        total_hedged: int,
+        total_cached: int,
+        total_coalesced: int,
+        uptime_seconds: float
+    ) -> dict:
+        """根据计数生成统计数据字典"""
+        window_normal, window_fallback, window_prompt, window_completion = windows[self.window_seconds]
+        window_total = window_normal + window_fallback
+        
+        # 计算 RPM（每分钟请求数）
+        # 基于窗口时间计算
+        rpm_normal = window_normal * (60 / self.window_seconds)
+        rpm_fallback = window_fallback * (60 / self.window_seconds)
+        rpm_total = window_total * (60 / self.window_seconds)
+        
+        # 计算回退率
+        total_requests = total_normal + total_fallback
+        fallback_rate = (total_fallback / total_requests * 100) if total_requests > 0 else 0
+        
+        # 窗口内的回退率
+        window_fallback_rate = (window_fallback / window_total * 100) if window_total > 0 else 0
+        
+        # 各窗口（1m/5m/15m）的 RPM
+        rpm_windows = []
+        for window, (normal, fallback, prompt, completion) in sorted(windows.items()):
+            total = normal + fallback
+            rpm_windows.append({
+                "window_seconds": window,
+                "total": total,
+                "normal": normal,
+                "fallback": fallback,
+                "rpm_total": round(total * 60 / window, 2),
+                "rpm_normal": round(normal * 60 / window, 2),
+                "rpm_fallback": round(fallback * 60 / window, 2),
+                "fallback_rate": round(fallback / total * 100, 2) if total > 0 else 0,
+                "prompt_tokens_per_second": round(prompt / window, 2),
+                "completion_tokens_per_second": round(completion / window, 2)
+            })
+        
+        return {
+            "total_requests": total_requests,
+            "total_normal": total_normal,
+            "total_fallback": total_fallback,
+            "fallback_rate": round(fallback_rate, 2),
+            "window_seconds": self.window_seconds,
+            "window_normal": window_normal,
+            "window_fallback": window_fallback,
+            "window_total": window_total,
+            "window_fallback_rate": round(window_fallback_rate, 2),
+            "rpm_normal": round(rpm_normal, 2),
+            "rpm_fallback": round(rpm_fallback, 2),
+            "rpm_total": round(rpm_total, 2),
+            "rpm_windows": rpm_windows,
+            "tokens": {
+                "today": today_tokens,
+                "prompt_tokens_per_second": round(window_prompt / self.window_seconds, 2),
+                "completion_tokens_per_second": round(window_completion / self.window_seconds, 2)
+            },
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "total_hedged": total_hedged,
+            "total_cached": total_cached,
+            "total_coalesced": total_coalesced,
+            "uptime_seconds": round(uptime_seconds, 0),
+            "uptime_formatted": self._format_uptime(uptime_seconds)
+        }
+    
+    def _stored_daily_stats(self, date: str) -> Optional[DailyStats]:
+        """从共享存储读取指定日期的统计"""
+        hourly = self._store.get_hourly(date)
+        if not hourly:
+            return None
+        normal = sum(h["normal"] for h in hourly.values())
+        fallback = sum(h["fallback"] for h in hourly.values())
+        return DailyStats(
+            date=date,
+            total_requests=normal + fallback,
+            total_normal=normal,
+            total_fallback=fallback,
+            prompt_tokens=sum(h["prompt_tokens"] for h in hourly.values()),
+            completion_tokens=sum(h["completion_tokens"] for h in hourly.values()),
+            wasted_tokens=sum(h["wasted_tokens"] for h in hourly.values()),
+            hourly_stats=hourly
+        )
+    
+    def _load_daily_dict(self, date: str) -> Optional[dict]:
+        """读取指定日期的统计（不经过历史缓存）"""
+        if self._store is not None:
+            daily = self._stored_daily_stats(date)
+        else:
+            self.aggregate()
+            daily = self._load_day(date)
+        if daily is None:
+            return None
+        
+        with self._lock:
+            data = daily.to_dict()
+            # 复制小时统计，今天的数据在锁外序列化时仍可能被聚合器修改
+            data["hourly_stats"] = {hour: dict(counts) for hour, counts in daily.hourly_stats.items()}
+            return data
+    
+    def daily_entry(self, date: str) -> Optional[HistoryEntry]:
+        """
+        获取指定日期的统计及其序列化结果和 ETag
+        
+        已结束的日期只计算一次，之后直接复用
+        
+        Args:
+            date: 日期字符串，格式 YYYY-MM-DD
+        """
+        return self._history.day(date)
     
     def get_daily_stats(self, date: str) -> Optional[dict]:
         """
@@ -277,10 +769,16 @@ class RequestStats:
         Returns:
             当天的统计数据，如果不存在返回 None
         """
-        with self._lock:
-            if date in self._daily_stats:
-                return self._daily_stats[date].to_dict()
-            return None
+        entry = self._history.day(date)
+        return entry.data if entry is not None else None
+    
+    def recent_days_entry(self, days: int = 30) -> HistoryEntry:
+        """
+        获取近N天的统计概览及其序列化结果和 ETag
+        
+        只有今天的数据重新计算，其余日期复用已序列化的字节
+        """
+        return self._history.recent(days)
     
     def get_recent_days_stats(self, days: int = 30) -> List[dict]:
         """
@@ -290,28 +788,9 @@ class RequestStats:
             days: 天数
             
         Returns:
-            统计数据列表，按日期降序排列
+            统计数据列表，按日期降序排列（没有数据的日期也返回，方便前端展示）
         """
-        with self._lock:
-            result = []
-            today = datetime.now()
-            
-            for i in range(days):
-                date = (today - timedelta(days=i)).strftime("%Y-%m-%d")
-                if date in self._daily_stats:
-                    result.append(self._daily_stats[date].to_dict())
-                else:
-                    # 没有数据的日期也返回，方便前端展示
-                    result.append({
-                        "date": date,
-                        "total_requests": 0,
-                        "total_normal": 0,
-                        "total_fallback": 0,
-                        "fallback_rate": 0,
-                        "hourly_stats": {}
-                    })
-            
-            return result
+        return self._history.recent(days).data
     
     def _format_uptime(self, seconds: float) -> str:
         """格式化运行时间"""
@@ -0,0 +1,263 @@
+"""
+共享统计存储模块
+多 worker 部署时，各 worker 定期把统计增量写入同一个 SQLite（WAL 模式）数据库，
+仪表板从数据库读取合并后的数据
+"""
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.codec import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# 秒级计数保留时长（秒），用于计算窗口内的 RPM
+SECONDS_RETENTION = 3600
+
+# worker 超过该时长（秒）未发布数据即视为已退出
+WORKER_TIMEOUT = 15
+
+# 小时增量的各列：wasted_tokens 为被丢弃的正常上游响应消耗的 token
+HOUR_FIELDS = ("normal", "fallback", "prompt_tokens", "completion_tokens", "wasted_tokens")
+# 秒级增量的各列
+SECOND_FIELDS = ("normal", "fallback", "prompt_tokens", "completion_tokens")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hourly (
+    date TEXT NOT NULL,
+    hour TEXT NOT NULL,
+    normal INTEGER NOT NULL DEFAULT 0,
+    fallback INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    wasted_tokens INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (date, hour)
+);
+CREATE TABLE IF NOT EXISTS seconds (
+    ts INTEGER PRIMARY KEY,
+    normal INTEGER NOT NULL DEFAULT 0,
+    fallback INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS totals (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS workers (
+    pid INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    components TEXT
+);
+"""
+
+
+def add_counts(target: Dict, key, counts: List[int]) -> None:
+    """把一组计数逐列累加到 target[key]"""
+    pending = target.get(key)
+    if pending is None:
+        target[key] = list(counts)
+    else:
+        for i, value in enumerate(counts):
+            pending[i] += value
+
+
+@dataclass
+class StatsDelta:
+    """两次发布之间累积的统计增量"""
+    # (日期, 小时) -> 按 HOUR_FIELDS 排列的计数
+    hours: Dict[Tuple[str, str], List[int]] = field(default_factory=dict)
+    # 秒级时间戳 -> 按 SECOND_FIELDS 排列的计数
+    seconds: Dict[int, List[int]] = field(default_factory=dict)
+    # 计数器名称 -> 增量
+    totals: Dict[str, int] = field(default_factory=dict)
+
+    def add_total(self, name: str, value: int) -> None:
+        """累加计数器"""
+        if value:
+            self.totals[name] = self.totals.get(name, 0) + value
+
+    def merge(self, other: 'StatsDelta') -> None:
+        """合并另一个增量"""
+        for key, counts in other.hours.items():
+            add_counts(self.hours, key, counts)
+        for key, counts in other.seconds.items():
+            add_counts(self.seconds, key, counts)
+        for name, value in other.totals.items():
+            self.add_total(name, value)
+
+    def is_empty(self) -> bool:
+        return not (self.hours or self.seconds or self.totals)
+
+
+def _upsert_sql(table: str, keys: Tuple[str, ...], fields: Tuple[str, ...]) -> str:
+    """生成按主键累加各列的 INSERT 语句"""
+    columns = keys + fields
+    updates = ", ".join(f"{name} = {name} + excluded.{name}" for name in fields)
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT({', '.join(keys)}) DO UPDATE SET {updates}"
+    )
+
+
+class SQLiteStatsStore:
+    """
+    基于 SQLite WAL 的共享统计存储
+
+    写入只在后台线程中进行（由调用方通过 asyncio.to_thread 等方式保证），
+    同一进程内的连接由锁保护
+    """
+
+    def __init__(self, path: str):
+        """
+        初始化共享存储
+
+        Args:
+            path: 数据库文件路径
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+        logger.info(f"已连接共享统计数据库: {path}")
+
+    def _migrate(self) -> None:
+        """为旧版数据库补充 token 列"""
+        for table, fields in (("hourly", HOUR_FIELDS), ("seconds", SECOND_FIELDS)):
+            columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for name in fields:
+                if name not in columns:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0")
+
+    def publish(
+        self,
+        delta: StatsDelta,
+        pid: int,
+        started_at: float,
+        components: Optional[dict] = None
+    ) -> None:
+        """
+        写入一个 worker 的统计增量（单个事务）
+
+        Args:
+            delta: 统计增量
+            pid: worker 进程 ID
+            started_at: worker 启动时间
+            components: worker 本地组件（断路器、连接池等）的状态快照
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.executemany(
+                    _upsert_sql("hourly", ("date", "hour"), HOUR_FIELDS),
+                    [(date, hour, *counts) for (date, hour), counts in delta.hours.items()]
+                )
+                cursor.executemany(
+                    _upsert_sql("seconds", ("ts",), SECOND_FIELDS),
+                    [(ts, *counts) for ts, counts in delta.seconds.items()]
+                )
+                cursor.executemany(
+                    "INSERT INTO totals (name, value) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    list(delta.totals.items())
+                )
+                cursor.execute("DELETE FROM seconds WHERE ts < ?", (int(now) - SECONDS_RETENTION,))
+                cursor.execute(
+                    "INSERT INTO workers (pid, started_at, updated_at, components) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(pid) DO UPDATE SET started_at = excluded.started_at, "
+                    "updated_at = excluded.updated_at, components = excluded.components",
+                    (pid, started_at, now, dumps(components).decode("utf-8") if components is not None else None)
+                )
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get_counters(self, windows: Sequence[int]) -> dict:
+        """
+        获取合并后的计数
+
+        Args:
+            windows: 需要统计的窗口大小（秒），一次查询得出
+
+        Returns:
+            今日各列（HOUR_FIELDS）的合计、各窗口内按 SECOND_FIELDS 排列的计数、累计计数器、
+            存活 worker 的最早启动时间
+        """
+        now = time.time()
+        today = datetime.now().strftime("%Y-%m-%d")
+        today_row = self._query(
+            f"SELECT {', '.join(f'COALESCE(SUM({name}), 0)' for name in HOUR_FIELDS)} "
+            "FROM hourly WHERE date = ?",
+            (today,)
+        )[0]
+        columns = ", ".join(
+            f"COALESCE(SUM(CASE WHEN ts > ? THEN {name} END), 0)"
+            for _ in windows
+            for name in SECOND_FIELDS
+        )
+        cutoffs = [int(now) - window for window in windows]
+        width = len(SECOND_FIELDS)
+        window_row = self._query(
+            f"SELECT {columns} FROM seconds WHERE ts > ?",
+            tuple(cutoff for cutoff in cutoffs for _ in range(width)) + (min(cutoffs),)
+        )[0]
+        totals = dict(self._query("SELECT name, value FROM totals"))
+        started_row = self._query(
+            "SELECT MIN(started_at) FROM workers WHERE updated_at >= ?",
+            (now - WORKER_TIMEOUT,)
+        )[0]
+        return {
+            "today": dict(zip(HOUR_FIELDS, today_row)),
+            "windows": {
+                window: tuple(window_row[i * width:(i + 1) * width])
+                for i, window in enumerate(windows)
+            },
+            "totals": totals,
+            "started_at": started_row[0]
+        }
+
+    def get_hourly(self, date: str) -> Dict[str, Dict[str, int]]:
+        """获取指定日期各小时的统计"""
+        result = {}
+        for hour, *counts in self._query(
+            f"SELECT hour, {', '.join(HOUR_FIELDS)} FROM hourly WHERE date = ? ORDER BY hour", (date,)
+        ):
+            hourly = dict(zip(HOUR_FIELDS, counts))
+            hourly["total"] = hourly["normal"] + hourly["fallback"]
+            result[hour] = hourly
+        return result
+
+    def get_workers(self) -> List[dict]:
+        """获取所有 worker 的发布状态，按进程 ID 排序"""
+        now = time.time()
+        return [
+            {
+                "pid": pid,
+                "started_at": started_at,
+                "updated_at": updated_at,
+                "alive": now - updated_at < WORKER_TIMEOUT,
+                "components": loads(components) if components else None
+            }
+            for pid, started_at, updated_at, components in self._query(
+                "SELECT pid, started_at, updated_at, components FROM workers ORDER BY pid"
+            )
+        ]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -3,19 +3,85 @@ WebUI 仪表板
 提供美观的统计数据展示界面
 """
 import logging
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 import os
 
-from app.stats import get_stats
+from app.affinity import get_affinity
+from app.breaker import get_breaker
+from app.cache import get_response_cache
+from app.coalesce import get_coalescer
+from app.codec import FastJSONResponse
+from app.proxy import get_proxy
+from app.config import DASHBOARD_PUSH_INTERVAL, WEBUI_MODE
+from app.history import MAX_RECENT_DAYS, HistoryEntry, etag_matches, is_valid_date
+from app.live import LiveBroadcaster
+from app.stats import get_stats, DATA_DIR
 
 logger = logging.getLogger(__name__)
 
 # WebUI 端口
 WEBUI_PORT = int(os.getenv("WEBUI_PORT", "8004"))
 
+# 仪表板近 30 天历史的刷新间隔（秒）
+HISTORY_REFRESH_INTERVAL = 60
+
+# 多 worker 部署时用于选举唯一仪表板进程的锁文件
+WEBUI_LOCK_FILE = os.path.join(DATA_DIR, "webui.lock")
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - 非 Unix 平台只支持单进程
+    fcntl = None
+
+# 持有的锁文件句柄（进程存活期间保持打开）
+_lock_handle = None
+
+
+def acquire_webui_lock() -> bool:
+    """
+    尝试成为提供仪表板的进程
+    
+    使用非阻塞的 flock 排他锁，同一时间只有一个 worker 能持有；
+    持有锁的进程退出后，锁由操作系统自动释放，其他 worker 可以接管
+    
+    Returns:
+        True 如果当前进程持有锁
+    """
+    global _lock_handle
+    if _lock_handle is not None:
+        return True
+    if fcntl is None:
+        _lock_handle = True
+        return True
+    
+    os.makedirs(DATA_DIR, exist_ok=True)
+    handle = open(WEBUI_LOCK_FILE, "a")
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _lock_handle = handle
+    return True
+
+
+def collect_components() -> dict:
+    """获取当前进程各组件的状态快照"""
+    proxy = get_proxy()
+    return {
+        "breakers": get_breaker().snapshot(),
+        "affinity": get_affinity().snapshot(),
+        "response_cache": get_response_cache().snapshot(),
+        "coalescing": get_coalescer().snapshot(),
+        "pools": proxy.pool_snapshot(),
+        "endpoints": proxy.endpoint_snapshot(),
+        "latency": get_stats().latency_snapshot(),
+        "token_usage": get_stats().token_snapshot()
+    }
+
 app = FastAPI(
     title="Content Filter Dashboard",
     description="请求统计仪表板",
@@ -320,6 +386,29 @@ DASHBOARD_HTML = """
             color: var(--accent-danger);
         }
         
+        .state-badge {
+            display: inline-block;
+            padding: 0.25rem 0.75rem;
+            border-radius: 1rem;
+            font-size: 0.75rem;
+            font-weight: 600;
+        }
+        
+        .state-badge.closed {
+            background: rgba(16, 185, 129, 0.2);
+            color: var(--accent-success);
+        }
+        
+        .state-badge.half_open {
+            background: rgba(245, 158, 11, 0.2);
+            color: var(--accent-warning);
+        }
+        
+        .state-badge.open {
+            background: rgba(239, 68, 68, 0.2);
+            color: var(--accent-danger);
+        }
+        
         .view-detail-btn {
             background: linear-gradient(135deg, var(--accent-primary), var(--accent-secondary));
             color: white;
@@ -494,6 +583,7 @@ DASHBOARD_HTML = """
                     <div class="label"><span class="icon">🚀</span> 总 RPM</div>
                     <div class="value" id="rpm-total">-</div>
                     <div class="subtext">过去 60 秒的请求速率</div>
+                    <div class="subtext" id="rpm-windows">-</div>
                 </div>
                 
                 <div class="stat-card success">
@@ -516,6 +606,100 @@ DASHBOARD_HTML = """
             </div>
         </section>
         
+        <section>
+            <h2 class="section-title">🔢 Token 用量 (今日)</h2>
+            <div class="stats-grid">
+                <div class="stat-card primary">
+                    <div class="label"><span class="icon">📥</span> 提示 Token</div>
+                    <div class="value" id="prompt-tokens">-</div>
+                    <div class="subtext" id="prompt-tps">-</div>
+                </div>
+                
+                <div class="stat-card success">
+                    <div class="label"><span class="icon">📤</span> 补全 Token</div>
+                    <div class="value" id="completion-tokens">-</div>
+                    <div class="subtext" id="completion-tps">-</div>
+                </div>
+                
+                <div class="stat-card warning">
+                    <div class="label"><span class="icon">🗑️</span> 浪费的 Token</div>
+                    <div class="value" id="wasted-tokens">-</div>
+                    <div class="subtext">被丢弃的正常上游响应消耗的 Token</div>
+                </div>
+            </div>
+            
+            <div class="history-table-container">
+                <table class="history-table">
+                    <thead>
+                        <tr>
+                            <th>上游</th>
+                            <th>模型</th>
+                            <th>提示 Token</th>
+                            <th>补全 Token</th>
+                            <th>被丢弃的 Token</th>
+                            <th>生成速度 (token/s)</th>
+                        </tr>
+                    </thead>
+                    <tbody id="token-table-body">
+                        <tr>
+                            <td colspan="6" style="text-align: center; color: var(--text-muted);">加载中...</td>
+                        </tr>
+                    </tbody>
+                </table>
+            </div>
+        </section>
+        
+        <section class="history-section">
+            <h2 class="section-title">⏱️ 延迟分布 (毫秒)</h2>
+            
+            <div class="chart-container">
+                <canvas id="latencyChart" class="chart-canvas"></canvas>
+            </div>
+            
+            <div class="history-table-container">
+                <table class="history-table">
+                    <thead>
+                        <tr>
+                            <th>分组</th>
+                            <th>阶段</th>
+                            <th>样本数</th>
+                            <th>P50</th>
+                            <th>P95</th>
+                            <th>P99</th>
+                        </tr>
+                    </thead>
+                    <tbody id="latency-table-body">
+                        <tr>
+                            <td colspan="6" style="text-align: center; color: var(--text-muted);">加载中...</td>
+                        </tr>
+                    </tbody>
+                </table>
+            </div>
+        </section>
+        
+        <section class="history-section">
+            <h2 class="section-title">🛡️ 断路器状态</h2>
+            <div class="history-table-container">
+                <table class="history-table">
+                    <thead>
+                        <tr>
+                            <th>模型</th>
+                            <th>状态</th>
+                            <th>窗口空响应率</th>
+                            <th>样本数</th>
+                            <th>直接回退次数</th>
+                            <th>已打开</th>
+                        </tr>
+                    </thead>
+                    <tbody id="breaker-table-body">
+                        <tr>
+                            <td colspan="6" style="text-align: center; color: var(--text-muted);">加载中...</td>
+                        </tr>
+                    </tbody>
+                </table>
+            </div>
+        </section>
+        
         <section class="history-section">
             <h2 class="section-title">📅 近30天历史统计</h2>
             
@@ -556,6 +740,22 @@ DASHBOARD_HTML = """
     <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
     <script>
         let historyChart = null;
+        let latencyChart = null;
+        
+        const upstreamNames = { normal: '正常', fallback: '回退' };
+        const phaseNames = {
+            connect: '响应头',
+            first_byte: '上游首字节',
+            first_client_byte: '客户端首字节',
+            total: '总耗时',
+            fallback_delay: '回退延迟',
+            parse: '步骤·解析请求',
+            mapping: '步骤·模型映射',
+            pool_wait: '步骤·等待连接池',
+            upstream_ttfb: '步骤·上游响应头',
+            decision: '步骤·回退判断',
+            respond: '步骤·输出响应'
+        };
         
         async function fetchStats() {
             try {
@@ -567,6 +767,30 @@ DASHBOARD_HTML = """
             }
         }
         
+        // 实时推送的完整状态，每次推送只包含变化的字段
+        const liveState = {};
+        
+        function connectLive() {
+            const source = new EventSource('/api/live');
+            source.onmessage = (event) => {
+                const changed = JSON.parse(event.data);
+                if (changed.recent_days !== undefined) {
+                    updateHistoryTable(changed.recent_days);
+                    updateHistoryChart(changed.recent_days);
+                    delete changed.recent_days;
+                }
+                if (Object.keys(changed).length === 0) {
+                    return;
+                }
+                Object.assign(liveState, changed);
+                updateUI(liveState);
+            };
+            source.onerror = () => {
+                // EventSource 会自动重连，重连后先收到完整快照
+                console.error('实时推送连接中断，正在重连');
+            };
+        }
+        
         async function fetchRecentDays() {
             try {
                 const response = await fetch('/api/recent-days?days=30');
@@ -598,6 +822,164 @@ DASHBOARD_HTML = """
             document.getElementById('rpm-normal').textContent = formatNumber(data.rpm_normal);
             document.getElementById('rpm-fallback').textContent = formatNumber(data.rpm_fallback);
             document.getElementById('window-fallback-rate').textContent = data.window_fallback_rate + '%';
+            document.getElementById('rpm-windows').textContent = (data.rpm_windows || [])
+                .map(w => `${w.window_seconds / 60}m: ${formatNumber(w.rpm_total)}`)
+                .join(' · ');
+            
+            // 更新 Token 用量
+            const tokens = data.tokens || {};
+            const todayTokens = tokens.today || {};
+            document.getElementById('prompt-tokens').textContent = formatNumber(todayTokens.prompt_tokens || 0);
+            document.getElementById('completion-tokens').textContent = formatNumber(todayTokens.completion_tokens || 0);
+            document.getElementById('wasted-tokens').textContent = formatNumber(todayTokens.wasted_tokens || 0);
+            document.getElementById('prompt-tps').textContent = `${tokens.prompt_tokens_per_second || 0} token/s (过去 ${data.window_seconds} 秒)`;
+            document.getElementById('completion-tps').textContent = `${tokens.completion_tokens_per_second || 0} token/s (过去 ${data.window_seconds} 秒)`;
+            updateTokenTable(data.token_usage || []);
+            
+            // 更新延迟分布
+            updateLatency(data.latency || { upstreams: {}, models: {} });
+            
+            // 更新断路器状态
+            updateBreakerTable(data.breakers || []);
+        }
+        
+        function updateTokenTable(rows) {
+            const tbody = document.getElementById('token-table-body');
+            if (rows.length === 0) {
+                tbody.innerHTML = '<tr><td colspan="6" style="text-align: center; color: var(--text-muted);">暂无数据</td></tr>';
+                return;
+            }
+            tbody.innerHTML = rows.map(r => `
+                <tr>
+                    <td><strong>${upstreamNames[r.upstream] || r.upstream}</strong></td>
+                    <td>${escapeHtml(r.model)}</td>
+                    <td>${formatNumber(r.prompt_tokens)}</td>
+                    <td>${formatNumber(r.completion_tokens)}</td>
+                    <td>${formatNumber(r.wasted_prompt_tokens + r.wasted_completion_tokens)}</td>
+                    <td>${r.tokens_per_second === null ? '-' : r.tokens_per_second}</td>
+                </tr>
+            `).join('');
+        }
+        
+        function latencyRows(latency) {
+            // 按上游展示全部阶段，按模型只展示总耗时和客户端首字节，最后是按上游的处理步骤
+            const rows = [];
+            for (const [upstream, phases] of Object.entries(latency.upstreams)) {
+                for (const [phase, h] of Object.entries(phases)) {
+                    rows.push({ group: upstreamNames[upstream] || upstream, phase, h });
+                }
+            }
+            for (const [model, phases] of Object.entries(latency.models)) {
+                for (const phase of ['first_client_byte', 'total']) {
+                    if (phases[phase]) {
+                        rows.push({ group: model, phase, h: phases[phase] });
+                    }
+                }
+            }
+            // 处理步骤耗时（亚毫秒精度）只在表格中展示
+            for (const [upstream, steps] of Object.entries(latency.steps || {})) {
+                for (const [step, h] of Object.entries(steps)) {
+                    rows.push({ group: upstreamNames[upstream] || upstream, phase: step, h });
+                }
+            }
+            return rows;
+        }
+        
+        function updateLatency(latency) {
+            const rows = latencyRows(latency);
+            const tbody = document.getElementById('latency-table-body');
+            if (rows.length === 0) {
+                tbody.innerHTML = '<tr><td colspan="6" style="text-align: center; color: var(--text-muted);">暂无数据</td></tr>';
+            } else {
+                tbody.innerHTML = rows.map(r => `
+                    <tr>
+                        <td><strong>${escapeHtml(r.group)}</strong></td>
+                        <td>${phaseNames[r.phase] || r.phase}</td>
+                        <td>${formatNumber(r.h.count)}</td>
+                        <td>${r.h.p50}</td>
+                        <td>${r.h.p95}</td>
+                        <td>${r.h.p99}</td>
+                    </tr>
+                `).join('');
+            }
+            
+            // 图表只展示按上游分组的各阶段分位数
+            const chartRows = [];
+            for (const [upstream, phases] of Object.entries(latency.upstreams)) {
+                for (const [phase, h] of Object.entries(phases)) {
+                    chartRows.push({ label: `${upstreamNames[upstream] || upstream}·${phaseNames[phase] || phase}`, h });
+                }
+            }
+            const labels = chartRows.map(r => r.label);
+            const datasets = [
+                { label: 'P50', data: chartRows.map(r => r.h.p50), backgroundColor: 'rgba(16, 185, 129, 0.6)' },
+                { label: 'P95', data: chartRows.map(r => r.h.p95), backgroundColor: 'rgba(245, 158, 11, 0.6)' },
+                { label: 'P99', data: chartRows.map(r => r.h.p99), backgroundColor: 'rgba(239, 68, 68, 0.6)' }
+            ];
+            
+            if (latencyChart) {
+                // 原地更新，避免每秒重建图表
+                latencyChart.data.labels = labels;
+                latencyChart.data.datasets.forEach((dataset, i) => { dataset.data = datasets[i].data; });
+                latencyChart.update('none');
+                return;
+            }
+            
+            latencyChart = new Chart(document.getElementById('latencyChart').getContext('2d'), {
+                type: 'bar',
+                data: { labels, datasets },
+                options: {
+                    responsive: true,
+                    maintainAspectRatio: false,
+                    plugins: {
+                        legend: {
+                            labels: {
+                                color: '#94a3b8'
+                            }
+                        }
+                    },
+                    scales: {
+                        x: {
+                            grid: {
+                                color: 'rgba(255, 255, 255, 0.05)'
+                            },
+                            ticks: {
+                                color: '#64748b'
+                            }
+                        },
+                        y: {
+                            type: 'logarithmic',
+                            grid: {
+                                color: 'rgba(255, 255, 255, 0.05)'
+                            },
+                            ticks: {
+                                color: '#64748b'
+                            }
+                        }
+                    }
+                }
+            });
+        }
+        
+        function updateBreakerTable(breakers) {
+            const tbody = document.getElementById('breaker-table-body');
+            
+            if (breakers.length === 0) {
+                tbody.innerHTML = '<tr><td colspan="6" style="text-align: center; color: var(--text-muted);">暂无数据</td></tr>';
+                return;
+            }
+            
+            const stateNames = { closed: '关闭', half_open: '半开', open: '打开' };
+            tbody.innerHTML = breakers.map(b => `
+                <tr>
+                    <td><strong>${escapeHtml(b.model)}</strong></td>
+                    <td><span class="state-badge ${b.state}">${stateNames[b.state] || b.state}</span></td>
+                    <td><span class="rate-badge ${getRateClass(b.empty_rate)}">${b.empty_rate}%</span></td>
+                    <td>${formatNumber(b.samples)}</td>
+                    <td>${formatNumber(b.skipped)}</td>
+                    <td>${b.state === 'closed' ? '-' : b.open_seconds + 's'}</td>
+                </tr>
+            `).join('');
         }
         
         function updateHistoryTable(data) {
@@ -712,15 +1094,26 @@ DASHBOARD_HTML = """
             return 'high';
         }
         
-        // 初始加载
-        fetchStats();
-        fetchRecentDays();
-        
-        // 每秒刷新实时数据
-        setInterval(fetchStats, 1000);
+        function escapeHtml(value) {
+            // 模型名等由客户端决定的内容，写入 innerHTML 前必须转义
+            return String(value)
+                .replace(/&/g, '&amp;')
+                .replace(/</g, '&lt;')
+                .replace(/>/g, '&gt;')
+                .replace(/"/g, '&quot;')
+                .replace(/'/g, '&#39;');
+        }
         
-        // 每分钟刷新历史数据
-        setInterval(fetchRecentDays, 60000);
+        if (window.EventSource) {
+            // 由服务端推送实时数据和历史数据
+            connectLive();
+        } else {
+            // 不支持 SSE 的浏览器退回到轮询
+            fetchStats();
+            fetchRecentDays();
+            setInterval(fetchStats, 1000);
+            setInterval(fetchRecentDays, 60000);
+        }
     </script>
 </body>
 </html>
@@ -1167,32 +1560,85 @@ async def dashboard():
 @app.get("/day/{date}", response_class=HTMLResponse)
 async def day_detail(date: str):
     """返回指定日期的详情页面"""
+    if not is_valid_date(date):
+        return HTMLResponse("日期格式应为 YYYY-MM-DD", status_code=400)
     return DAY_DETAIL_HTML.format(date=date)
 
 
-@app.get("/api/stats")
-async def api_stats():
-    """返回统计数据 JSON"""
+def build_stats() -> dict:
+    """生成仪表板展示的统计数据"""
     stats = get_stats()
-    return JSONResponse(content=stats.get_stats())
+    content = stats.get_stats()
+    # 断路器、缓存、连接池等组件属于各 worker 本地状态
+    if WEBUI_MODE == "process":
+        # 独立进程中没有代理组件，展示 worker 发布到共享存储的快照
+        content.update(stats.get_published_components())
+    else:
+        # 展示提供仪表板的 worker
+        content.update(collect_components())
+    if stats.shared:
+        content["workers"] = stats.get_workers()
+    return content
+
+
+def build_recent_days() -> dict:
+    """生成仪表板展示的近 30 天历史"""
+    return {"recent_days": get_stats().get_recent_days_stats(30)}
+
+
+live = LiveBroadcaster(
+    [
+        (DASHBOARD_PUSH_INTERVAL, build_stats),
+        (HISTORY_REFRESH_INTERVAL, build_recent_days)
+    ],
+    interval=DASHBOARD_PUSH_INTERVAL
+)
+
+
+@app.get("/api/stats")
+def api_stats():
+    """返回统计数据 JSON（可能查询共享数据库，在线程池中执行，mount 模式下不阻塞代理的事件循环）"""
+    return FastJSONResponse(content=build_stats())
+
+
+@app.get("/api/live")
+async def api_live():
+    """实时推送统计数据（SSE），只发送变化的字段"""
+    return StreamingResponse(
+        live.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def cached_json(request: Request, entry: HistoryEntry) -> Response:
+    """返回预先序列化的 JSON，If-None-Match 命中时返回 304"""
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
 
+# 以下两个接口会读取快照文件或共享数据库，定义为普通函数，由 FastAPI 在线程池中执行，不阻塞事件循环
+# （mount 模式下与代理共用事件循环）
 
 @app.get("/api/daily/{date}")
-async def api_daily_stats(date: str):
+def api_daily_stats(date: str, request: Request):
     """返回指定日期的统计数据"""
+    if not is_valid_date(date):
+        return FastJSONResponse(content={"error": "日期格式应为 YYYY-MM-DD"}, status_code=400)
     stats = get_stats()
-    data = stats.get_daily_stats(date)
-    if data is None:
-        return JSONResponse(content={"error": f"没有 {date} 的统计数据"})
-    return JSONResponse(content=data)
+    entry = stats.daily_entry(date)
+    if entry is None:
+        return FastJSONResponse(content={"error": f"没有 {date} 的统计数据"})
+    return cached_json(request, entry)
 
 
 @app.get("/api/recent-days")
-async def api_recent_days(days: int = 30):
-    """返回近N天的统计概览"""
+def api_recent_days(request: Request, days: int = 30):
+    """返回近N天的统计概览（最多 MAX_RECENT_DAYS 天）"""
     stats = get_stats()
-    data = stats.get_recent_days_stats(days)
-    return JSONResponse(content=data)
+    return cached_json(request, stats.recent_days_entry(min(max(days, 1), MAX_RECENT_DAYS)))
 
 
 def run_webui():
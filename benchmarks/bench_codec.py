@@ -0,0 +1,123 @@
+"""
+JSON 编解码基准测试
+模拟单个请求在代理中的 JSON 处理量，比较各编解码后端每个请求消耗的 CPU 时间
+
+用法:
+    python benchmarks/bench_codec.py [--requests 2000] [--chunks 200]
+"""
+import argparse
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def build_workload(chunks: int):
+    """构造一个请求的典型数据：请求体、SSE 增量事件、非流式响应和统计数据"""
+    request_body = json.dumps({
+        "model": "gpt-4o",
+        "stream": True,
+        "temperature": 0.7,
+        "messages": [
+            {"role": "system", "content": "你是一个乐于助人的助手。" * 20},
+            {"role": "user", "content": "请详细介绍一下中间件的工作原理。" * 10},
+            {"role": "assistant", "content": "好的，下面是详细介绍。" * 40},
+            {"role": "user", "content": "继续"}
+        ]
+    }, ensure_ascii=False).encode("utf-8")
+
+    sse_payloads = [
+        json.dumps({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "gpt-4o",
+            "choices": [{"index": 0, "delta": {"content": f"第{i}段内容"}, "finish_reason": None}]
+        }, ensure_ascii=False).encode("utf-8")
+        for i in range(chunks)
+    ]
+
+    completion = json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 1700000000,
+        "model": "gpt-4o",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "这是一个完整的回答。" * chunks},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 500, "completion_tokens": chunks, "total_tokens": 500 + chunks}
+    }, ensure_ascii=False).encode("utf-8")
+
+    stats = {
+        "total_requests": 12345,
+        "fallback_rate": 12.5,
+        "hourly_stats": [{"hour": f"{h:02d}", "normal": h * 10, "fallback": h} for h in range(24)]
+    }
+    return request_body, sse_payloads, completion, stats
+
+
+def make_backends():
+    """返回 名称 -> (loads, dumps) 映射"""
+    backends = {
+        "json": (
+            json.loads,
+            lambda obj: json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        )
+    }
+    if orjson is not None:
+        backends["orjson"] = (orjson.loads, orjson.dumps)
+    if msgspec is not None:
+        decoder = msgspec.json.Decoder()
+        encoder = msgspec.json.Encoder()
+        backends["msgspec"] = (decoder.decode, encoder.encode)
+    return backends
+
+
+def run_one_request(loads, dumps, workload) -> None:
+    """执行一个请求的 JSON 处理：解析请求体、逐个解析 SSE 事件、解析并重新编码响应、编码统计数据"""
+    request_body, sse_payloads, completion, stats = workload
+    loads(request_body)
+    for payload in sse_payloads:
+        loads(payload)
+    dumps(loads(completion))
+    dumps(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON 编解码基准测试")
+    parser.add_argument("--requests", type=int, default=2000, help="模拟的请求数")
+    parser.add_argument("--chunks", type=int, default=200, help="每个流式请求的 SSE 事件数")
+    args = parser.parse_args()
+
+    workload = build_workload(args.chunks)
+    backends = make_backends()
+
+    results = {}
+    for name, (loads, dumps) in backends.items():
+        # 预热
+        for _ in range(50):
+            run_one_request(loads, dumps, workload)
+        start = time.process_time()
+        for _ in range(args.requests):
+            run_one_request(loads, dumps, workload)
+        results[name] = (time.process_time() - start) / args.requests * 1e6
+
+    baseline = results["json"]
+    print(f"请求数: {args.requests}，每请求 SSE 事件数: {args.chunks}")
+    print(f"{'后端':<10}{'CPU/请求 (us)':>16}{'节省 (us)':>14}{'加速比':>10}")
+    for name, per_request in results.items():
+        print(f"{name:<10}{per_request:>16.1f}{baseline - per_request:>14.1f}{baseline / per_request:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
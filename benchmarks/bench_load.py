@@ -0,0 +1,418 @@
+"""
+端到端负载基准测试
+在本地启动两个模拟上游（正常/备用，见 fake_upstream.py）和真实的 app.main:app（uvicorn），
+用异步负载生成器以固定并发压测，报告 RPS、代理增加的延迟、首字节时间（TTFT）、
+代理进程每请求 CPU 时间和内存。同样的负载先直连正常上游跑一遍作为对照，
+两者的差即代理增加的延迟（有空响应时包含回退的耗时）
+
+结果可以保存为基线，之后与基线比较，超出容差时以非零状态退出：
+    python benchmarks/bench_load.py --save-baseline benchmarks/baselines/load.json
+    python benchmarks/bench_load.py --baseline benchmarks/baselines/load.json [--tolerance 20]
+
+用法:
+    python benchmarks/bench_load.py [--concurrency 32] [--duration 10] [--warmup 2]
+        [--stream-ratio 0.5] [--empty-rate 0.1] [--latency-ms 50] [--chunks 20]
+        [--token-delay-ms 5] [--workers 1] [--env STREAM_COMMIT_MODE=buffered ...]
+
+CPU 和内存从 /proc 读取，只在 Linux 上报告
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_upstream import UPSTREAM_ARGUMENTS, add_upstream_arguments  # noqa: E402
+
+# 与基线比较的指标：(路径, 越大越好)
+COMPARED_METRICS = (
+    (("proxy", "rps"), True),
+    (("proxy", "latency_ms", "p50"), False),
+    (("proxy", "latency_ms", "p99"), False),
+    (("proxy", "ttft_ms", "p50"), False),
+    (("proxy", "ttft_ms", "p99"), False),
+    (("proxy", "cpu_ms_per_request"), False),
+    (("proxy", "peak_rss_mb"), False),
+)
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return round(values[min(len(values) - 1, int(q * len(values)))], 2)
+
+    return {"p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": round(values[-1], 2)}
+
+
+# ---------- 进程资源 ----------
+
+def _process_tree(pid: int) -> List[int]:
+    """进程及其全部子进程（uvicorn 多 worker 时）"""
+    pids = [pid]
+    index = 0
+    while index < len(pids):
+        try:
+            with open(f"/proc/{pids[index]}/task/{pids[index]}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+        index += 1
+    return pids
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """进程树累计的用户态 + 内核态 CPU 时间（秒）"""
+    total = 0
+    try:
+        for child in _process_tree(pid):
+            with open(f"/proc/{child}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+    except OSError:
+        return None
+    return total / CLOCK_TICKS
+
+
+def memory_mb(pid: int) -> Optional[Dict[str, float]]:
+    """进程树当前 RSS 之和与最大峰值 RSS（MB）"""
+    rss = peak = 0
+    try:
+        for child in _process_tree(pid):
+            with open(f"/proc/{child}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("VmHWM:"):
+                        peak += int(line.split()[1])
+    except OSError:
+        return None
+    return {"rss_mb": round(rss / 1024, 1), "peak_rss_mb": round(peak / 1024, 1)}
+
+
+# ---------- 进程管理 ----------
+
+def start_fake_upstream(port: int, name: str, args: argparse.Namespace, empty_rate: float) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(ROOT, "benchmarks", "fake_upstream.py"), "--port", str(port), "--name", name]
+    for option, *_ in UPSTREAM_ARGUMENTS:
+        value = empty_rate if option == "empty-rate" else getattr(args, option.replace("-", "_"))
+        command += [f"--{option}", str(value)]
+    return subprocess.Popen(command, cwd=ROOT)
+
+
+def start_proxy(port: int, normal: str, fallback: str, args: argparse.Namespace, data_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "UPSTREAM_NORMAL": normal,
+        "UPSTREAM_FALLBACK": fallback,
+        "UPSTREAM_NORMAL_KEY": "bench",
+        "UPSTREAM_FALLBACK_KEY": "bench",
+        "UPSTREAMS_FILE": os.path.join(data_dir, "upstreams.json"),
+        "MIDDLEWARE_API_KEY": "",
+        "DATA_DIR": data_dir,
+        "WEBUI_PORT": str(free_port()),
+        "LOG_LEVEL": args.log_level,
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    command = [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"
+    ]
+    log = open(os.path.join(data_dir, "proxy.log"), "wb")
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                response = await client.get(url)
+                if response.status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"等待 {url} 就绪超时")
+            await asyncio.sleep(0.2)
+
+
+# ---------- 负载生成 ----------
+
+class LoadResult:
+    """一轮压测的客户端观测"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.ttfts: List[float] = []
+        self.errors = 0
+        self.requests = 0
+
+    def summary(self, seconds: float) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "rps": round(self.requests / seconds, 1),
+            "latency_ms": percentiles(self.latencies),
+            "ttft_ms": percentiles(self.ttfts)
+        }
+
+
+def request_body(stream: bool) -> bytes:
+    return json.dumps({
+        "model": "gpt-4o",
+        "stream": stream,
+        "temperature": 0.7,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": f"benchmark request {random.random()}"}
+        ]
+    }).encode()
+
+
+async def one_request(client: httpx.AsyncClient, url: str, stream: bool, result: Optional[LoadResult]) -> None:
+    started = time.perf_counter()
+    try:
+        if stream:
+            ttft = None
+            async with client.stream("POST", url, content=request_body(True), headers={"content-type": "application/json"}) as response:
+                async for chunk in response.aiter_raw():
+                    if ttft is None and chunk:
+                        ttft = time.perf_counter() - started
+                status = response.status_code
+        else:
+            response = await client.post(url, content=request_body(False), headers={"content-type": "application/json"})
+            status = response.status_code
+            ttft = None
+    except httpx.HTTPError:
+        status = 0
+        ttft = None
+    elapsed = time.perf_counter() - started
+
+    if result is None:
+        return
+    result.requests += 1
+    if status != 200:
+        result.errors += 1
+        return
+    result.latencies.append(elapsed * 1000)
+    if ttft is not None:
+        result.ttfts.append(ttft * 1000)
+
+
+async def drive(base_url: str, args: argparse.Namespace) -> dict:
+    """以固定并发压测：预热阶段的请求不计入结果"""
+    url = f"{base_url}/v1/chat/completions"
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    result = LoadResult()
+    recording = False
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def worker(deadline: float):
+            while time.monotonic() < deadline:
+                await one_request(client, url, random.random() < args.stream_ratio, result if recording else None)
+
+        start = time.monotonic()
+        deadline = start + args.warmup + args.duration
+        tasks = [asyncio.create_task(worker(deadline)) for _ in range(args.concurrency)]
+        await asyncio.sleep(args.warmup)
+        recording = True
+        measured_from = time.monotonic()
+        await asyncio.gather(*tasks)
+        seconds = time.monotonic() - measured_from
+    return result.summary(seconds)
+
+
+async def run_proxy_phase(base_url: str, pid: int, args: argparse.Namespace) -> dict:
+    """压测代理，同时记录代理进程树的 CPU 时间和内存"""
+    async def measured():
+        # 预热结束后再开始计 CPU
+        await asyncio.sleep(args.warmup)
+        return cpu_seconds(pid)
+
+    cpu_task = asyncio.create_task(measured())
+    summary = await drive(base_url, args)
+    cpu_before = await cpu_task
+    cpu_after = cpu_seconds(pid)
+    if cpu_before is not None and cpu_after is not None and summary["requests"]:
+        summary["cpu_ms_per_request"] = round((cpu_after - cpu_before) / summary["requests"] * 1000, 3)
+    summary.update(memory_mb(pid) or {})
+    return summary
+
+
+# ---------- 基线 ----------
+
+def lookup(result: dict, path: tuple) -> Optional[float]:
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    与基线比较
+
+    Returns:
+        超出容差的指标说明列表
+    """
+    regressions = []
+    print(f"\n与基线比较（容差 {tolerance:g}%）:")
+    print(f"{'指标':<28}{'基线':>12}{'本次':>12}{'变化':>10}")
+    for path, higher_is_better in COMPARED_METRICS:
+        old, new = lookup(baseline, path), lookup(result, path)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  回退"
+            regressions.append(f"{'.'.join(path)}: {old} -> {new} ({change:+.1f}%)")
+        print(f"{'.'.join(path):<28}{old:>12}{new:>12}{change:>+9.1f}%{flag}")
+    return regressions
+
+
+# ---------- 报告 ----------
+
+def print_report(result: dict) -> None:
+    direct, proxy, overhead = result["direct"], result["proxy"], result["overhead_ms"]
+    print(f"\n{'':<10}{'RPS':>10}{'错误':>8}{'延迟 p50':>12}{'p99':>10}{'TTFT p50':>12}{'p99':>10}")
+    for name, phase in (("直连上游", direct), ("经过代理", proxy)):
+        print(
+            f"{name:<10}{phase['rps']:>10}{phase['errors']:>8}"
+            f"{phase['latency_ms']['p50']:>12}{phase['latency_ms']['p99']:>10}"
+            f"{phase['ttft_ms']['p50']:>12}{phase['ttft_ms']['p99']:>10}"
+        )
+    print(
+        f"代理增加的延迟 (ms): p50 {overhead['latency_p50']}，p99 {overhead['latency_p99']}；"
+        f"TTFT p50 {overhead['ttft_p50']}，p99 {overhead['ttft_p99']}"
+    )
+    if "cpu_ms_per_request" in proxy:
+        print(f"代理 CPU/请求: {proxy['cpu_ms_per_request']} ms")
+    if "rss_mb" in proxy:
+        print(f"代理内存: RSS {proxy['rss_mb']} MB，峰值 {proxy['peak_rss_mb']} MB")
+
+
+async def run(args: argparse.Namespace) -> dict:
+    normal_port, fallback_port, proxy_port = free_port(), free_port(), free_port()
+    data_dir = tempfile.mkdtemp(prefix="bench-load-")
+    processes = [
+        start_fake_upstream(normal_port, "normal", args, args.empty_rate),
+        start_fake_upstream(fallback_port, "fallback", args, 0.0),
+    ]
+    try:
+        normal_url = f"http://127.0.0.1:{normal_port}"
+        fallback_url = f"http://127.0.0.1:{fallback_port}"
+        await wait_ready(f"{normal_url}/v1/models")
+        await wait_ready(f"{fallback_url}/v1/models")
+
+        print("直连正常上游...")
+        direct = await drive(normal_url, args)
+
+        proxy = start_proxy(proxy_port, normal_url, fallback_url, args, data_dir)
+        processes.append(proxy)
+        proxy_url = f"http://127.0.0.1:{proxy_port}"
+        await wait_ready(f"{proxy_url}/health")
+        print(f"经过代理（日志: {os.path.join(data_dir, 'proxy.log')}）...")
+        proxied = await run_proxy_phase(proxy_url, proxy.pid, args)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    return {
+        "scenario": {
+            key: getattr(args, key)
+            for key in ("concurrency", "duration", "warmup", "stream_ratio", "workers", "env")
+        } | {option.replace("-", "_"): getattr(args, option.replace("-", "_")) for option, *_ in UPSTREAM_ARGUMENTS},
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "direct": direct,
+        "proxy": proxied,
+        "overhead_ms": {
+            "latency_p50": round(proxied["latency_ms"]["p50"] - direct["latency_ms"]["p50"], 2),
+            "latency_p99": round(proxied["latency_ms"]["p99"] - direct["latency_ms"]["p99"], 2),
+            "ttft_p50": round(proxied["ttft_ms"]["p50"] - direct["ttft_ms"]["p50"], 2),
+            "ttft_p99": round(proxied["ttft_ms"]["p99"] - direct["ttft_ms"]["p99"], 2)
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端负载基准测试")
+    parser.add_argument("--concurrency", type=int, default=32, help="并发请求数")
+    parser.add_argument("--duration", type=float, default=10, help="计入结果的压测时长（秒）")
+    parser.add_argument("--warmup", type=float, default=2, help="预热时长（秒）")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="流式请求的比例")
+    parser.add_argument("--workers", type=int, default=1, help="代理的 uvicorn worker 数")
+    parser.add_argument("--log-level", default="WARNING", help="代理的日志级别")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给代理的额外环境变量")
+    add_upstream_arguments(parser)
+    # 默认让一部分请求回退，把回退路径也计入测量
+    parser.set_defaults(empty_rate=0.1)
+    parser.add_argument("--json", metavar="PATH", help="把结果写入 JSON 文件")
+    parser.add_argument("--save-baseline", metavar="PATH", help="把结果保存为基线")
+    parser.add_argument("--baseline", metavar="PATH", help="与基线比较")
+    parser.add_argument("--tolerance", type=float, default=20, help="允许的回退百分比")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+                f.write("\n")
+            print(f"结果已写入 {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("scenario") != result["scenario"]:
+            print("警告: 基线的压测参数与本次不同，比较结果可能没有意义")
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print("\n性能回退:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
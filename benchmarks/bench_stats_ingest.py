@@ -0,0 +1,64 @@
+"""
+统计写入基准测试
+分别测量请求路径记录一次请求的耗时和后台聚合的吞吐量（事件/秒）
+
+用法:
+    python benchmarks/bench_stats_ingest.py [--events 1000000] [--batch 10000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="统计写入基准测试")
+    parser.add_argument("--events", type=int, default=1_000_000, help="记录的请求数")
+    parser.add_argument("--batch", type=int, default=10_000, help="每次聚合前累积的请求数")
+    args = parser.parse_args()
+
+    # 统计模块在导入时读取 DATA_DIR，必须先设置
+    data_dir = tempfile.mkdtemp(prefix="bench-stats-")
+    os.environ["DATA_DIR"] = data_dir
+    from app.context import RequestContext, UPSTREAM_FALLBACK, UPSTREAM_NORMAL
+    from app.stats import RequestStats
+
+    stats = RequestStats(backend="memory")
+    # 每 10 个请求中有 1 个回退
+    contexts = [
+        RequestContext(model="gpt-4o", upstream=UPSTREAM_FALLBACK if i == 0 else UPSTREAM_NORMAL,
+                       bytes_in=2048, bytes_out=8192)
+        for i in range(10)
+    ]
+
+    record_time = 0.0
+    aggregate_time = 0.0
+    recorded = 0
+    while recorded < args.events:
+        batch = min(args.batch, args.events - recorded)
+        start = time.perf_counter()
+        for i in range(batch):
+            stats.record_context(contexts[i % 10])
+        record_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        stats.aggregate()
+        aggregate_time += time.perf_counter() - start
+        recorded += batch
+
+    stats.close()
+
+    counters = stats.get_stats()
+    assert counters["total_requests"] == args.events, counters
+
+    print(f"事件数: {args.events}，每批: {args.batch}，数据目录: {data_dir}")
+    print(f"{'阶段':<10}{'耗时/事件 (ns)':>16}{'吞吐量 (事件/秒)':>20}")
+    print(f"{'记录':<10}{record_time / args.events * 1e9:>16.0f}{args.events / record_time:>20,.0f}")
+    print(f"{'聚合':<10}{aggregate_time / args.events * 1e9:>16.0f}{args.events / aggregate_time:>20,.0f}")
+
+
+if __name__ == "__main__":
+    main()
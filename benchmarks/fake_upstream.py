@@ -0,0 +1,165 @@
+"""
+本地模拟的 OpenAI 兼容上游
+供负载基准测试使用：可以配置空响应比例、首字节延迟分布、流式数据块大小和逐 token 间隔。
+直接实现 ASGI 接口，尽量减少上游自身消耗的 CPU
+
+用法:
+    python benchmarks/fake_upstream.py --port 9001 [--empty-rate 0.1] [--latency-ms 50]
+        [--latency-sigma 0.3] [--chunks 20] [--chunk-chars 16] [--token-delay-ms 5]
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+import uvicorn
+
+JSON_HEADERS = [(b"content-type", b"application/json")]
+SSE_HEADERS = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]
+
+
+class FakeUpstream:
+    """模拟上游的 ASGI 应用"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.name = args.name
+        self.empty_rate = args.empty_rate
+        self.latency_ms = args.latency_ms
+        self.latency_sigma = args.latency_sigma
+        self.chunks = args.chunks
+        self.chunk_text = ("x" * (args.chunk_chars - 1) + " ") if args.chunk_chars > 0 else ""
+        self.token_delay = args.token_delay_ms / 1000
+        self.models = json.dumps({
+            "object": "list",
+            "data": [{"id": f"{self.name}-model", "object": "model", "created": 0, "owned_by": self.name}]
+        }).encode()
+
+    def _latency(self) -> float:
+        """首字节延迟（秒）：中位数为 latency_ms 的对数正态分布"""
+        if self.latency_ms <= 0:
+            return 0.0
+        return self.latency_ms * math.exp(random.gauss(0, self.latency_sigma)) / 1000
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        if scope["path"] == "/v1/models":
+            await self._respond(send, 200, JSON_HEADERS, self.models)
+            return
+        if scope["path"] != "/v1/chat/completions" or scope["method"] != "POST":
+            await self._respond(send, 404, JSON_HEADERS, b'{"error":"not found"}')
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        request = json.loads(body)
+
+        empty = random.random() < self.empty_rate
+        await asyncio.sleep(self._latency())
+        if request.get("stream"):
+            include_usage = bool((request.get("stream_options") or {}).get("include_usage"))
+            await self._stream(send, request.get("model", ""), empty, include_usage)
+        else:
+            await self._respond(send, 200, JSON_HEADERS, self._completion(request.get("model", ""), empty))
+
+    @staticmethod
+    async def _respond(send, status: int, headers: list, content: bytes) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers + [(b"content-length", str(len(content)).encode())]
+        })
+        await send({"type": "http.response.body", "body": content})
+
+    def _usage(self, empty: bool) -> dict:
+        completion = 0 if empty else self.chunks
+        return {"prompt_tokens": 10, "completion_tokens": completion, "total_tokens": 10 + completion}
+
+    def _completion(self, model: str, empty: bool) -> bytes:
+        return json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "" if empty else self.chunk_text * self.chunks},
+                "finish_reason": "stop"
+            }],
+            "usage": self._usage(empty)
+        }).encode()
+
+    async def _stream(self, send, model: str, empty: bool, include_usage: bool) -> None:
+        await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+        base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+
+        def event(choices: list, **extra) -> bytes:
+            return b"data: " + json.dumps({**base, "choices": choices, **extra}).encode() + b"\n\n"
+
+        await send({
+            "type": "http.response.body",
+            "body": event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]),
+            "more_body": True
+        })
+        content = "" if empty else self.chunk_text
+        for _ in range(self.chunks):
+            if self.token_delay > 0:
+                await asyncio.sleep(self.token_delay)
+            await send({
+                "type": "http.response.body",
+                "body": event([{"index": 0, "delta": {"content": content}, "finish_reason": None}]),
+                "more_body": True
+            })
+        tail = event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if include_usage:
+            tail += event([], usage=self._usage(empty))
+        await send({"type": "http.response.body", "body": tail + b"data: [DONE]\n\n"})
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="模拟的 OpenAI 兼容上游")
+    parser.add_argument("--port", type=int, required=True, help="监听端口")
+    parser.add_argument("--name", default="upstream", help="上游名称（出现在模型列表中）")
+    add_upstream_arguments(parser)
+    return parser
+
+
+# 上游行为参数：(参数名, 类型, 默认值, 说明)，负载基准测试复用
+UPSTREAM_ARGUMENTS = (
+    ("empty-rate", float, 0.0, "返回空内容的比例"),
+    ("latency-ms", float, 50.0, "首字节延迟的中位数（毫秒）"),
+    ("latency-sigma", float, 0.3, "首字节延迟对数正态分布的 sigma"),
+    ("chunks", int, 20, "每个响应的内容数据块数"),
+    ("chunk-chars", int, 16, "每个数据块的字符数"),
+    ("token-delay-ms", float, 5.0, "流式数据块之间的间隔（毫秒）"),
+)
+
+
+def add_upstream_arguments(parser: argparse.ArgumentParser) -> None:
+    """添加上游行为参数"""
+    for name, type_, default, help_text in UPSTREAM_ARGUMENTS:
+        parser.add_argument(f"--{name}", type=type_, default=default, help=help_text)
+
+
+def main():
+    args = build_parser().parse_args()
+    uvicorn.run(FakeUpstream(args), host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()